@@ -11,4 +11,5 @@ from .task import *         # Depends on ImageInstance, Creator
 from .tag import *          # Depends on Annotation, Study, ImageInstance
 from .annotation import *   # Depends on Patient, Study, Series, ImageInstance, Creator~
 from .segmentation import * # Depends on ImageInstance, Feature, Creator, SubTask
-from .attributes import *   # Depends on Model, ImageInstance
\ No newline at end of file
+from .attributes import *   # Depends on Model, ImageInstance
+from .inference_cache import *  # Independent
\ No newline at end of file
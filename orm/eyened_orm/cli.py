@@ -18,9 +18,14 @@ The following commands are available:
 - test: Create a test database for ORM testing, developing new features or running alembic migrations.
 - full: Create a test database for ORM testing, developing new features or running alembic migrations.
 - update-thumbnails: Update thumbnails for all images in the database.
+- import-manifest: Import images from a CSV/JSONL manifest in checkpointed batches.
 - run-models: Run the models on the database.
+- benchmark-models: Benchmark the CPU inference backends.
 - zarr-tree: Display the structure of the zarr store, showing groups and array shapes.
 - defragment-zarr: Defragment the zarr store by copying all segmentations to a new store with sequential indices.
+- etdrs-report: Create ETDRS reports (area / count per field) for segmentations, in parallel.
+- oct-thickness: Compute ETDRS layer thickness of OCT volumes and store it as attributes.
+- benchmark-registration: Benchmark the pyramid registration against full resolution registration.
 
 Important: import packages that are not dependencies of the ORM within the function definitions, as they are not installed by default.
 """
@@ -130,17 +135,116 @@ def update_thumbnails(env, failed):
         update_thumbnails(session, images)
 
 
+@eorm.command()
+@click.option(
+    "-e", "--env", type=str, help="Path to .env file for environment configuration"
+)
+@click.argument("manifest", type=click.Path(exists=True))
+@click.option(
+    "--batch-size", type=int, default=500, help="Number of rows committed per transaction"
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(),
+    default=None,
+    help="Checkpoint file used to resume the import (default: <manifest>.checkpoint.json)",
+)
+@click.option("--create-projects", is_flag=True, default=False)
+@click.option("--create-patients", is_flag=True, default=False)
+@click.option("--create-studies", is_flag=True, default=False)
+@click.option("--no-thumbnails", is_flag=True, default=False)
+@click.option("--run-models", is_flag=True, default=False)
+@click.option(
+    "--on-duplicate",
+    type=click.Choice(["allow", "skip", "link", "flag"]),
+    default="allow",
+    help="What to do with images whose file is identical to an existing image",
+)
+def import_manifest(
+    env,
+    manifest,
+    batch_size,
+    checkpoint,
+    create_projects,
+    create_patients,
+    create_studies,
+    no_thumbnails,
+    run_models,
+    on_duplicate,
+):
+    """Import images from a CSV or JSONL manifest, committing in batches.
+
+    Progress is recorded in a checkpoint file after every batch. Running the same
+    command again resumes after the last committed row.
+    """
+    from eyened_orm import Database
+    from eyened_orm.importer.importer import Importer
+
+    config = load_config(env)
+    database = Database(config)
+
+    if checkpoint is None:
+        checkpoint = f"{manifest}.checkpoint.json"
+
+    with database.get_session() as session:
+        importer = Importer(
+            session,
+            config,
+            create_patients=create_patients,
+            create_studies=create_studies,
+            create_projects=create_projects,
+            run_ai_models=run_models,
+            generate_thumbnails=not no_thumbnails,
+            on_duplicate=on_duplicate,
+        )
+        stats = importer.import_manifest(
+            manifest, batch_size=batch_size, checkpoint_path=checkpoint
+        )
+
+    print(
+        f"Imported {stats['imported']} images from {stats['rows']} rows "
+        f"in {stats['elapsed']:.1f}s ({stats['images_per_second']:.1f} images/s)"
+    )
+    if stats["duplicates"]:
+        print(f"{stats['duplicates']} images were duplicates of existing images ({on_duplicate})")
+    if stats["failed"]:
+        print(f"{len(stats['failed'])} rows failed (see {checkpoint}):")
+        for failure in stats["failed"][:20]:
+            print(f"  row {failure['row']} ({failure['image']}): {failure['error']}")
+
+
 @eorm.command()
 @click.option(
     "-e", "--env", type=str, help="Path to .env file for environment configuration"
 )
 @click.option("-d", "--device", type=str, default=None)
-def run_models(env, device):
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=1000,
+    help="Number of images processed and committed at a time",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["torch", "onnx", "onnx-int8"]),
+    default="torch",
+    help="Inference backend (onnx and onnx-int8 only on cpu, requires pip install eyened_orm[onnx])",
+)
+@click.option("--threads", type=int, default=None, help="Number of CPU threads")
+@click.option(
+    "--batch-size", type=int, default=16, help="Number of images per forward pass"
+)
+def run_models(env, device, chunk_size, backend, threads, batch_size):
+    """Run the models on all ColorFundus images that have not been preprocessed yet.
+
+    Results are committed per chunk, so an interrupted run resumes where it stopped.
+    """
     import torch
     import tempfile
 
     from eyened_orm import Database
     from eyened_orm.inference.inference import run_inference
+    from eyened_orm.inference.registry import get_registry
     from eyened_orm.inference.utils import auto_device
 
     config = load_config(env)
@@ -150,6 +254,7 @@ def run_models(env, device):
             device = auto_device()
         else:
             device = torch.device(device)
+        registry = get_registry(device, backend=backend, num_threads=threads)
 
         cfi_cache_path = config.cfi_cache_path
         if cfi_cache_path is None:
@@ -158,10 +263,65 @@ def run_models(env, device):
                 config.cfi_cache_path = cfi_cache_path
 
                 print(f"Using temporary cfi_cache_path: {cfi_cache_path}")
+                run_inference(
+                    session,
+                    cfi_cache_path=cfi_cache_path,
+                    registry=registry,
+                    chunk_size=chunk_size,
+                    model_batch_size=batch_size,
+                )
 
         else:
             print(f"Running inference with cfi_cache_path: {cfi_cache_path}")
-        run_inference(session, device=device, cfi_cache_path=cfi_cache_path)
+            run_inference(
+                session,
+                cfi_cache_path=cfi_cache_path,
+                registry=registry,
+                chunk_size=chunk_size,
+                model_batch_size=batch_size,
+            )
+
+
+@eorm.command()
+@click.option(
+    "-e", "--env", type=str, help="Path to .env file for environment configuration"
+)
+@click.option("-n", "--n-images", type=int, default=64, help="Number of images")
+@click.option(
+    "--backend",
+    "backends",
+    type=click.Choice(["torch", "onnx", "onnx-int8"]),
+    multiple=True,
+    default=["torch", "onnx", "onnx-int8"],
+    help="Backends to benchmark (repeat the option for multiple, onnx backends require pip install eyened_orm[onnx])",
+)
+@click.option(
+    "--batch-size",
+    "batch_sizes",
+    type=int,
+    multiple=True,
+    default=[1, 4, 8, 16],
+    help="Batch sizes to benchmark (repeat the option for multiple)",
+)
+@click.option("--threads", type=int, default=None, help="Number of CPU threads")
+@click.option("-o", "--output", type=click.Path(), default=None, help="Write results to CSV")
+def benchmark_models(env, n_images, backends, batch_sizes, threads, output):
+    """Benchmark the CPU inference backends in images/s and compare their outputs to torch."""
+    from eyened_orm import Database
+    from eyened_orm.inference.benchmark import benchmark_backends, load_benchmark_images
+
+    config = load_config(env)
+    database = Database(config)
+    with database.get_session() as session:
+        ids, inputs = load_benchmark_images(session, n_images)
+    print(f"Benchmarking on {len(ids)} images")
+
+    results = benchmark_backends(
+        ids, inputs, backends=backends, batch_sizes=batch_sizes, num_threads=threads
+    )
+    print(results.to_string(index=False, float_format="{:.3f}".format))
+    if output:
+        results.to_csv(output, index=False)
 
 
 @eorm.command()
@@ -301,70 +461,156 @@ def defragment_zarr(env, new_store_path):
     default=False,
     help="Print errors for failed hash calculations",
 )
-def update_hashes(env, print_errors):
+@click.option("-j", "--n-jobs", type=int, default=8, help="Number of worker processes")
+@click.option(
+    "--page-size",
+    type=int,
+    default=1000,
+    help="Number of images hashed and updated per database round trip",
+)
+def update_hashes(env, print_errors, n_jobs, page_size):
     """Update FileChecksum and DataHash for all ImageInstances in the database where they are NULL.
 
-    This command will iterate over all ImageInstances in the database with FileChecksum == None
-    or DataHash == None and populate them with the outputs of im.calc_file_checksum() and
-    im.calc_data_hash() respectively.
+    Images with FileChecksum == None or DataHash == None are read from the database in pages
+    and hashed in a process pool. The results are written back with one bulk UPDATE per page.
+    The values are the same as those of im.calc_file_checksum() and im.calc_data_hash().
     """
-    from eyened_orm import Database, ImageInstance
-    from sqlalchemy import select
+    from eyened_orm import Database
+    from eyened_orm.utils.hashes import update_hashes
 
     config = load_config(env)
     database = Database(config)
 
     with database.get_session() as session:
-        # Get all image instances with missing hashes
-        query = select(ImageInstance).filter(
-            (ImageInstance.FileChecksum == None) | (ImageInstance.DataHash == None)
+        stats = update_hashes(
+            session, n_jobs=n_jobs, page_size=page_size, print_errors=print_errors
+        )
+
+    print(
+        f"Completed: Updated hashes for {stats['updated']} images with {stats['errors']} errors "
+        f"({stats['bytes'] / 1e9:.1f} GB in {stats['elapsed']:.0f}s, {stats['mb_per_second']:.1f} MB/s)"
+    )
+
+
+@eorm.command()
+@click.option(
+    "-e", "--env", type=str, help="Path to .env file for environment configuration"
+)
+@click.option(
+    "-f",
+    "--feature",
+    "features",
+    type=str,
+    multiple=True,
+    required=True,
+    help="FeatureName of the segmentations to report (can be repeated)",
+)
+@click.option("--project", type=int, default=None, help="Only images of this ProjectID")
+@click.option("--tag", type=str, default=None, help="Only images with this (ImageInstance) tag")
+@click.option(
+    "--source",
+    type=click.Choice(["model", "annotation"]),
+    default="model",
+    help="Report model segmentations or (active) annotated segmentations",
+)
+@click.option(
+    "-o", "--output", type=click.Path(), required=True, help="Folder to write the reports to"
+)
+@click.option("-j", "--n-jobs", type=int, default=8, help="Number of worker processes")
+@click.option(
+    "--batch-size",
+    type=int,
+    default=32,
+    help="Number of images read from the database and zarr store at once",
+)
+@click.option("--no-html", is_flag=True, default=False, help="Only write report.json")
+@click.option("--overwrite", is_flag=True, default=False, help="Recreate existing reports")
+def etdrs_report(
+    env, features, project, tag, source, output, n_jobs, batch_size, no_html, overwrite
+):
+    """Create ETDRS reports for the segmentations of the selected images.
+
+    For each image the latest segmentation of each feature is summarized per ETDRS field
+    (area, number of connected components and largest component) in OUTPUT/<ImageInstanceID>.
+    Images that already have a report are skipped. All summaries are combined in
+    OUTPUT/etdrs_report.parquet.
+    """
+    from eyened_orm import Database
+    from eyened_orm.reports.batch import run_etdrs_reports
+
+    config = load_config(env)
+    database = Database(config)
+    with database.get_session() as session:
+        run_etdrs_reports(
+            session,
+            features,
+            output,
+            project_id=project,
+            tag=tag,
+            source=source,
+            n_jobs=n_jobs,
+            batch_size=batch_size,
+            export_html=not no_html,
+            overwrite=overwrite,
         )
 
-        images = session.execute(query).scalars().all()
-        total = len(images)
-
-        print(f"Found {total} images with missing hashes")
-        processed = 0
-        errors = 0
-
-        for im in tqdm(images):
-            try:
-                updated = False
-
-                if im.FileChecksum is None:
-                    try:
-                        im.FileChecksum = im.calc_file_checksum()
-                        updated = True
-                    except Exception as e:
-                        if print_errors:
-                            print(
-                                f"Error calculating file checksum for ImageInstanceID={im.ImageInstanceID}, path={im.path}: {e}"
-                            )
-                        errors += 1
-
-                if im.DataHash is None:
-                    try:
-                        im.DataHash = im.calc_data_hash()
-                        updated = True
-                    except Exception as e:
-                        if print_errors:
-                            print(
-                                f"Error calculating data hash for ImageInstanceID={im.ImageInstanceID}, path={im.path}: {e}"
-                            )
-                        errors += 1
-
-                if updated:
-                    processed += 1
-                    if processed % 1000 == 0:
-                        session.commit()
-
-            except Exception as e:
-                if print_errors:
-                    print(f"Error processing ImageInstanceID={im.ImageInstanceID}: {e}")
-                errors += 1
-
-        session.commit()
-        print(f"Completed: Updated hashes for {processed} images with {errors} errors")
+
+@eorm.command()
+@click.option(
+    "-e", "--env", type=str, help="Path to .env file for environment configuration"
+)
+@click.option(
+    "-f",
+    "--feature",
+    type=str,
+    required=True,
+    help="FeatureName of the layer segmentations (MultiClass: one layer per subfeature)",
+)
+@click.option("--project", type=int, default=None, help="Only images of this ProjectID")
+@click.option("--tag", type=str, default=None, help="Only images with this (ImageInstance) tag")
+@click.option(
+    "--source",
+    type=click.Choice(["model", "annotation"]),
+    default="model",
+    help="Use model segmentations or (active) annotated segmentations",
+)
+@click.option(
+    "--fovea-feature",
+    type=str,
+    default="Fovea",
+    help="FeatureName of the annotated fovea segmentations the grid is centered on",
+)
+@click.option("-j", "--n-jobs", type=int, default=8, help="Number of worker processes")
+@click.option(
+    "--batch-size", type=int, default=64, help="Number of volumes measured per commit"
+)
+@click.option(
+    "--slab-size", type=int, default=16, help="Number of B-scans reduced at once"
+)
+def oct_thickness(env, feature, project, tag, source, fovea_feature, n_jobs, batch_size, slab_size):
+    """Compute ETDRS layer thickness of OCT volumes and store it as attributes.
+
+    For each volume the latest layer segmentation is reduced to an enface thickness map per
+    layer, and the mean thickness (mm) and volume (mm³) per ETDRS field are stored as
+    AttributeValues of the "ETDRS thickness" model.
+    """
+    from eyened_orm import Database
+    from eyened_orm.reports.thickness import run_oct_thickness
+
+    config = load_config(env)
+    database = Database(config)
+    with database.get_session() as session:
+        run_oct_thickness(
+            session,
+            feature,
+            project_id=project,
+            tag=tag,
+            source=source,
+            fovea_feature=fovea_feature,
+            n_jobs=n_jobs,
+            batch_size=batch_size,
+            slab_size=slab_size,
+        )
 
 
 @eorm.command()
@@ -386,11 +632,65 @@ def update_hashes(env, print_errors):
 @click.option(
     "--replace", is_flag=True, required=False, default=False, help="Replace existing registration"
 )
-def run_registration(env, patient, project, schema, creator, replace):
+@click.option(
+    "--feature-cache",
+    type=click.Path(),
+    required=False,
+    default=None,
+    help="Folder to cache registration features in (default: CFI_CACHE_PATH/registration)",
+)
+@click.option(
+    "-j",
+    "--n-jobs",
+    type=int,
+    default=1,
+    help="Number of worker processes, each registering one eye of a patient at a time (default 1: no pool)",
+)
+@click.option(
+    "--pyramid",
+    is_flag=True,
+    default=False,
+    help="Register on a coarse level first and refine at full resolution only where needed",
+)
+@click.option(
+    "--min-quality",
+    type=float,
+    default=0.15,
+    help="Pyramid: reject pairs with a lower coarse fit quality",
+)
+@click.option(
+    "--accept-quality",
+    type=float,
+    default=0.5,
+    help="Pyramid: accept coarse fits from this quality without refinement (above 1: always refine)",
+)
+def run_registration(
+    env, patient, project, schema, creator, replace, feature_cache, n_jobs, pyramid, min_quality, accept_quality
+):
     from eyened_orm import Database, Patient, Project
-    from eyened_orm.utils.registration import get_or_create_schema, get_or_create_creator, run_patient
+    from eyened_orm.utils.registration import (
+        FeatureCache,
+        get_or_create_creator,
+        get_or_create_schema,
+        run_patient,
+        run_registration_parallel,
+    )
 
     config = load_config(env)
+    if feature_cache is None and config.cfi_cache_path is not None:
+        feature_cache = config.cfi_cache_path / "registration"
+    if feature_cache is not None:
+        print(f"Using registration feature cache: {feature_cache}")
+        feature_cache = FeatureCache(feature_cache)
+    if pyramid:
+        pyramid = {
+            "cfi_cache_path": config.cfi_cache_path,
+            "min_quality": min_quality,
+            "accept_quality": accept_quality,
+        }
+    else:
+        pyramid = None
+
     database = Database(config)
     with database.get_session() as session:
             
@@ -398,13 +698,61 @@ def run_registration(env, patient, project, schema, creator, replace):
         creator = get_or_create_creator(session, creator)
         if patient:
             patients = Patient.where(session, Patient.PatientIdentifier == patient)
-            for patient in patients:
-                run_patient(session, patient, schema, creator, replace)
         elif project:
             project = Project.by_id(session, project)
             patients = Patient.where(session, Patient.ProjectID == project.ProjectID)
-            for patient in patients:
-                run_patient(session, patient, schema, creator, replace)
         else:
             print("No patient or project provided")
-        
\ No newline at end of file
+            return
+
+        if n_jobs > 1:
+            run_registration_parallel(
+                session, patients, schema, creator, replace, feature_cache, n_jobs, pyramid
+            )
+        else:
+            for patient in patients:
+                run_patient(session, patient, schema, creator, replace, feature_cache, pyramid)
+        
+
+
+@eorm.command()
+@click.option(
+    "-e", "--env", type=str, help="Path to .env file for environment configuration"
+)
+@click.option("-n", "--n-pairs", type=int, default=32, help="Number of image pairs")
+@click.option("--patient", type=str, default=None, help="Only pairs of this patient identifier")
+@click.option("--project", type=int, default=None, help="Only pairs of this ProjectID")
+@click.option("--min-quality", type=float, default=0.15, help="Reject pairs with a lower coarse fit quality")
+@click.option(
+    "--accept-quality",
+    type=float,
+    default=0.5,
+    help="Accept coarse fits from this quality without refinement (above 1: always refine)",
+)
+@click.option("-o", "--output", type=click.Path(), default=None, help="Write results to CSV")
+def benchmark_registration(env, n_pairs, patient, project, min_quality, accept_quality, output):
+    """Benchmark the pyramid registration against full resolution registration (time and agreement)."""
+    import pandas as pd
+
+    from eyened_orm import Database
+    from eyened_orm.utils.registration_benchmark import (
+        benchmark_registration,
+        load_benchmark_pairs,
+        summarize_benchmark,
+    )
+
+    config = load_config(env)
+    database = Database(config)
+    with database.get_session() as session:
+        pairs = load_benchmark_pairs(session, n_pairs, project, patient)
+        print(f"Benchmarking on {len(pairs)} pairs")
+        results = benchmark_registration(
+            pairs,
+            config.cfi_cache_path,
+            min_quality=min_quality,
+            accept_quality=accept_quality,
+        )
+    print(results.to_string(index=False, float_format="{:.3f}".format))
+    print(pd.Series(summarize_benchmark(results)).to_string(float_format="{:.3f}".format))
+    if output:
+        results.to_csv(output, index=False)
@@ -20,6 +20,7 @@ from .base import Base
 
 if TYPE_CHECKING:
     from eyened_orm import Annotation, Creator, ImageInstanceTagLink, Series
+    from eyened_orm.reports import ETDRS_masks
 
 
 class Laterality(Enum):
@@ -71,6 +72,58 @@ class ETDRSField(Enum):
     F7 = "F7"
 
 
+def load_pixel_array(
+    images_basepath: Path,
+    dataset_identifier: str,
+    rows: Optional[int] = None,
+    columns: Optional[int] = None,
+) -> np.ndarray:
+    """Return the raw data for an image (see ImageInstance.pixel_array)"""
+    images_basepath = Path(images_basepath)
+    path = images_basepath / dataset_identifier
+    if dataset_identifier.endswith(".dcm"):
+        ds = pydicom.dcmread(path)
+        return ds.pixel_array
+    elif dataset_identifier.endswith(".binary"):
+        with open(path, "rb") as f:
+            raw = np.frombuffer(f.read(), dtype=np.uint8)
+            data = raw.reshape((-1, rows, columns), order="C")
+        return data
+    elif dataset_identifier.startswith("[png_series_"):
+        prefix, filename = dataset_identifier.split("]", 1)
+        n_files = int(prefix[len("[png_series_") :])
+        base_path = images_basepath / filename
+        return np.array(
+            [
+                np.array(Image.open(base_path.parent / f"{base_path.stem}_{i}.png"))
+                for i in range(n_files)
+            ]
+        ).squeeze()
+    else:
+        return np.array(Image.open(path))
+
+
+def data_hash(data: np.ndarray) -> str:
+    """Return the sha256 hexdigest of the bytes of a pixel array (see ImageInstance.calc_data_hash)"""
+    import hashlib
+
+    # Ensure the array is contiguous in memory for consistent byte representation
+    # (hashlib reads the buffer directly, without copying it with tobytes)
+    contiguous_data = np.ascontiguousarray(data)
+    return hashlib.sha256(memoryview(contiguous_data).cast("B")).hexdigest()
+
+
+def file_checksum(path: str | Path, chunk_size: int = 1 << 20) -> bytes:
+    """Return the md5 digest of a file, read in chunks of chunk_size bytes."""
+    import hashlib
+
+    md5_hash = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5_hash.update(chunk)
+    return md5_hash.digest()
+
+
 class ImageInstance(Base):
     __tablename__ = "ImageInstance"
     __table_args__ = (
@@ -90,6 +143,9 @@ class ImageInstance(Base):
             "SourceInfoID",
             unique=True,
         ),
+        # prefix indexes, used for duplicate detection
+        Index("FileChecksum_idx", "FileChecksum", mysql_length=16),
+        Index("DataHash_idx", "DataHash", mysql_length=64),
     )
 
     ImageInstanceID: Mapped[int] = mapped_column(primary_key=True)
@@ -218,6 +274,11 @@ class ImageInstance(Base):
     DateModified: Mapped[Optional[datetime]] = mapped_column(onupdate=func.now())
     # DatePreprocessed is the date and time the image was last preprocessed
     DatePreprocessed: Mapped[Optional[datetime]]
+    # Inference task that is processing the image, until InferenceLeaseUntil, and the number of
+    # inference runs that failed on the image (see eyened_orm.inference.queue)
+    InferenceLeaseOwner: Mapped[Optional[str]] = mapped_column(String(64))
+    InferenceLeaseUntil: Mapped[Optional[datetime]]
+    InferenceAttempts: Mapped[int] = mapped_column(default=0, server_default="0")
 
     # relationships:
     Annotations: Mapped[List["Annotation"]] = relationship(
@@ -312,26 +373,9 @@ class ImageInstance(Base):
     @property
     def pixel_array(self):
         """Return the raw data for this image as a numpy array"""
-        if self.DatasetIdentifier.endswith(".dcm"):
-            ds = pydicom.dcmread(self.path)
-            return ds.pixel_array
-        elif self.DatasetIdentifier.endswith(".binary"):
-            with open(self.path, "rb") as f:
-                raw = np.frombuffer(f.read(), dtype=np.uint8)
-                data = raw.reshape((-1, self.Rows_y, self.Columns_x), order="C")
-            return data
-        elif self.DatasetIdentifier.startswith("[png_series_"):
-            prefix, filename = self.DatasetIdentifier.split("]", 1)
-            n_files = int(prefix[len("[png_series_") :])
-            base_path = self.config.images_basepath / filename
-            return np.array(
-                [
-                    np.array(Image.open(base_path.parent / f"{base_path.stem}_{i}.png"))
-                    for i in range(n_files)
-                ]
-            ).squeeze()
-        else:
-            return np.array(Image.open(self.path))
+        return load_pixel_array(
+            self.config.images_basepath, self.DatasetIdentifier, self.Rows_y, self.Columns_x
+        )
 
     @property
     def bounds(self) -> CFIBounds:
@@ -360,36 +404,55 @@ class ImageInstance(Base):
             return None
         return self.bounds.get_cropping_transform(1024).M_inv
 
+    def ETDRS_masks(self, fovea_tolerance: float = 0) -> "ETDRS_masks":
+        """ETDRS grid in image space, centered on the fovea found by the models (CFKeypoints)"""
+        from eyened_orm.reports.etdrs_masks import ETDRS_masks
+
+        if not self.CFKeypoints or self.CFKeypoints.get("fovea_xy") is None:
+            raise ValueError(f"No fovea location for image {self.ImageInstanceID}")
+        if self.ResolutionHorizontal is None or self.ResolutionVertical is None:
+            raise ValueError(f"No resolution for image {self.ImageInstanceID}")
+        if self.Rows_y is None or self.Columns_x is None:
+            raise ValueError(f"No image size for image {self.ImageInstanceID}")
+        if self.Laterality is None:
+            # the nasal and temporal fields depend on the eye
+            raise ValueError(f"No laterality for image {self.ImageInstanceID}")
+
+        fovea_x, fovea_y = self.CFKeypoints["fovea_xy"]
+        return ETDRS_masks(
+            self.Rows_y,
+            self.Columns_x,
+            fovea_x,
+            fovea_y,
+            (self.ResolutionHorizontal, self.ResolutionVertical),
+            self.Laterality.value,
+            fovea_tolerance=fovea_tolerance,
+        )
+
     def calc_data_hash(self):
         """Return the hash of the image data"""
-        import hashlib
-
         if not self.path.exists():
             raise FileNotFoundError(f"File {self.path} does not exist")
 
-        # Get the raw data as numpy array
-        data = self.pixel_array
-
-        # Ensure the array is contiguous in memory for consistent byte representation
-        contiguous_data = np.ascontiguousarray(data)
-
-        # Convert to bytes and calculate hash
-        data_bytes = contiguous_data.tobytes()
-        return hashlib.sha256(data_bytes).hexdigest()
+        return data_hash(self.pixel_array)
 
     def calc_file_checksum(self):
         """Return the checksum of the file"""
-        import hashlib
-
         if not self.path.exists():
             raise FileNotFoundError(f"File {self.path} does not exist")
 
-        md5_hash = hashlib.md5()
+        return file_checksum(self.path)
 
-        with open(self.path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-        return md5_hash.digest()
+    @classmethod
+    def by_file_checksums(
+        cls, session: Session, checksums: List[bytes]
+    ) -> List["ImageInstance"]:
+        """Find the image instances with any of the given file checksums (uses FileChecksum_idx)."""
+        checksums = {c for c in checksums if c is not None}
+        if not checksums:
+            return []
+        stmt = select(cls).where(cls.FileChecksum.in_(checksums), cls.Inactive == False)
+        return session.scalars(stmt).all()
 
     @classmethod
     def _base_joins(cls, statement):
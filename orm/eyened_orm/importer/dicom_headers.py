@@ -0,0 +1,279 @@
+"""
+Import front-end for folders of DICOM files.
+
+Only the DICOM headers are read (stop_before_pixels=True), which is much cheaper than
+decoding pixel data. Headers are read in a process pool and mapped onto the props of
+Patient, Study, Series and ImageInstance.
+
+Typical usage:
+
+    data = dicom_folder_to_import_data("/images/export_2024", project_name="MyProject")
+    importer.import_many(data)
+
+or, for large exports, write the rows to a JSONL manifest and use Importer.import_manifest.
+"""
+
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+from tqdm import tqdm
+
+from eyened_orm.importer.manifest import group_rows
+
+def _value(ds, keyword, default=None):
+    value = getattr(ds, keyword, None)
+    if value is None or value == "":
+        return default
+    return value
+
+
+def _float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_date(value) -> Optional[datetime.date]:
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(str(value)[:8], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def _parse_datetime(date_value, time_value=None) -> Optional[datetime.datetime]:
+    if not date_value:
+        return None
+    value = str(date_value)
+    if time_value:
+        value += str(time_value)
+    # DICOM DT: YYYYMMDDHHMMSS.FFFFFF (trailing components optional)
+    value = value.split("+")[0].split("-")[0]
+    for fmt, n in (("%Y%m%d%H%M%S.%f", None), ("%Y%m%d%H%M%S", 14), ("%Y%m%d%H%M", 12), ("%Y%m%d", 8)):
+        try:
+            return datetime.datetime.strptime(value if n is None else value[:n], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _pixel_measures(ds):
+    """Return (PixelSpacing, SliceThickness) from the dataset or its shared functional groups."""
+    pixel_spacing = _value(ds, "PixelSpacing")
+    slice_thickness = _value(ds, "SliceThickness")
+
+    shared = _value(ds, "SharedFunctionalGroupsSequence")
+    if shared and (pixel_spacing is None or slice_thickness is None):
+        measures = _value(shared[0], "PixelMeasuresSequence")
+        if measures:
+            pixel_spacing = pixel_spacing or _value(measures[0], "PixelSpacing")
+            slice_thickness = slice_thickness or _value(measures[0], "SliceThickness")
+    return pixel_spacing, slice_thickness
+
+
+def header_to_image_props(ds) -> Dict[str, Any]:
+    """Map the header of a DICOM dataset onto ImageInstance props."""
+    dicom_modality = _value(ds, "Modality")
+    samples_per_pixel = _value(ds, "SamplesPerPixel")
+    laterality = _value(ds, "ImageLaterality") or _value(ds, "Laterality")
+
+    props = {
+        "SOPInstanceUid": _value(ds, "SOPInstanceUID"),
+        "SOPClassUid": _value(ds, "SOPClassUID"),
+        "PhotometricInterpretation": _value(ds, "PhotometricInterpretation"),
+        "SamplesPerPixel": int(samples_per_pixel) if samples_per_pixel is not None else None,
+        "Rows_y": int(_value(ds, "Rows", 0)) or None,
+        "Columns_x": int(_value(ds, "Columns", 0)) or None,
+        "NrOfFrames": int(_value(ds, "NumberOfFrames", 1)),
+        "Laterality": laterality if laterality in ("L", "R") else None,
+        "DICOMModality": dicom_modality if dicom_modality in ("OP", "OPT", "SC") else None,
+        "HorizontalFieldOfView": _float(_value(ds, "HorizontalFieldOfView")),
+        "AcquisitionDateTime": _parse_datetime(_value(ds, "AcquisitionDateTime"))
+        or _parse_datetime(_value(ds, "AcquisitionDate"), _value(ds, "AcquisitionTime")),
+    }
+
+    pupil_dilated = _value(ds, "PupilDilated")
+    if pupil_dilated in ("YES", "NO"):
+        props["PupilDilated"] = pupil_dilated == "YES"
+
+    pixel_spacing, slice_thickness = _pixel_measures(ds)
+    if dicom_modality == "OPT":
+        # OCT: rows are along the A-scan, columns along the B-scan, frames are B-scans
+        props["Modality"] = "OCT"
+        if pixel_spacing is not None:
+            props["ResolutionAxial"] = _float(pixel_spacing[0])
+            props["ResolutionHorizontal"] = _float(pixel_spacing[1])
+        props["SliceThickness"] = _float(slice_thickness)
+        props["ResolutionVertical"] = _float(
+            _value(ds, "SpacingBetweenSlices", slice_thickness)
+        )
+    else:
+        if dicom_modality == "OP" and props["SamplesPerPixel"] == 3:
+            props["Modality"] = "ColorFundus"
+        if pixel_spacing is not None:
+            props["ResolutionVertical"] = _float(pixel_spacing[0])
+            props["ResolutionHorizontal"] = _float(pixel_spacing[1])
+
+    return {k: v for k, v in props.items() if v is not None}
+
+
+def read_dicom_header(path: str | Path) -> Optional[Dict[str, Any]]:
+    """
+    Read the header of a single DICOM file.
+
+    Returns a flat import row (see Importer.import_one) with the header mapped onto
+    the props of each level, or None if the file is not a DICOM file.
+    """
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+    except (InvalidDicomError, IsADirectoryError):
+        return None
+
+    if _value(ds, "DirectoryRecordSequence") is not None:
+        # DICOMDIR file, not an image
+        return None
+
+    patient_props = {
+        "BirthDate": _parse_date(_value(ds, "PatientBirthDate")),
+        "Sex": _value(ds, "PatientSex") if _value(ds, "PatientSex") in ("M", "F") else None,
+    }
+    study_props = {"StudyDescription": _value(ds, "StudyDescription")}
+    series_number = _value(ds, "SeriesNumber")
+    series_props = {
+        "SeriesInstanceUid": _value(ds, "SeriesInstanceUID"),
+        "StudyInstanceUid": _value(ds, "StudyInstanceUID"),
+        "SeriesNumber": int(series_number) if series_number is not None else None,
+    }
+
+    return {
+        "patient_identifier": _value(ds, "PatientID"),
+        "patient_props": {k: v for k, v in patient_props.items() if v is not None},
+        "study_date": _parse_date(_value(ds, "StudyDate")),
+        "study_props": {k: v for k, v in study_props.items() if v is not None},
+        "series_props": {k: v for k, v in series_props.items() if v is not None},
+        "image": str(Path(path).absolute()),
+        "image_props": header_to_image_props(ds),
+    }
+
+
+def _read_header_safe(path):
+    try:
+        return read_dicom_header(path), None
+    except Exception as e:
+        return None, f"{path}: {e}"
+
+
+def find_dicom_files(root: str | Path, use_dicomdir: bool = True) -> List[Path]:
+    """
+    Find candidate DICOM files below root.
+
+    If use_dicomdir is True and root contains a DICOMDIR, the files referenced by the
+    DICOMDIR are returned. Otherwise, all files in the directory tree are returned
+    (non-DICOM files are skipped later when reading the headers).
+    """
+    root = Path(root)
+    dicomdir = root / "DICOMDIR"
+    if use_dicomdir and dicomdir.exists():
+        from pydicom.fileset import FileSet
+
+        fileset = FileSet(pydicom.dcmread(dicomdir))
+        return [Path(instance.path) for instance in fileset]
+
+    return [
+        Path(dirpath) / filename
+        for dirpath, _, filenames in os.walk(root)
+        for filename in filenames
+        if filename != "DICOMDIR"
+    ]
+
+
+def extract_headers(
+    paths: Iterable[str | Path],
+    n_jobs: int = 8,
+    chunksize: int = 32,
+    print_errors: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Read DICOM headers for paths in a process pool.
+
+    Returns the flat import rows for all DICOM files (non-DICOM files are skipped).
+    """
+    paths = list(paths)
+    rows = []
+    errors = []
+
+    if n_jobs <= 1:
+        results = map(_read_header_safe, paths)
+        for row, error in tqdm(results, total=len(paths)):
+            rows.append(row)
+            errors.append(error)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = executor.map(_read_header_safe, paths, chunksize=chunksize)
+            for row, error in tqdm(results, total=len(paths)):
+                rows.append(row)
+                errors.append(error)
+
+    errors = [e for e in errors if e is not None]
+    if errors:
+        print(f"Failed to read {len(errors)} files")
+        if print_errors:
+            for error in errors:
+                print(error)
+    return [row for row in rows if row is not None]
+
+
+def dicom_folder_to_rows(
+    root: str | Path,
+    project_name: str,
+    n_jobs: int = 8,
+    use_dicomdir: bool = True,
+    image_props: Optional[Dict[str, Any]] = None,
+    patient_identifier_fn: Optional[Callable[[Dict[str, Any]], str]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Walk root and return one flat import row per DICOM file.
+
+    Parameters:
+    -----------
+    root : str | Path
+        Folder containing the DICOM files (e.g. a device export), must be within images_basepath
+    project_name : str
+        Project to import the images into
+    n_jobs : int, default=8
+        Number of processes used to read headers
+    use_dicomdir : bool, default=True
+        Use the DICOMDIR in root (if present) to find the files
+    image_props : dict, optional
+        Props added to every image, overriding values read from the headers
+        (e.g. {"Modality": "InfraredReflectance"})
+    patient_identifier_fn : callable, optional
+        Maps a row to a patient identifier, e.g. to pseudonymize the DICOM PatientID
+    """
+    paths = find_dicom_files(root, use_dicomdir=use_dicomdir)
+    print(f"Found {len(paths)} candidate files in {root}")
+    rows = extract_headers(paths, n_jobs=n_jobs)
+
+    for row in rows:
+        row["project_name"] = project_name
+        if patient_identifier_fn is not None:
+            row["patient_identifier"] = patient_identifier_fn(row)
+        if image_props:
+            row["image_props"] = {**row["image_props"], **image_props}
+    return rows
+
+
+def dicom_folder_to_import_data(root: str | Path, project_name: str, **kwargs) -> List[Dict]:
+    """
+    Walk root and return the nested structure expected by Importer.import_many.
+
+    See dicom_folder_to_rows for the parameters.
+    """
+    return group_rows(dicom_folder_to_rows(root, project_name, **kwargs))
@@ -1,7 +1,13 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 import requests
-from typing import Optional
+from requests.adapters import HTTPAdapter
+from typing import Iterable, List, Optional
+from urllib3.util.retry import Retry
+from tqdm import tqdm
 
 
 @dataclass
@@ -12,6 +18,10 @@ class ImageImporter:
     into the platform, with options to create associated metadata (projects, patients,
     studies, and series) as needed.
 
+    Authentication uses the session cookies of the platform. When the access token expires
+    (a request returns 401), the importer refreshes it using the refresh token and
+    logs in again if that fails, so long running imports are not interrupted.
+
     Args:
         admin_username (str): Username for platform authentication
         admin_password (str): Password for platform authentication
@@ -24,6 +34,11 @@ class ImageImporter:
         create_series (bool, optional): Whether to create series if not exist. Defaults to True.
         include_stack_trace (bool, optional): Whether to include stack trace in responses. Defaults to True.
         remember_me (bool, optional): Whether to remember the user. Defaults to False, providing a 1 hour session, otherwise 30 days.
+        on_duplicate (str, optional): What to do with images identical to an existing image: "allow", "skip", "link" or "flag". Defaults to "allow".
+        max_workers (int, optional): Number of concurrent requests used by import_images. Defaults to 8.
+        max_retries (int, optional): Number of retries for failed connections and 502/503/504 responses. Defaults to 3.
+        backoff_factor (float, optional): Backoff factor between retries (0.5 -> 0.5s, 1s, 2s, ...). Defaults to 0.5.
+        timeout (float, optional): Timeout in seconds for a single request. Defaults to 300.
     """
 
     admin_username: str
@@ -38,21 +53,50 @@ class ImageImporter:
     create_series: bool = True
     include_stack_trace: bool = True
     remember_me: bool = False
+    on_duplicate: str = "allow"
+
+    max_workers: int = 8
+    max_retries: int = 3
+    backoff_factor: float = 0.5
+    timeout: float = 300
 
     _session: Optional[requests.Session] = field(default=None, init=False)
+    _auth_lock: threading.Lock = field(default_factory=threading.Lock, init=False)
 
     def __post_init__(self):
-        """Initialize paths and endpoints, and perform initial login."""s
+        """Initialize paths and endpoints, and perform initial login."""
         self.base_url = f"http://{self.host}:{self.port}"
         self.image_endpoint = f"{self.base_url}/api/import/image"
-        self.login_endpoint = f"{self.base_url}/api/auth/login-password"
-        self._session = requests.Session()
+        self.batch_endpoint = f"{self.base_url}/api/import/batch"
+        self.login_endpoint = f"{self.base_url}/api/auth/login"
+        self.refresh_endpoint = f"{self.base_url}/api/auth/refresh"
+        self._session = self._create_session()
         self._login()
 
-    def _login(self) -> None:
-        """Login to the platform and store session cookie for subsequent requests.
+    def _create_session(self) -> requests.Session:
+        """Create a session with a connection pool sized for max_workers and automatic retries."""
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,  # do not resend requests that may have been processed
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=None,  # also retry POST on the statuses above
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(self.max_workers, 1),
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
-        The session cookie will be valid for 1 hour.
+    def _login(self) -> None:
+        """Login to the platform and store session cookies for subsequent requests.
 
         Raises:
             requests.exceptions.HTTPError: If login request fails
@@ -60,14 +104,48 @@ class ImageImporter:
         login_data = {
             "username": self.admin_username,
             "password": self.admin_password,
-            "remember_me": False,  # will be valid for 1 hour
+            "remember_me": self.remember_me,
         }
         response = self._session.post(
             self.login_endpoint,
             json=login_data,
+            timeout=self.timeout,
         )
         response.raise_for_status()
 
+    def _reauthenticate(self, failed_cookie: Optional[str]) -> None:
+        """Refresh the access token, falling back to a full login.
+
+        failed_cookie is the access token that was rejected. If another thread already
+        renewed the token in the meantime, nothing is done.
+        """
+        with self._auth_lock:
+            if self._session.cookies.get("jwt_token") != failed_cookie:
+                return
+            response = self._session.post(self.refresh_endpoint, timeout=self.timeout)
+            if response.status_code != 200:
+                self._login()
+
+    def _post(self, url: str, **kwargs) -> requests.Response:
+        """POST with transparent re-authentication when the access token has expired."""
+        cookie = self._session.cookies.get("jwt_token")
+        response = self._session.post(url, timeout=self.timeout, **kwargs)
+        if response.status_code == 401:
+            self._reauthenticate(cookie)
+            response = self._session.post(url, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        """GET with transparent re-authentication when the access token has expired."""
+        cookie = self._session.cookies.get("jwt_token")
+        response = self._session.get(url, timeout=self.timeout, **kwargs)
+        if response.status_code == 401:
+            self._reauthenticate(cookie)
+            response = self._session.get(url, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
     @property
     def import_options(self) -> dict:
         """Get the current import configuration options.
@@ -81,6 +159,7 @@ class ImageImporter:
             "create_studies": self.create_studies,
             "create_series": self.create_series,
             "include_stack_trace": self.include_stack_trace,
+            "on_duplicate": self.on_duplicate,
         }
 
     def import_image(self, image_payload: dict) -> dict:
@@ -96,6 +175,79 @@ class ImageImporter:
             requests.exceptions.HTTPError: If import request fails
         """
         payload = {"data": image_payload, "options": self.import_options}
-        response = self._session.post(self.image_endpoint, json=payload)
-        response.raise_for_status()
+        response = self._post(self.image_endpoint, json=payload)
         return response.json()
+
+    def _import_image_safe(self, image_payload: dict) -> dict:
+        try:
+            return self.import_image(image_payload)
+        except Exception as e:
+            return {"success": False, "message": "Request failed", "error": str(e)}
+
+    def import_images(self, image_payloads: Iterable[dict]) -> List[dict]:
+        """Import many images concurrently using max_workers parallel requests.
+
+        Failed requests do not stop the import; their response contains success=False.
+
+        Args:
+            image_payloads (Iterable[dict]): Image payloads as accepted by import_image
+
+        Returns:
+            List[dict]: Responses in the same order as image_payloads
+        """
+        image_payloads = list(image_payloads)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(self._import_image_safe, image_payloads)
+            return list(tqdm(results, total=len(image_payloads)))
+
+    def import_batch(
+        self,
+        image_payloads: Iterable[dict],
+        batch_size: int = 500,
+        wait: bool = True,
+        poll_interval: float = 5.0,
+    ) -> List[dict]:
+        """Import many images using the batch import endpoint.
+
+        The payloads are sent in chunks of batch_size images, each of which is imported
+        by the platform in a background job.
+
+        Args:
+            image_payloads (Iterable[dict]): Image payloads as accepted by import_image
+            batch_size (int, optional): Number of images per request. Defaults to 500.
+            wait (bool, optional): Wait until all jobs have finished. Defaults to True.
+            poll_interval (float, optional): Seconds between status checks when waiting. Defaults to 5.
+
+        Returns:
+            List[dict]: Status of each job (see GET /import/batch/{job_id})
+        """
+        image_payloads = list(image_payloads)
+        jobs = []
+        for i in range(0, len(image_payloads), batch_size):
+            payload = {
+                "data": image_payloads[i : i + batch_size],
+                "options": self.import_options,
+            }
+            jobs.append(self._post(self.batch_endpoint, json=payload).json())
+
+        if not wait:
+            return jobs
+
+        pending = {job["job_id"] for job in jobs}
+        statuses = {job["job_id"]: job for job in jobs}
+        with tqdm(total=len(image_payloads)) as progress:
+            while pending:
+                time.sleep(poll_interval)
+                for job_id in list(pending):
+                    status = self.get_batch_status(job_id)
+                    statuses[job_id] = status
+                    if status["status"] in ("completed", "failed"):
+                        pending.remove(job_id)
+                progress.n = sum(s.get("processed", 0) for s in statuses.values())
+                progress.refresh()
+
+        return [statuses[job["job_id"]] for job in jobs]
+
+    def get_batch_status(self, job_id: str) -> dict:
+        """Get the status of a batch import job."""
+        return self._get(f"{self.batch_endpoint}/{job_id}").json()
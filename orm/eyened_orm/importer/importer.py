@@ -1,8 +1,11 @@
 import datetime
 import secrets    
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
 
 import pandas as pd
 from sqlalchemy import inspect
@@ -14,10 +17,14 @@ from eyened_orm import (
     Series,
     Study,
 )
+from eyened_orm.image_instance import file_checksum
 from eyened_orm.importer.thumbnails import update_thumbnails
 from eyened_orm.utils.config import EyenedORMConfig
 
 
+DUPLICATE_POLICIES = ("allow", "skip", "link", "flag")
+
+
 class Importer:
     def __init__(
         self,
@@ -28,8 +35,9 @@ class Importer:
         create_series: bool = True,
         create_projects: bool = False,
         run_ai_models: bool = False,
-        generate_thumbnails: bool = True
-        
+        generate_thumbnails: bool = True,
+        on_duplicate: str = "allow",
+        checksum_workers: int = 8,
     ):
         """
         Initialize the Importer with database session and data to import.
@@ -52,8 +60,22 @@ class Importer:
             If True, run AI models on the images after import
         generate_thumbnails : bool, default=True
             If True, generate thumbnails for the images after import
-       
+        on_duplicate : str, default="allow"
+            What to do with images whose file checksum matches an existing image
+            (or an earlier image in the same import):
+            - "allow": import the image anyway
+            - "skip": do not import the image
+            - "link": do not import the image, the existing ImageInstance is attached to the
+              image entry in the data structure instead
+            - "flag": import the image and tag it as "Duplicate"
+            Duplicates are recorded in self.duplicates.
+        checksum_workers : int, default=8
+            Number of threads used to compute file checksums
         """
+        if on_duplicate not in DUPLICATE_POLICIES:
+            raise ValueError(
+                f"on_duplicate must be one of {DUPLICATE_POLICIES}, got '{on_duplicate}'"
+            )
         self.session = session
         self.config = config
         self.create_patients = create_patients
@@ -62,10 +84,13 @@ class Importer:
         self.create_projects = create_projects
         self.run_ai_models = run_ai_models
         self.generate_thumbnails = generate_thumbnails
+        self.on_duplicate = on_duplicate
+        self.checksum_workers = checksum_workers
+        self.duplicates = []
+        # objects created by the committed inserts (see import_stream)
+        self._inserted = []
 
 
-        
-
         assert self.config.images_basepath is not None, "images_basepath must be set when using the importer"
 
         
@@ -81,6 +106,8 @@ class Importer:
         self.studies = []
         self.series = []
         self.images = []
+        # (image entry, original ImageInstance or image entry) pairs found by _check_duplicates
+        self._pending_duplicates = []
 
     def init_objects(self, data: List[Dict]):
         """
@@ -136,6 +163,8 @@ class Importer:
             if "project_name" not in patient_item or not patient_item["project_name"]:
                 raise ValueError(f"project_name is required for patient at index {i}")
 
+        data = self._check_duplicates(data)
+
         # Process each patient
         for patient_item in data:
             # Find or create the project for this patient
@@ -217,6 +246,8 @@ class Importer:
         im.Series = series
 
         im.DatasetIdentifier = self.get_image_path(image_data)
+        if im.FileChecksum is None:
+            im.FileChecksum = image_data.get("checksum")
         image_data["instance"] = im
         return im
 
@@ -232,6 +263,13 @@ class Importer:
             if series is None:
                 warnings.warn(f"{string_repr} not found.")
 
+        series_uid = props.get("SeriesInstanceUid")
+        if series is None and series_uid is not None:
+            # e.g. a DICOM series split over import batches, or a re-imported folder
+            series = study.get_series_by_uid(series_uid)
+            if series is not None:
+                return series
+
         if series is None:
             if not self.create_series:
                 raise RuntimeError(
@@ -250,7 +288,7 @@ class Importer:
         return series
 
     def find_or_create_study(self, patient, study_item):
-        default_study_date = self.config.default_study_date or datetime.date(1970,1,1)
+        default_study_date = study_item.get("study_date") or self.config.default_study_date or datetime.date(1970,1,1)
         props = study_item.get("props", {})
 
         # Convert string date to datetime.date if necessary
@@ -288,7 +326,116 @@ class Importer:
 
         return study
 
-    
+    def _calc_checksums(self, image_items: List[Dict]) -> List[Optional[bytes]]:
+        """
+        Compute the file checksum for each image item, reading the files in a thread pool.
+        Returns None for files that cannot be read.
+        """
+        basepath = Path(self.config.images_basepath)
+
+        def calc(image_item):
+            try:
+                return file_checksum(basepath / self.get_image_path(image_item))
+            except (OSError, AssertionError, NotImplementedError):
+                return None
+
+        if self.checksum_workers <= 1:
+            return [calc(item) for item in image_items]
+        with ThreadPoolExecutor(max_workers=self.checksum_workers) as executor:
+            return list(executor.map(calc, image_items))
+
+    def _check_duplicates(self, data: List[Dict]) -> List[Dict]:
+        """
+        Compute the file checksums of all images in data and look up existing images with
+        the same checksum in a single query.
+
+        Checksums are stored on the image entries (and later on the ImageInstance). When
+        on_duplicate is "skip" or "link", duplicate images are removed from (a copy of) data,
+        together with any series, study and patient that no longer contain images.
+        """
+        image_items = [
+            image_item
+            for patient_item in data
+            for study_item in patient_item.get("studies", [])
+            for series_item in study_item.get("series", [])
+            for image_item in series_item.get("images", [])
+        ]
+        if not image_items:
+            return data
+
+        for image_item, checksum in zip(image_items, self._calc_checksums(image_items)):
+            image_item["checksum"] = checksum
+
+        existing = {
+            im.FileChecksum: im
+            for im in ImageInstance.by_file_checksums(
+                self.session, [item["checksum"] for item in image_items]
+            )
+        }
+
+        # first occurrence within this import, for duplicates within the data itself
+        seen = {}
+        for image_item in image_items:
+            checksum = image_item["checksum"]
+            if checksum is None:
+                continue
+            duplicate_of = existing.get(checksum, seen.get(checksum))
+            if duplicate_of is None:
+                seen[checksum] = image_item
+            else:
+                self._pending_duplicates.append((image_item, duplicate_of))
+
+        if self.on_duplicate not in ("skip", "link") or not self._pending_duplicates:
+            return data
+
+        skipped = {id(image_item) for image_item, _ in self._pending_duplicates}
+        pruned = []
+        for patient_item in data:
+            studies = []
+            for study_item in patient_item.get("studies", []):
+                series = []
+                for series_item in study_item.get("series", []):
+                    images = series_item.get("images", [])
+                    kept = [item for item in images if id(item) not in skipped]
+                    if kept or not images:
+                        series.append({**series_item, "images": kept})
+                if series or not study_item.get("series"):
+                    studies.append({**study_item, "series": series})
+            if studies or not patient_item.get("studies"):
+                pruned.append({**patient_item, "studies": studies})
+        return pruned
+
+    def _resolve_duplicates(self) -> List[Dict]:
+        """
+        Called after flush, in the transaction of the import: attach the original ImageInstance
+        to each duplicate image entry (as "duplicate_of", and as "instance" when
+        on_duplicate="link") and tag flagged duplicates. Returns the records for self.duplicates.
+        """
+        records = []
+        for image_item, duplicate_of in self._pending_duplicates:
+            if not isinstance(duplicate_of, ImageInstance):
+                # duplicate of an image earlier in the same import
+                duplicate_of = duplicate_of["instance"]
+            image_item["duplicate_of"] = duplicate_of
+            if self.on_duplicate == "link":
+                image_item["instance"] = duplicate_of
+            elif self.on_duplicate == "flag":
+                image_item["instance"].make_tag(
+                    "Duplicate",
+                    creator_name="Importer",
+                    comment=f"Same file as ImageInstance {duplicate_of.ImageInstanceID}",
+                    tag_description="The image file is identical to that of another image instance",
+                )
+
+            records.append(
+                {
+                    "image": image_item.get("image"),
+                    "duplicate_of": duplicate_of.ImageInstanceID,
+                    "action": self.on_duplicate,
+                }
+            )
+        self._pending_duplicates = []
+        return records
 
     def get_image_path(self, image_data):
         """
@@ -324,10 +471,39 @@ class Importer:
             self.update_thumbnails()
 
         if self.run_ai_models:
-            # Run AI models on the images
-            from eyened_orm.inference.inference import run_inference
+            self._run_ai_models()
+
+    def _run_ai_models(self):
+        # Run AI models on the images
+        from eyened_orm.inference.inference import run_inference
 
-            run_inference(self.session, device=None, cfi_cache_path=self.config.cfi_cache_path)
+        run_inference(self.session, device=None, cfi_cache_path=self.config.cfi_cache_path)
+
+    def _insert(self, data: List[Dict]) -> List[ImageInstance]:
+        """
+        Create the objects for data and commit them in a single transaction.
+        On failure the transaction is rolled back and a RuntimeError is raised.
+        """
+        self.init_objects(data)
+        items = [*self.projects, *self.patients, *self.studies, *self.series, *self.images]
+        created = [item for item in items if inspect(item).transient]
+        # Add all created / updated objects to the session
+        for item in items:
+            self.session.add(item)
+
+        try:
+            # flushed first, so duplicates can be tagged in the same transaction
+            self.session.flush()
+            duplicates = self._resolve_duplicates()
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            raise RuntimeError(
+                "Failed to commit the transaction. Nothing will be written to the database and no files have been created or changed"
+            ) from e
+        self.duplicates.extend(duplicates)
+        self._inserted.extend(created)
+        return list(self.images)
 
     def _import(self, data: List[Dict]):
         """
@@ -369,22 +545,10 @@ class Importer:
             The image instances created during the import
         """
 
-        self.init_objects(data)
-        # Add all created / updated objects to the session
-        for item in [*self.projects, *self.patients, *self.studies, *self.series, *self.images]:
-            self.session.add(item)
-
-        try:
-            self.session.commit()
-        except Exception as e:
-            self.session.rollback()
-            raise RuntimeError(
-                "Failed to commit the transaction. Nothing will be written to the database and no files have been created or changed"
-            ) from e
-
+        images = self._insert(data)
         self.post_insert()
         # Save created images to return before clearing collections
-        return list(self.images)
+        return images
     
     def _summary(self, data: List[Dict]) -> Dict:
         with self.session.begin_nested():
@@ -436,7 +600,8 @@ class Importer:
             summary = {
                 "projects": project_names,
                 "general_stats": general_stats,
-                "column_stats": column_stats
+                "column_stats": column_stats,
+                "duplicates": len(self._pending_duplicates),
             }
 
             # Print summary as before
@@ -449,6 +614,11 @@ class Importer:
             df_stats['New_Percentage'] = df_stats['New_Percentage'].apply(lambda x: f"{x:.1f}%")
             df_stats['Existing_Percentage'] = df_stats['Existing_Percentage'].apply(lambda x: f"{x:.1f}%")
             print(df_stats.to_string(index=False))
+            if self._pending_duplicates:
+                print(
+                    f"\n{len(self._pending_duplicates)} images are duplicates of existing images "
+                    f"(on_duplicate='{self.on_duplicate}')"
+                )
 
             print('\n-----------  Column Population Statistics  -----------')
             print('- only for new entities')
@@ -485,6 +655,7 @@ class Importer:
             If summary=False: The image instances created during the import
             If summary=True: A dictionary containing import statistics
         """
+        self.duplicates = []
         try:
             if summary:
                 return self._summary(data)
@@ -548,6 +719,158 @@ class Importer:
         # Call the appropriate method based on the summary flag
         return self.import_many(structured_data, summary=summary)
 
+    def _import_batch(self, batch: List[tuple], failed: List[Dict]) -> List[ImageInstance]:
+        """
+        Import a batch of (row_index, row) tuples in a single transaction.
+        If the transaction fails, the rows are retried one by one so that a single
+        bad row only fails itself. Failed rows are appended to failed.
+        """
+        from eyened_orm.importer.manifest import group_rows
+
+        try:
+            return self._insert(group_rows(row for _, row in batch))
+        except Exception:
+            self.session.rollback()
+
+        images = []
+        for row_index, row in batch:
+            try:
+                images.extend(self._insert(group_rows([row])))
+            except Exception as e:
+                self.session.rollback()
+                cause = e.__cause__ if e.__cause__ is not None else e
+                failed.append({"row": row_index, "image": row.get("image"), "error": str(cause)})
+        return images
+
+    def import_stream(
+        self,
+        rows: Iterable[Dict],
+        batch_size: int = 500,
+        checkpoint_path: Optional[Union[str, Path]] = None,
+        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Import flat image rows incrementally, committing every batch_size rows.
+
+        Each batch is committed in its own transaction and thumbnails are generated per batch.
+        AI models (if enabled) run once after all batches are imported.
+        After each batch a checkpoint is written with the index of the last processed row,
+        so that a failed or interrupted import can be resumed by calling this method again
+        with the same rows and checkpoint_path.
+
+        Parameters:
+        -----------
+        rows : Iterable[Dict]
+            Flat image dictionaries with the structure documented in import_one.
+            Can be a generator (e.g. read_manifest) so the input is never fully materialized.
+        batch_size : int, default=500
+            Number of rows to commit per transaction
+        checkpoint_path : str | Path, optional
+            Path to a JSON checkpoint file. If it exists, rows up to the recorded
+            last_row are skipped.
+        progress_callback : callable, optional
+            Called after every batch with the import statistics so far
+
+        Returns:
+        --------
+        Dict
+            Import statistics: rows, imported, duplicates, failed (list of failed rows), elapsed
+            and images_per_second. The duplicates themselves are recorded in self.duplicates.
+        """
+        from eyened_orm.importer.manifest import load_checkpoint, save_checkpoint
+
+        checkpoint = load_checkpoint(checkpoint_path)
+        start_row = checkpoint["last_row"] + 1
+        if start_row > 0:
+            print(
+                f"Resuming import at row {start_row} "
+                f"({checkpoint['imported']} images imported previously)"
+            )
+
+        self.duplicates = []
+        numbered_rows = islice(enumerate(rows), start_row, None)
+        n_rows = 0
+        n_imported = 0
+        n_failed = len(checkpoint["failed"])
+        t_start = time.perf_counter()
+
+        def get_stats():
+            elapsed = time.perf_counter() - t_start
+            return {
+                "rows": n_rows,
+                "imported": n_imported,
+                "duplicates": len(self.duplicates),
+                "failed": checkpoint["failed"],
+                "elapsed": elapsed,
+                "images_per_second": n_imported / elapsed if elapsed > 0 else 0.0,
+            }
+
+        try:
+            while True:
+                batch = list(islice(numbered_rows, batch_size))
+                if not batch:
+                    break
+
+                t_batch = time.perf_counter()
+                images = self._import_batch(batch, checkpoint["failed"])
+                if self.generate_thumbnails and images:
+                    update_thumbnails(self.session, images)
+
+                n_rows += len(batch)
+                n_imported += len(images)
+                checkpoint["last_row"] = batch[-1][0]
+                checkpoint["imported"] += len(images)
+                save_checkpoint(checkpoint_path, checkpoint)
+
+                batch_failed = len(checkpoint["failed"]) - n_failed
+                n_failed = len(checkpoint["failed"])
+                stats = get_stats()
+                print(
+                    f"Rows {batch[0][0]}-{batch[-1][0]}: {len(images)} imported, {batch_failed} failed "
+                    f"in {time.perf_counter() - t_batch:.1f}s "
+                    f"(total {n_imported} images, {stats['images_per_second']:.1f} images/s)"
+                )
+                if progress_callback is not None:
+                    progress_callback(stats)
+
+                # release the objects created by this batch, keeping memory flat; other objects
+                # in the session (e.g. of the caller) stay attached
+                self._clear_collections()
+                self._expunge_inserted()
+        finally:
+            self._clear_collections()
+            self._inserted = []
+
+        if self.run_ai_models and n_imported:
+            self._run_ai_models()
+
+        return get_stats()
+
+    def _expunge_inserted(self):
+        for item in self._inserted:
+            if item in self.session:
+                self.session.expunge(item)
+        self._inserted = []
+
+    def import_manifest(
+        self,
+        manifest_path: Union[str, Path],
+        batch_size: int = 500,
+        checkpoint_path: Optional[Union[str, Path]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Stream a CSV or JSONL manifest into the database (see import_stream).
+
+        The manifest is read row by row, see eyened_orm.importer.manifest for the format.
+        """
+        from eyened_orm.importer.manifest import read_manifest
+
+        return self.import_stream(
+            read_manifest(manifest_path),
+            batch_size=batch_size,
+            checkpoint_path=checkpoint_path,
+        )
+
     def _get_populated_fields_stats(self, model_class, instances):
         """
         Return a dictionary of populated fields statistics for a list of model instances.
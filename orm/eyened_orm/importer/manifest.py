@@ -0,0 +1,157 @@
+"""
+Helpers for streaming imports from manifest files.
+
+A manifest contains one image per row, using the same flat structure as
+Importer.import_one:
+
+    project_name, patient_identifier, patient_props, study_date, study_props,
+    series_id, series_props, image, image_props
+
+JSONL manifests contain one such dictionary per line.
+CSV manifests use the same keys as column names. The *_props columns may contain a JSON
+object. Any other column is added to image_props (empty cells are skipped).
+"""
+
+import csv
+import datetime
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+_FLAT_KEYS = (
+    "project_name",
+    "patient_identifier",
+    "study_date",
+    "series_id",
+    "image",
+)
+_PROPS_KEYS = ("patient_props", "study_props", "series_props", "image_props")
+
+
+def _parse_csv_row(row: Dict[str, str]) -> Dict[str, Any]:
+    item = {k: row.get(k) or None for k in _FLAT_KEYS}
+    for key in _PROPS_KEYS:
+        value = row.get(key)
+        item[key] = json.loads(value) if value else {}
+
+    # remaining columns are image properties
+    for key, value in row.items():
+        if key in _FLAT_KEYS or key in _PROPS_KEYS:
+            continue
+        if value is None or value == "":
+            continue
+        item["image_props"][key] = value
+    return item
+
+
+def read_manifest(path: str | Path) -> Iterator[Dict[str, Any]]:
+    """
+    Read a CSV or JSONL manifest one row at a time.
+
+    Parameters:
+    -----------
+    path : str | Path
+        Path to a .csv or .jsonl file
+
+    Yields:
+    -------
+    Dict
+        Flat image dictionaries (see Importer.import_one)
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == ".csv":
+        with open(path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                yield _parse_csv_row(row)
+    elif suffix in (".jsonl", ".ndjson"):
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    else:
+        raise ValueError(f"Unsupported manifest format: {path} (expected .csv or .jsonl)")
+
+
+def _parse_study_date(value):
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def group_rows(rows: Iterable[Dict[str, Any]]) -> List[Dict]:
+    """
+    Convert flat image rows into the nested structure expected by Importer.import_many.
+
+    Rows referring to the same project/patient/study/series are merged, so that new
+    objects are created only once per batch. Rows without a patient_identifier are not
+    merged: each one is a new patient (with a random identifier, see Importer).
+    """
+    patients: Dict[Tuple, Dict] = {}
+    studies: Dict[Tuple, Dict] = {}
+    series: Dict[Tuple, Dict] = {}
+
+    for index, row in enumerate(rows):
+        if not row.get("project_name"):
+            raise ValueError("project_name is required for each manifest row")
+
+        study_date = _parse_study_date(row.get("study_date"))
+        patient_identifier = row.get("patient_identifier")
+        patient_key = (
+            row["project_name"],
+            patient_identifier,
+            index if patient_identifier is None else None,
+        )
+        study_key = (*patient_key, study_date)
+        # rows without a series_id are grouped by their SeriesInstanceUid (if any)
+        series_uid = (row.get("series_props") or {}).get("SeriesInstanceUid")
+        series_key = (*study_key, row.get("series_id"), series_uid)
+
+        if patient_key not in patients:
+            patients[patient_key] = {
+                "project_name": row["project_name"],
+                "patient_identifier": patient_identifier,
+                "props": row.get("patient_props") or {},
+                "studies": [],
+            }
+        if study_key not in studies:
+            studies[study_key] = {
+                "study_date": study_date,
+                "props": row.get("study_props") or {},
+                "series": [],
+            }
+            patients[patient_key]["studies"].append(studies[study_key])
+        if series_key not in series:
+            series[series_key] = {
+                "series_id": row.get("series_id"),
+                "props": row.get("series_props") or {},
+                "images": [],
+            }
+            studies[study_key]["series"].append(series[series_key])
+
+        series[series_key]["images"].append(
+            {"image": row.get("image"), "props": row.get("image_props") or {}}
+        )
+
+    return list(patients.values())
+
+
+def load_checkpoint(path: Optional[str | Path]) -> Dict[str, Any]:
+    """Load a checkpoint file, returning an empty checkpoint if it does not exist."""
+    if path is None or not Path(path).exists():
+        return {"last_row": -1, "imported": 0, "failed": []}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: Optional[str | Path], checkpoint: Dict[str, Any]) -> None:
+    """Atomically write the checkpoint file (no-op if path is None)."""
+    if path is None:
+        return
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, default=str)
+    os.replace(tmp_path, path)
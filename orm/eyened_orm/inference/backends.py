@@ -0,0 +1,161 @@
+"""
+CPU inference backends for the ensembles.
+
+The ensembles wrap a TorchScript module (ensemble.ensemble) that maps an NCHW batch to the
+outputs of all models; the ensemble classes add sliding window / tta logic around it.
+A backend replaces this inner module, so the ensemble code is used unchanged:
+
+- torch: the TorchScript module (default)
+- onnx: the module exported to ONNX and run with ONNX Runtime
+- onnx-int8: as onnx, with dynamically quantized (int8) weights
+
+Exported models are cached in onnx_cache_path (default: ~/.cache/eyened/onnx), keyed by the
+model version, so the export only happens once per model version.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def default_onnx_cache_path() -> Path:
+    return Path(
+        os.environ.get("EYENED_ONNX_CACHE", Path.home() / ".cache" / "eyened" / "onnx")
+    )
+
+
+def set_num_threads(num_threads: Optional[int]):
+    """Set the number of threads used by torch on CPU (intra op)."""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def input_channels(module: torch.nn.Module) -> int:
+    """Number of input channels of a (convolutional) module: the first 4d weight is the first conv."""
+    for param in module.parameters():
+        if param.dim() == 4:
+            return param.shape[1]
+    raise ValueError("Could not determine the number of input channels")
+
+
+def export_onnx(module: torch.nn.Module, path: Path, in_channels: int, size: int):
+    """Export module to ONNX, with dynamic batch size, height and width."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    dummy = torch.zeros(1, in_channels, size, size)
+    tmp_path = path.with_suffix(".tmp")
+    torch.onnx.export(
+        module,
+        dummy,
+        str(tmp_path),
+        input_names=["image"],
+        output_names=["output"],
+        dynamic_axes={"image": {0: "batch", 2: "height", 3: "width"}},
+        opset_version=17,
+    )
+    # rename when complete, so an interrupted export is never used
+    tmp_path.replace(path)
+
+
+def quantize_onnx(path: Path, quantized_path: Path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp_path = quantized_path.with_suffix(".tmp")
+    quantize_dynamic(str(path), str(tmp_path), weight_type=QuantType.QUInt8)
+    tmp_path.replace(quantized_path)
+
+
+class OnnxModule(torch.nn.Module):
+    """Drop-in replacement for the TorchScript module of an ensemble, running on ONNX Runtime (CPU)."""
+
+    def __init__(self, path: Path, num_threads: Optional[int] = None):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self.path = Path(path)
+        self.session = ort.InferenceSession(
+            str(path), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = np.ascontiguousarray(x.detach().float().cpu().numpy())
+        (output,) = self.session.run(None, {self.input_name: x})
+        return torch.from_numpy(output)
+
+
+def onnx_path(onnx_cache_path: Path, name: str, version: str, backend: str) -> Path:
+    key = hashlib.sha1(version.encode()).hexdigest()[:16]
+    suffix = ".int8.onnx" if backend == "onnx-int8" else ".onnx"
+    return Path(onnx_cache_path) / f"{name}-{key}{suffix}"
+
+
+def convert_ensemble(
+    ensemble,
+    backend: str,
+    name: str,
+    version: str,
+    onnx_cache_path: Optional[Path] = None,
+    num_threads: Optional[int] = None,
+):
+    """
+    Replace the inner module of ensemble by the given backend (in place), returns the ensemble.
+
+    The outputs of the converted module are compared to those of the TorchScript module on a
+    test input, and the maximum difference is printed.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}, options: {', '.join(BACKENDS)}")
+    if backend == "torch":
+        return ensemble
+    if onnx_cache_path is None:
+        onnx_cache_path = default_onnx_cache_path()
+
+    module = ensemble.ensemble
+    in_channels = input_channels(module)
+    test_cfg = ensemble.config["datamodule"].get("test_transform", {})
+    size = test_cfg.get("resize") or test_cfg.get("square_size", 1024)
+
+    path = onnx_path(onnx_cache_path, name, version, "onnx")
+    if not path.exists():
+        print(f"Exporting model {name} ({version}) to {path}")
+        export_onnx(module, path, in_channels, size)
+    if backend == "onnx-int8":
+        quantized_path = onnx_path(onnx_cache_path, name, version, backend)
+        if not quantized_path.exists():
+            print(f"Quantizing model {name} ({version}) to {quantized_path}")
+            quantize_onnx(path, quantized_path)
+        path = quantized_path
+
+    converted = OnnxModule(path, num_threads=num_threads)
+    difference = check_parity(module, converted, in_channels, size)
+    print(f"Model {name} on {backend}: max abs difference with torch {difference:.2e}")
+    ensemble.ensemble = converted
+    return ensemble
+
+
+def check_parity(
+    reference: torch.nn.Module, candidate: torch.nn.Module, in_channels: int, size: int
+) -> float:
+    """Maximum absolute difference between the outputs of reference and candidate on a test input."""
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(1, in_channels, size, size, generator=generator)
+    with torch.no_grad():
+        expected = reference(x).float().cpu()
+        actual = candidate(x).float().cpu()
+    if expected.shape != actual.shape:
+        raise ValueError(
+            f"Output shape {tuple(actual.shape)} differs from torch {tuple(expected.shape)}"
+        )
+    return (expected - actual).abs().max().item()
@@ -0,0 +1,110 @@
+"""
+Throughput benchmark of the inference backends on CPU.
+
+A sample of ColorFundus images is preprocessed once (in memory). Then run_models is timed for
+every backend and batch size, and the outputs are compared to those of the torch backend:
+the distance between the keypoints (in pixels of the preprocessed image) and the difference
+between the quality logits.
+"""
+
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import torch
+from sqlalchemy import select
+
+from eyened_orm import ImageInstance, Modality
+from .backends import BACKENDS
+from .inference import run_models
+from .pipeline import iter_preprocessed_batches
+from .registry import ModelRegistry
+
+def load_benchmark_images(session, n_images: int = 64, n_jobs: int = 8):
+    """Return ids and preprocessed (rgb, ce) arrays of the n_images most recent ColorFundus images."""
+    rows = session.execute(
+        select(ImageInstance.ImageInstanceID, ImageInstance.DatasetIdentifier)
+        .where(
+            ImageInstance.Modality == Modality.ColorFundus,
+            ImageInstance.Inactive == False,
+        )
+        .order_by(ImageInstance.ImageInstanceID.desc())
+        .limit(n_images)
+    ).all()
+    images_basepath = Path(session.config.images_basepath)
+    ids, inputs = [], []
+    for batch in iter_preprocessed_batches(
+        [row.ImageInstanceID for row in rows],
+        [images_basepath / row.DatasetIdentifier for row in rows],
+        n_jobs=n_jobs,
+    ):
+        for item in batch:
+            if item["success"]:
+                ids.append(item["id"])
+                inputs.append((item["rgb"], item["ce"]))
+    return ids, inputs
+
+
+def compare_outputs(reference: pd.DataFrame, df: pd.DataFrame) -> Dict[str, float]:
+    """Maximum differences between the outputs of run_models and the reference outputs."""
+    df = df.loc[reference.index]
+    result = {}
+    for name, (x, y) in {
+        "fovea": ("x_fovea", "y_fovea"),
+        "disc": ("x_disc", "y_disc"),
+    }.items():
+        distance = np.hypot(df[x] - reference[x], df[y] - reference[y])
+        result[f"max_{name}_px"] = float(distance.max())
+    quality = ["q1", "q2", "q3"]
+    result["max_quality_diff"] = float((df[quality] - reference[quality]).abs().max().max())
+    return result
+
+
+def benchmark_backends(
+    ids: List[int],
+    inputs: List,
+    backends: Sequence[str] = BACKENDS,
+    batch_sizes: Sequence[int] = (1, 4, 8, 16),
+    num_threads: Optional[int] = None,
+    onnx_cache_path: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Time run_models on CPU for every backend and batch size.
+
+    Returns a DataFrame with images_per_second and the differences with the torch outputs.
+    """
+    device = torch.device("cpu")
+    results = []
+    reference = None
+    for backend in ["torch", *[b for b in backends if b != "torch"]]:
+        registry = ModelRegistry(
+            device=device,
+            backend=backend,
+            num_threads=num_threads,
+            onnx_cache_path=onnx_cache_path,
+        )
+        # warm up (loads / exports the models)
+        run_models(inputs[:1], ids[:1], registry=registry, progress=False)
+
+        for batch_size in batch_sizes:
+            t_start = time.perf_counter()
+            df = run_models(
+                inputs, ids, registry=registry, batch_size=batch_size, progress=False
+            )
+            elapsed = time.perf_counter() - t_start
+            if reference is None:
+                reference = df
+            result = {
+                "backend": backend,
+                "batch_size": batch_size,
+                "images_per_second": len(df) / elapsed,
+                **compare_outputs(reference, df),
+            }
+            print(
+                f"{backend} (batch size {batch_size}): {result['images_per_second']:.2f} images/s"
+            )
+            if backend in backends:
+                results.append(result)
+    return pd.DataFrame(results)
@@ -0,0 +1,126 @@
+"""
+Reuse of inference results for images with identical pixel data (InferenceCache).
+
+The cache stores the raw outputs of each step per ImageInstance.DataHash: the bounds found by
+preprocessing (model name "preprocessing") and the outputs of every model head (by registry
+name). Cached outputs go through the same postprocessing and database update as computed
+outputs. Entries are only used when all versions (fundusprep and the models) match.
+"""
+
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import pandas as pd
+from sqlalchemy import select
+
+from eyened_orm import ImageInstance
+
+PREPROCESSING = "preprocessing"
+
+
+def preprocessing_version() -> str:
+    try:
+        return f"retinalysis-fundusprep=={version('retinalysis-fundusprep')}"
+    except PackageNotFoundError:
+        return "retinalysis-fundusprep"
+
+
+def cache_versions(registry, heads: Sequence) -> Dict[str, str]:
+    """Version of every cached step, by model name."""
+    versions = {PREPROCESSING: preprocessing_version()}
+    for head in heads:
+        key = registry.models[head.name].key
+        # other backends give (slightly) different outputs
+        versions[head.name] = key if registry.backend == "torch" else f"{key}@{registry.backend}"
+    return versions
+
+
+def get_data_hashes(session, ids: Iterable[int]) -> Dict[int, bytes]:
+    """DataHash by ImageInstanceID, for the images that have one."""
+    ids = list(ids)
+    if not ids:
+        return {}
+    rows = session.execute(
+        select(ImageInstance.ImageInstanceID, ImageInstance.DataHash).where(
+            ImageInstance.ImageInstanceID.in_(ids), ImageInstance.DataHash != None
+        )
+    )
+    return {image_id: data_hash for image_id, data_hash in rows}
+
+
+def to_cache_results(
+    df_bounds: pd.DataFrame,
+    df_model_outputs: pd.DataFrame,
+    data_hashes: Dict[int, bytes],
+    heads: Sequence,
+) -> Dict[bytes, Dict[str, Any]]:
+    """Cache entries ({DataHash: {ModelName: Result}}) for the computed images in data_hashes."""
+    results = {}
+    for image_id, data_hash in data_hashes.items():
+        if image_id not in df_bounds.index:
+            continue
+        success = bool(df_bounds.at[image_id, "success"])
+        if success and image_id not in df_model_outputs.index:
+            # the image could not be read by the models, retry next time
+            continue
+        result = {
+            PREPROCESSING: {
+                "success": success,
+                "bounds": df_bounds.at[image_id, "bounds"] if success else {},
+            }
+        }
+        for head in heads:
+            result[head.name] = (
+                {
+                    column: float(df_model_outputs.at[image_id, column])
+                    for column in head.columns
+                }
+                if success
+                else None
+            )
+        results[data_hash] = result
+    return results
+
+
+def from_cache_result(
+    image_id: int, result: Dict[str, Any], heads: Sequence
+) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """Rows of the bounds and model outputs frames for a cached result (outputs None if unsuccessful)."""
+    preprocessing = result[PREPROCESSING]
+    bounds = {
+        "id": image_id,
+        "success": preprocessing["success"],
+        "bounds": preprocessing["bounds"],
+    }
+    if not preprocessing["success"]:
+        return bounds, None
+    outputs = {"id": image_id}
+    for head in heads:
+        outputs.update(result[head.name])
+    return bounds, outputs
+
+
+def split_cached(
+    ids: List[int],
+    paths: List,
+    data_hashes: Dict[int, bytes],
+    cached: Dict[bytes, Dict[str, Any]],
+) -> Tuple[List[int], List, Dict[int, bytes]]:
+    """
+    Split the images into images to compute (ids, paths) and images whose result is reused
+    ({id: DataHash}): cached results, and images with the same pixel data as an image that is
+    computed in this run.
+    """
+    run_ids, run_paths = [], []
+    reused = {}
+    computed_hashes = set()
+    for image_id, path in zip(ids, paths):
+        data_hash = data_hashes.get(image_id)
+        if data_hash is not None and (data_hash in cached or data_hash in computed_hashes):
+            reused[image_id] = data_hash
+            continue
+        if data_hash is not None:
+            computed_hashes.add(data_hash)
+        run_ids.append(image_id)
+        run_paths.append(path)
+    return run_ids, run_paths, reused
@@ -1,171 +1,304 @@
+import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 import torch
-from rtnls_inference.ensembles import HeatmapRegressionEnsemble
-from rtnls_inference.ensembles.ensemble_classification import ClassificationEnsemble
-from rtnls_inference.ensembles.ensemble_keypoints import KeypointsEnsemble
-from rtnls_inference.utils import decollate_batch, extract_keypoints_from_heatmaps
-from sqlalchemy import select
+from rtnls_inference.datasets.fundus import FundusTestDataset
+from rtnls_inference.transforms import FundusTestTransform
+from rtnls_inference.utils import collate_except_metadata, extract_keypoints_from_heatmaps
+from sqlalchemy import func, select
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from eyened_orm import ImageInstance, Modality
-from .utils import auto_device
-
-
-def run_basic_models(fpaths, ids, device: torch.device = None):
-    if device is None:
-        device = auto_device()
-    ensemble_fovea = HeatmapRegressionEnsemble.from_huggingface(
-        "Eyened/vascx:fovea/fovea_july24.pt"
-    ).to(device)
-    ensemble_discedge = HeatmapRegressionEnsemble.from_huggingface(
-        "Eyened/vascx:discedge/discedge_july24.pt"
-    ).to(device)
-
-    dataloader = ensemble_fovea._make_inference_dataloader(
-        fpaths,
+from eyened_orm.inference_cache import InferenceCache
+from .cache import (
+    cache_versions,
+    from_cache_result,
+    get_data_hashes,
+    split_cached,
+    to_cache_results,
+)
+from .pipeline import iter_preprocessed_batches
+from .queue import (
+    claim_pending_images,
+    pending_images_query,
+    record_failed_attempts,
+    release_images,
+)
+from .registry import ModelRegistry, get_registry
+
+
+SQUARE_SIZE = 1024
+
+
+class InMemoryFundusDataset(FundusTestDataset):
+    """FundusTestDataset that also accepts preprocessed images that are already in memory.
+
+    Each input is a path or an array (rgb), or a tuple of paths or arrays (rgb, ce).
+    """
+
+    def _open_image(self, idx):
+        images = self.image_paths[idx]
+        if isinstance(images, np.ndarray):
+            return images, None
+        if isinstance(images[0], np.ndarray):
+            if len(images) == 1:
+                return images[0], None
+            return images[0], images[1]
+        return super()._open_image(idx)
+
+
+def make_dataloader(inputs, ids, batch_size: int = 16, num_workers: int = 8):
+    """
+    Dataloader over preprocessed (SQUARE_SIZE) images, decoded once for all models.
+
+    Items contain the normalized rgb + ce image (6 channels). When inputs only contain the rgb
+    image, the contrast enhanced image is computed by the transform.
+    """
+    single_input = not isinstance(inputs[0], (tuple, list)) or len(inputs[0]) == 1
+    dataset = InMemoryFundusDataset(
+        images_paths=inputs,
         ids=ids,
-        num_workers=8,
-        preprocess=False,
-        batch_size=8,
+        transform=FundusTestTransform(
+            square_size=SQUARE_SIZE, preprocess=False, contrast_enhance=single_input
+        ),
+        ignore_exceptions=True,
+    )
+    # decoding arrays is cheap, workers would only add pickling overhead
+    in_memory = isinstance(
+        inputs[0][0] if isinstance(inputs[0], (tuple, list)) else inputs[0], np.ndarray
+    )
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=collate_except_metadata,
+        num_workers=0 if in_memory else num_workers,
     )
 
-    output_ids, outputs = [], []
-    with torch.no_grad():
-        for batch in tqdm(dataloader):
-            if len(batch) == 0:
-                continue
-
-            im = batch["image"].to(device)
-            # im_rgb = im[..., :3, :, :]  # only rgb part
-
-            # FOVEA DETECTION
-            with torch.autocast(device_type=device.type):
-                heatmap = ensemble_fovea.forward(im)
-
-            keypoints = extract_keypoints_from_heatmaps(heatmap)
-
-            kp_fovea = torch.mean(keypoints, dim=1)  # average over models
-
-            # DISCEDGE DETECTION
-            with torch.autocast(device_type=device.type):
-                heatmap = ensemble_discedge.forward(im)
-            keypoints = extract_keypoints_from_heatmaps(heatmap)
-
-            kp_discedge = torch.mean(keypoints, dim=1)  # average over models
 
-            # join keypoints
-            keypoints = torch.cat([kp_fovea, kp_discedge], dim=1)
+@dataclass(frozen=True)
+class ModelHead:
+    name: str  # name of the model in the registry
+    columns: Tuple[str, ...]  # output columns
+    # "rgb" or "rgb+ce", None: rgb+ce unless the test transform of the model disables contrast_enhance
+    inputs: Optional[str] = None
 
-            items = {"id": batch["id"], "keypoints": keypoints}
-            if "bounds" in batch:
-                items["bounds"] = batch["bounds"]
-            items = decollate_batch(items)
 
-            items = [dataloader.dataset.transform.undo_item(item) for item in items]
+DEFAULT_HEADS = (
+    ModelHead("fovea", ("x_fovea", "y_fovea"), "rgb+ce"),
+    ModelHead("discedge", ("x_disc", "y_disc"), "rgb+ce"),
+    ModelHead("quality", ("q1", "q2", "q3")),
+)
 
-            for item in items:
-                output_ids.append(item["id"])
-                outputs.append(
-                    [
-                        *item["keypoints"][0].tolist(),
-                        *item["keypoints"][1].tolist(),
-                    ]
-                )
-    return pd.DataFrame(
-        outputs,
-        index=output_ids,
-        columns=["x_fovea", "y_fovea", "x_disc", "y_disc"],
-    )
 
+def _run_head(head: ModelHead, kind: str, ensemble, im: torch.Tensor, device) -> np.ndarray:
+    """Run one model on a batch of rgb + ce images, returns an array of shape (N, len(head.columns))."""
+    test_cfg = ensemble.config["datamodule"].get("test_transform", {})
+    inputs = head.inputs or ("rgb+ce" if test_cfg.get("contrast_enhance", True) else "rgb")
+    if inputs == "rgb":
+        im = im[:, :3]  # only rgb part
+    resize = test_cfg.get("resize") or test_cfg.get("square_size", SQUARE_SIZE)
+    if resize != im.shape[-1]:
+        im = torch.nn.functional.interpolate(
+            im, size=(resize, resize), mode="bilinear", align_corners=False
+        )
 
-def run_quality_model(fpaths, ids, device: torch.device = None):
-    if device is None:
-        device = auto_device()
-    ensemble_quality = ClassificationEnsemble.from_huggingface(
-        "Eyened/vascx:quality/quality.pt"
-    ).to(device)
-    dataloader = ensemble_quality._make_inference_dataloader(
-        fpaths,
-        ids=ids,
-        num_workers=8,
-        preprocess=False,
-        batch_size=16,
-    )
+    if kind == "heatmap":
+        with torch.autocast(device_type=device.type):
+            heatmap = ensemble.forward(im)
+        keypoints = extract_keypoints_from_heatmaps(heatmap)
+        keypoints = torch.mean(keypoints, dim=1)  # average over models
+        # coordinates in the preprocessed image, as FundusTestTransform.undo_item without
+        # preprocessing: (square_size / resize) * keypoints
+        keypoints = keypoints * (SQUARE_SIZE / resize)
+        return keypoints.reshape(len(keypoints), -1).float().cpu().numpy()
+    elif kind == "classification":
+        proba = ensemble.predict_step(im)
+        proba = torch.mean(proba, dim=0)  # average over models
+        return proba.float().cpu().numpy()
+    raise ValueError(f"Unknown model kind: {kind}")
+
+
+def run_models(
+    fpaths,
+    ids,
+    device: torch.device = None,
+    registry: ModelRegistry = None,
+    heads: Sequence[ModelHead] = DEFAULT_HEADS,
+    batch_size: int = 16,
+    num_workers: int = 8,
+    progress: bool = True,
+) -> pd.DataFrame:
+    """
+    Run the models of heads on preprocessed images in a single pass.
+
+    Each batch is read and decoded once and fed to every model (rgb or rgb + ce, see ModelHead).
+    fpaths are paths or arrays, either single (rgb) or tuples (rgb, ce).
+    Returns one DataFrame indexed by id with the columns of all heads.
+    """
+    if registry is None:
+        registry = get_registry(device)
+    device = registry.device
+    ensembles = [(head, registry.models[head.name].kind, registry.get(head.name)) for head in heads]
+
+    dataloader = make_dataloader(fpaths, ids, batch_size=batch_size, num_workers=num_workers)
 
     output_ids, outputs = [], []
     with torch.no_grad():
-        for batch in tqdm(dataloader):
+        for batch in tqdm(dataloader, disable=not progress):
             if len(batch) == 0:
                 continue
 
             im = batch["image"].to(device)
+            output_ids.extend(batch["id"])
+            outputs.append(
+                np.concatenate(
+                    [_run_head(head, kind, ensemble, im, device) for head, kind, ensemble in ensembles],
+                    axis=1,
+                )
+            )
 
-            # QUALITY
-            quality = ensemble_quality.predict_step(im)
-            quality = torch.mean(quality, dim=0)
-
-            items = {"id": batch["id"], "quality": quality}
-            items = decollate_batch(items)
+    columns = [column for head in heads for column in head.columns]
+    if not outputs:
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame(np.concatenate(outputs), index=output_ids, columns=columns)
 
-            for item in items:
-                output_ids.append(item["id"])
-                outputs.append(item["quality"].tolist())
 
-    return pd.DataFrame(
-        outputs,
-        index=output_ids,
-        columns=["q1", "q2", "q3"],
+def run_basic_models(
+    fpaths, ids, device: torch.device = None, registry: ModelRegistry = None, **kwargs
+):
+    return run_models(
+        fpaths, ids, device, registry, heads=DEFAULT_HEADS[:2], batch_size=8, **kwargs
     )
 
 
-def run_inference_for_images(
-    session, images, device: torch.device = None, cfi_cache_path=None
+def run_quality_model(
+    fpaths, ids, device: torch.device = None, registry: ModelRegistry = None, **kwargs
 ):
-    from rtnls_fundusprep.preprocessor import parallel_preprocess
+    return run_models(fpaths, ids, device, registry, heads=DEFAULT_HEADS[2:], **kwargs)
 
-    if device is None:
-        device = auto_device()
 
+def run_inference_for_images(
+    session,
+    images,
+    device: torch.device = None,
+    cfi_cache_path=None,
+    registry: ModelRegistry = None,
+):
     ids = [im.ImageInstanceID for im in images]
     paths = [im.path for im in images]
-
-    bounds = parallel_preprocess(
-        paths,  # List of image files
-        ids,
-        rgb_path=(
-            f'{cfi_cache_path}/rgb' if cfi_cache_path is not None else None
-        ),  # Output path for RGB images
-        ce_path=(
-            f'{cfi_cache_path}/ce' if cfi_cache_path is not None else None
-        ),  # Output path for Contrast Enhanced images
-        n_jobs=8,  # number of preprocessing workers
+    run_inference_for_paths(
+        session, ids, paths, device, cfi_cache_path=cfi_cache_path, registry=registry
     )
 
-    df_bounds = pd.DataFrame(bounds).set_index("id")
-
-    # Continue only with successfully preprocessed images
-    ids = df_bounds[
-        df_bounds["success"]
-    ].index.tolist()  # only run on successfully preprocessed images
 
-    if not ids:
-        print("No images to process")
+def run_inference_for_paths(
+    session,
+    ids,
+    paths,
+    device: torch.device = None,
+    cfi_cache_path=None,
+    registry: ModelRegistry = None,
+    batch_size: int = 32,
+    n_jobs: int = 8,
+    model_batch_size: int = 16,
+):
+    """
+    Preprocess and run the models on the images, and store the results.
+
+    Preprocessing runs in n_jobs worker processes and overlaps with running the models on
+    batches of batch_size images (model_batch_size images per forward pass). If cfi_cache_path
+    is None, the preprocessed images are kept in memory, otherwise they are written to
+    cfi_cache_path/rgb and cfi_cache_path/ce.
+
+    Images with the same pixel data (DataHash) as an image that was processed before with the
+    same model versions get the cached results (InferenceCache) and are not processed again.
+    """
+    if registry is None:
+        registry = get_registry(device)
+
+    # PNG files are decoded by dataloader workers
+    num_workers = 2
+
+    t_start = time.perf_counter()
+    # reuse the results of images with the same pixel data (DataHash)
+    data_hashes = get_data_hashes(session, ids)
+    versions = cache_versions(registry, DEFAULT_HEADS)
+    cached = InferenceCache.lookup(session, data_hashes.values(), versions)
+    run_ids, run_paths, reused = split_cached(ids, paths, data_hashes, cached)
+    if reused:
+        print(f"Reusing cached results for {len(reused)}/{len(ids)} images")
+
+    t_models = 0.0
+    bounds, model_outputs = [], []
+    batches = iter_preprocessed_batches(
+        run_ids, run_paths, batch_size=batch_size, cfi_cache_path=cfi_cache_path, n_jobs=n_jobs
+    )
+    with tqdm(total=len(run_ids)) as progress:
+        for batch in batches:
+            bounds.extend(
+                {"id": item["id"], "success": item["success"], "bounds": item["bounds"]}
+                for item in batch
+            )
+            successful = [item for item in batch if item["success"]]
+            if successful:
+                t_batch = time.perf_counter()
+                model_outputs.append(
+                    run_models(
+                        [(item["rgb"], item["ce"]) for item in successful],
+                        [item["id"] for item in successful],
+                        registry=registry,
+                        batch_size=model_batch_size,
+                        num_workers=num_workers,
+                        progress=False,
+                    )
+                )
+                t_models += time.perf_counter() - t_batch
+            progress.update(len(batch))
+    t_pipeline = time.perf_counter()
+
+    # store the computed results and add the reused results
+    columns = [column for head in DEFAULT_HEADS for column in head.columns]
+    df_bounds = pd.DataFrame(bounds, columns=["id", "success", "bounds"]).set_index("id")
+    df_model_outputs = (
+        pd.concat(model_outputs) if model_outputs else pd.DataFrame(columns=columns)
+    )
+    computed = to_cache_results(df_bounds, df_model_outputs, data_hashes, DEFAULT_HEADS)
+    InferenceCache.store(session, computed, versions)
+
+    results = {**cached, **computed}
+    reused_bounds, reused_outputs = [], []
+    for image_id, data_hash in reused.items():
+        if data_hash not in results:
+            # the image with the same pixel data failed, retried in the next run
+            continue
+        row_bounds, row_outputs = from_cache_result(image_id, results[data_hash], DEFAULT_HEADS)
+        reused_bounds.append(row_bounds)
+        if row_outputs is not None:
+            reused_outputs.append(row_outputs)
+    if reused_bounds:
+        df_bounds = pd.concat(
+            [df_bounds, pd.DataFrame(reused_bounds).set_index("id")]
+        )
+    if reused_outputs:
+        df_model_outputs = pd.concat(
+            [df_model_outputs, pd.DataFrame(reused_outputs).set_index("id")[columns]]
+        )
+    if len(df_bounds) == 0:
+        session.commit()
         return
+    n_successful = int(df_bounds["success"].sum())
 
-    fpaths = [
-        (
-            f'{cfi_cache_path}/rgb/{id}.png',
-            f'{cfi_cache_path}/ce/{id}.png',
-        )
-        for id in ids
-    ]
+    if len(df_model_outputs) == 0:
+        from .utils import clear_unsuccessfull
 
-    # Run the models
-    df_model_outputs = run_basic_models(fpaths, ids, device)
-    fpaths = [fp[0] for fp in fpaths]
-    df_quality = run_quality_model(fpaths, ids, device)
+        print("No images were preprocessed successfully")
+        clear_unsuccessfull(session, df_bounds)
+        return
 
     # Update the DB
     from .utils import clear_unsuccessfull, postprocess, update_database
@@ -173,7 +306,6 @@ def run_inference_for_images(
     df = pd.merge(
         df_bounds, df_model_outputs, left_index=True, right_index=True, how="left"
     )
-    df = pd.merge(df, df_quality, left_index=True, right_index=True, how="left")
     df = df.rename(
         columns={
             "x_fovea": "prep_fovea_x",
@@ -189,23 +321,139 @@ def run_inference_for_images(
     df_successfull = postprocess(df_successfull)
     update_database(session, df_successfull)
     clear_unsuccessfull(session, df_unsucessfull)
+    t_database = time.perf_counter()
 
+    print(
+        f"Preprocessing + models: {t_pipeline - t_start:.1f}s (models: {t_models:.1f}s, "
+        f"waiting for preprocessing: {t_pipeline - t_start - t_models:.1f}s), "
+        f"database: {t_database - t_pipeline:.1f}s "
+        f"({n_successful}/{len(df_bounds)} images preprocessed successfully)"
+    )
 
-def run_inference(session, device: torch.device = None, cfi_cache_path=None):
-    if device is None:
-        device = auto_device()
 
-    # We run preprocessing + inference on all ColorFundus images with DatePreprocessed==None
-    images = ImageInstance.where(
+def run_isolating_failures(session, ids, paths, **kwargs):
+    """
+    Run inference on the images (see run_inference_for_paths), isolating the images that make a
+    run fail: if a run raises, both halves are run separately and the search continues in the
+    half that fails, down to single images.
+
+    Returns the ids of the images that failed on their own. Raises if both halves of a failed
+    run fail as well, as the error is then not caused by a single image (e.g. the database or
+    the models).
+    """
+    try:
+        run_inference_for_paths(session, ids, paths, **kwargs)
+        return []
+    except Exception as e:
+        session.rollback()
+        error = e
+
+    while len(ids) > 1:
+        half = len(ids) // 2
+        failed_parts = []
+        for part in (slice(None, half), slice(half, None)):
+            try:
+                run_inference_for_paths(session, ids[part], paths[part], **kwargs)
+            except Exception as e:
+                session.rollback()
+                failed_parts.append(part)
+                error = e
+        if len(failed_parts) == 2:
+            raise error
+        if not failed_parts:
+            return []
+        # the other half was processed, continue in the failed half
+        ids, paths = ids[failed_parts[0]], paths[failed_parts[0]]
+
+    print(f"Error running inference for image {ids[0]}: {error}")
+    return list(ids)
+
+
+def run_inference_chunk(
+    session,
+    owner: str,
+    chunk_size: int = 500,
+    lease_seconds: int = 3600,
+    device: torch.device = None,
+    cfi_cache_path=None,
+    registry: ModelRegistry = None,
+) -> int:
+    """
+    Claim a chunk of pending images (see claim_pending_images), run inference on it and
+    release it. Returns the number of images claimed (0 when there is nothing left to do).
+
+    Images that are not processed count a failed attempt (see record_failed_attempts), unless
+    the chunk fails as a whole (see run_isolating_failures), in which case the error is raised
+    and the task retries the chunk.
+    """
+    rows = claim_pending_images(session, owner, chunk_size, lease_seconds)
+    if not rows:
+        return 0
+    images_basepath = Path(session.config.images_basepath)
+    ids = [row.ImageInstanceID for row in rows]
+    run_isolating_failures(
         session,
-        (ImageInstance.Modality == Modality.ColorFundus)
-        & (ImageInstance.DatePreprocessed == None)
+        ids,
+        [images_basepath / row.DatasetIdentifier for row in rows],
+        device=device,
+        cfi_cache_path=cfi_cache_path,
+        registry=registry,
     )
-
-    if len(images) == 0:
+    record_failed_attempts(session, owner, ids)
+    release_images(session, owner)
+    return len(rows)
+
+
+def run_inference(
+    session,
+    device: torch.device = None,
+    cfi_cache_path=None,
+    registry: ModelRegistry = None,
+    chunk_size: int = 1000,
+    model_batch_size: int = 16,
+):
+    """
+    Run preprocessing + inference on all ColorFundus images with DatePreprocessed == None.
+
+    Images are processed in chunks of chunk_size. The results of each chunk are committed
+    before the next chunk is started, so an interrupted run continues where it stopped when
+    it is started again (processed images have DatePreprocessed set).
+    """
+    if registry is None:
+        registry = get_registry(device)
+
+    n_total = session.scalar(
+        select(func.count()).select_from(pending_images_query().subquery())
+    )
+    if n_total == 0:
         print("No images to process")
         return
-    print(f"Found {len(images)} CFI images to process")
-
-    # Run inference
-    run_inference_for_images(session, images, device, cfi_cache_path=cfi_cache_path)
+    print(f"Found {n_total} CFI images to process")
+
+    images_basepath = Path(session.config.images_basepath)
+    last_id = 0
+    n_processed = 0
+    t_start = time.perf_counter()
+    while True:
+        # only ids and paths are loaded, so no ORM objects accumulate in the session
+        rows = session.execute(pending_images_query(last_id).limit(chunk_size)).all()
+        if not rows:
+            break
+        # images that fail (and are not marked as processed) are not retried within this run
+        last_id = rows[-1].ImageInstanceID
+
+        t_chunk = time.perf_counter()
+        run_inference_for_paths(
+            session,
+            [row.ImageInstanceID for row in rows],
+            [images_basepath / row.DatasetIdentifier for row in rows],
+            cfi_cache_path=cfi_cache_path,
+            registry=registry,
+            model_batch_size=model_batch_size,
+        )
+        n_processed += len(rows)
+        elapsed = time.perf_counter() - t_start
+        print(
+            f"Processed chunk of {len(rows)} images in {time.perf_counter() - t_chunk:.1f}s "
+            f"({n_processed}/{n_total}, {n_processed / elapsed:.1f} images/s)"
+        )
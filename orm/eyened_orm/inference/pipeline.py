@@ -0,0 +1,144 @@
+"""
+Producer / consumer pipeline for CFI preprocessing and inference.
+
+Preprocessing workers (processes) feed a bounded queue that is consumed by the model stage,
+so that preprocessing of the next images overlaps with running the models on the current batch.
+
+Preprocessed images are either kept in memory (cfi_cache_path=None) or written to
+cfi_cache_path/rgb and cfi_cache_path/ce as PNG files (as rtnls_fundusprep.parallel_preprocess does).
+"""
+
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+_DONE = object()
+
+
+def preprocess_image(
+    id: int,
+    path: str | Path,
+    rgb_path: Optional[str] = None,
+    ce_path: Optional[str] = None,
+    square_size: int = 1024,
+) -> Dict[str, Any]:
+    """
+    Preprocess a single CFI (see rtnls_fundusprep.preprocessor.preprocess_one).
+
+    Returns a dict with id, success and bounds. For successfully preprocessed images, rgb and ce
+    contain the preprocessed images: the PNG paths if rgb_path and ce_path are given,
+    otherwise the uint8 arrays.
+    """
+    from PIL import Image
+    from rtnls_fundusprep.preprocessor import FundusPreprocessor
+    from rtnls_fundusprep.utils import open_image
+
+    preprocessor = FundusPreprocessor(square_size=square_size, contrast_enhance=True)
+    try:
+        prep = preprocessor(open_image(path), None)
+    except Exception:
+        print(f"Error with image {path} with id {id}")
+        return {"id": id, "success": False, "bounds": {}}
+
+    rgb = prep["image"].astype(np.uint8)
+    ce = prep["ce"].astype(np.uint8)
+    item = {"id": id, "success": True, "bounds": prep["metadata"]["bounds"]}
+    if rgb_path is not None and ce_path is not None:
+        Image.fromarray(rgb).save(rgb_path)
+        Image.fromarray(ce).save(ce_path)
+        item["rgb"], item["ce"] = rgb_path, ce_path
+    else:
+        item["rgb"], item["ce"] = rgb, ce
+    return item
+
+
+def _produce(items, out_queue: queue.Queue, n_jobs: int, max_pending: int, stop: threading.Event):
+    """Run preprocess_image for items in a process pool, putting the results on out_queue in order."""
+    try:
+        # spawn: the parent may have initialized CUDA and runs threads, which does not mix with fork
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as executor:
+            pending = deque()
+            for args in items:
+                if stop.is_set():
+                    break
+                pending.append(executor.submit(preprocess_image, *args))
+                if len(pending) >= max_pending:
+                    out_queue.put(pending.popleft().result())
+            while pending and not stop.is_set():
+                out_queue.put(pending.popleft().result())
+            for future in pending:
+                future.cancel()
+    except BaseException as e:
+        out_queue.put(e)
+    finally:
+        out_queue.put(_DONE)
+
+
+def iter_preprocessed_batches(
+    ids: List[int],
+    paths: List[str | Path],
+    batch_size: int = 32,
+    cfi_cache_path: Optional[str | Path] = None,
+    n_jobs: int = 8,
+    queue_size: Optional[int] = None,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Preprocess images in a background process pool and yield them in batches of batch_size.
+
+    At most queue_size preprocessed images (default: 2 * batch_size) are waiting for the
+    consumer, which bounds memory use when the images are kept in memory.
+    Failed images are included with success=False.
+    """
+    if cfi_cache_path is not None:
+        rgb_dir = Path(cfi_cache_path) / "rgb"
+        ce_dir = Path(cfi_cache_path) / "ce"
+        rgb_dir.mkdir(parents=True, exist_ok=True)
+        ce_dir.mkdir(parents=True, exist_ok=True)
+        items = [
+            (id, path, str(rgb_dir / f"{id}.png"), str(ce_dir / f"{id}.png"))
+            for id, path in zip(ids, paths)
+        ]
+    else:
+        items = [(id, path) for id, path in zip(ids, paths)]
+
+    if queue_size is None:
+        queue_size = 2 * batch_size
+    out_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=_produce,
+        args=(items, out_queue, n_jobs, n_jobs * 2, stop),
+        daemon=True,
+    )
+    producer.start()
+
+    batch = []
+    try:
+        while True:
+            item = out_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        stop.set()
+        # unblock the producer if it is waiting on a full queue
+        while producer.is_alive():
+            try:
+                out_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
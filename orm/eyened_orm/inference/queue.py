@@ -0,0 +1,145 @@
+"""
+Database backed queue of the ColorFundus images that need inference.
+
+Pending images have DatePreprocessed == None. Inference tasks lease chunks of pending images
+(InferenceLeaseOwner, InferenceLeaseUntil), so that any number of workers can process the queue
+concurrently without processing the same images. Leases expire, so the images of a worker that
+died are picked up again by other workers. Failed inference runs are counted per image
+(InferenceAttempts, see record_failed_attempts; reset when the image is processed): a run that
+fails as a whole, or a retry of the same task, is not counted against the images of the chunk.
+Images that failed MAX_INFERENCE_ATTEMPTS times are no longer claimed (failed). Set their
+InferenceAttempts to 0 to process them again.
+
+This module does not depend on torch, so it can be used by the server.
+"""
+
+from typing import Optional
+
+from sqlalchemy import case, func, literal_column, or_, select, update
+
+from eyened_orm import ImageInstance, Modality
+
+MAX_INFERENCE_ATTEMPTS = 3
+
+
+def not_leased(owner: Optional[str] = None):
+    """Condition: the image is not leased by a (running) inference task, other than owner."""
+    condition = or_(
+        ImageInstance.InferenceLeaseUntil == None,
+        ImageInstance.InferenceLeaseUntil < func.now(),
+    )
+    if owner is not None:
+        condition = or_(condition, ImageInstance.InferenceLeaseOwner == owner)
+    return condition
+
+
+def pending_images_query(last_id: int = 0, owner: Optional[str] = None):
+    """
+    ColorFundus images that have not been preprocessed yet and are not being processed by an
+    inference task (other than owner), ordered by ImageInstanceID.
+    """
+    return (
+        select(ImageInstance.ImageInstanceID, ImageInstance.DatasetIdentifier)
+        .where(
+            ImageInstance.Modality == Modality.ColorFundus,
+            ImageInstance.DatePreprocessed == None,
+            ImageInstance.Inactive == False,
+            ImageInstance.ImageInstanceID > last_id,
+            not_leased(owner),
+        )
+        .order_by(ImageInstance.ImageInstanceID)
+    )
+
+
+def claim_pending_images(
+    session,
+    owner: str,
+    chunk_size: int = 500,
+    lease_seconds: int = 3600,
+    max_attempts: int = MAX_INFERENCE_ATTEMPTS,
+):
+    """
+    Lease up to chunk_size pending images to owner for lease_seconds and return their ids and paths.
+
+    Rows are selected with FOR UPDATE SKIP LOCKED, so concurrent workers claim disjoint chunks.
+    Images already leased to owner (a previous attempt of the same task) are claimed again.
+    Images that failed max_attempts times are skipped.
+    """
+    query = (
+        pending_images_query(owner=owner)
+        .where(ImageInstance.InferenceAttempts < max_attempts)
+        .limit(chunk_size)
+        .with_for_update(skip_locked=True)
+    )
+    rows = session.execute(query).all()
+    if rows:
+        session.execute(
+            update(ImageInstance)
+            .where(ImageInstance.ImageInstanceID.in_([row.ImageInstanceID for row in rows]))
+            .values(
+                InferenceLeaseOwner=owner,
+                InferenceLeaseUntil=func.timestampadd(
+                    literal_column("SECOND"), lease_seconds, func.now()
+                ),
+            )
+        )
+    session.commit()
+    return rows
+
+
+def record_failed_attempts(session, owner: str, image_ids):
+    """
+    Count a failed attempt for the images of image_ids leased to owner that were not processed.
+    """
+    session.execute(
+        update(ImageInstance)
+        .where(
+            ImageInstance.ImageInstanceID.in_(list(image_ids)),
+            ImageInstance.InferenceLeaseOwner == owner,
+            ImageInstance.DatePreprocessed == None,
+        )
+        .values(InferenceAttempts=ImageInstance.InferenceAttempts + 1)
+    )
+    session.commit()
+
+
+def release_images(session, owner: str):
+    """
+    Release the leases of owner on processed images.
+
+    Images that could not be processed keep their lease until it expires, after which
+    they are claimed again (by any task), until they failed MAX_INFERENCE_ATTEMPTS times.
+    """
+    session.execute(
+        update(ImageInstance)
+        .where(
+            ImageInstance.InferenceLeaseOwner == owner,
+            ImageInstance.DatePreprocessed != None,
+        )
+        .values(InferenceLeaseOwner=None, InferenceLeaseUntil=None, InferenceAttempts=0)
+    )
+    session.commit()
+
+
+def inference_progress(session) -> dict:
+    """
+    Number of ColorFundus images waiting for inference (pending), being processed (in_progress)
+    and no longer claimed after MAX_INFERENCE_ATTEMPTS failed attempts (failed).
+    """
+    leased = ImageInstance.InferenceLeaseUntil >= func.now()
+    failed = ~leased & (ImageInstance.InferenceAttempts >= MAX_INFERENCE_ATTEMPTS)
+    query = select(
+        func.count(),
+        func.coalesce(func.sum(case((leased, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((failed, 1), else_=0)), 0),
+    ).where(
+        ImageInstance.Modality == Modality.ColorFundus,
+        ImageInstance.DatePreprocessed == None,
+        ImageInstance.Inactive == False,
+    )
+    total, in_progress, n_failed = session.execute(query).one()
+    return {
+        "pending": int(total) - int(in_progress) - int(n_failed),
+        "in_progress": int(in_progress),
+        "failed": int(n_failed),
+    }
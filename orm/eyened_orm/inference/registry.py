@@ -0,0 +1,261 @@
+"""
+Process level registry of the inference ensembles.
+
+Loading an ensemble from huggingface (or the local cache) takes much longer than running it on
+the few images of a typical import, so the registry loads each ensemble once, keeps it on the
+device and returns the same instance on subsequent calls.
+
+- Models are identified by name (fovea, discedge, quality). Each name maps to a ModelSpec with a
+  version. When the spec of a name changes (set_model), the loaded ensemble is replaced on the
+  next call to get (hot reload).
+- When memory_budget_mb is set, the least recently used ensembles are evicted to stay within
+  the budget. When idle_timeout is set, ensembles that have not been used for that many seconds
+  are evicted, by a daemon thread of the process that loaded them (the registry is per process,
+  so every worker process frees its own models).
+- On CPU, the ensembles can run on ONNX Runtime instead of torch (backend, see backends.py).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import torch
+
+from .backends import OnnxModule, convert_ensemble, set_num_threads
+from .utils import auto_device
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    kind: str  # "heatmap" or "classification"
+    reference: str  # huggingface reference: "<repo>:<path>"
+    version: Optional[str] = None  # defaults to the reference
+
+    @property
+    def key(self) -> str:
+        return self.version or self.reference
+
+
+DEFAULT_MODELS: Dict[str, ModelSpec] = {
+    "fovea": ModelSpec("heatmap", "Eyened/vascx:fovea/fovea_july24.pt"),
+    "discedge": ModelSpec("heatmap", "Eyened/vascx:discedge/discedge_july24.pt"),
+    "quality": ModelSpec("classification", "Eyened/vascx:quality/quality.pt"),
+}
+
+
+def load_ensemble(spec: ModelSpec):
+    if spec.kind == "heatmap":
+        from rtnls_inference.ensembles import HeatmapRegressionEnsemble
+
+        return HeatmapRegressionEnsemble.from_huggingface(spec.reference)
+    elif spec.kind == "classification":
+        from rtnls_inference.ensembles.ensemble_classification import (
+            ClassificationEnsemble,
+        )
+
+        return ClassificationEnsemble.from_huggingface(spec.reference)
+    raise ValueError(f"Unknown model kind: {spec.kind}")
+
+
+def module_size_mb(module: torch.nn.Module) -> float:
+    """
+    Memory used by the parameters and buffers of a module, in MB. ONNX Runtime submodules
+    (OnnxModule) have no torch parameters and are counted by the size of their model file.
+    """
+    tensors = [*module.parameters(), *module.buffers()]
+    n_bytes = sum(t.numel() * t.element_size() for t in tensors)
+    n_bytes += sum(m.path.stat().st_size for m in module.modules() if isinstance(m, OnnxModule))
+    return n_bytes / 2**20
+
+
+@dataclass
+class _LoadedModel:
+    spec: ModelSpec
+    ensemble: torch.nn.Module
+    size_mb: float
+    last_used: float
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        models: Optional[Dict[str, ModelSpec]] = None,
+        device: Optional[torch.device] = None,
+        memory_budget_mb: Optional[float] = None,
+        idle_timeout: Optional[float] = None,
+        backend: str = "torch",
+        num_threads: Optional[int] = None,
+        onnx_cache_path: Optional[str] = None,
+    ):
+        """
+        Parameters:
+        -----------
+        models : Dict[str, ModelSpec], optional
+            Models by name (default: DEFAULT_MODELS)
+        device : torch.device, optional
+            Device the models are loaded on (default: auto_device())
+        memory_budget_mb : float, optional
+            Maximum memory used by the loaded models, least recently used models are evicted first
+        idle_timeout : float, optional
+            Evict models that have not been used for this many seconds
+        backend : str, default="torch"
+            "torch", "onnx" or "onnx-int8" (CPU only)
+        num_threads : int, optional
+            Number of intra op threads used on CPU
+        onnx_cache_path : str, optional
+            Where exported ONNX models are stored (default: ~/.cache/eyened/onnx)
+        """
+        self.models = dict(models or DEFAULT_MODELS)
+        self.device = device if device is not None else auto_device()
+        self.memory_budget_mb = memory_budget_mb
+        self.idle_timeout = idle_timeout
+        if backend != "torch" and self.device.type != "cpu":
+            raise ValueError(f"Backend {backend} is only supported on cpu")
+        self.backend = backend
+        self.num_threads = num_threads
+        self.onnx_cache_path = onnx_cache_path
+        if self.device.type == "cpu":
+            set_num_threads(num_threads)
+        # loaded models, in order of last use
+        self._loaded: "OrderedDict[str, _LoadedModel]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._idle_thread: Optional[threading.Thread] = None
+
+    def get(self, name: str) -> torch.nn.Module:
+        """Return the ensemble for name, loading it if it is not loaded or its version changed."""
+        with self._lock:
+            self.evict_idle()
+            spec = self.models[name]
+            loaded = self._loaded.get(name)
+            if loaded is not None and loaded.spec.key != spec.key:
+                print(f"Reloading model {name}: {loaded.spec.key} -> {spec.key}")
+                self.evict(name)
+                loaded = None
+
+            if loaded is None:
+                t_start = time.perf_counter()
+                ensemble = load_ensemble(spec).to(self.device)
+                ensemble.eval()
+                ensemble = convert_ensemble(
+                    ensemble,
+                    self.backend,
+                    name,
+                    spec.key,
+                    onnx_cache_path=self.onnx_cache_path,
+                    num_threads=self.num_threads,
+                )
+                # after conversion: the backend determines the memory used
+                size_mb = module_size_mb(ensemble)
+                loaded = _LoadedModel(spec, ensemble, size_mb, time.monotonic())
+                self._loaded[name] = loaded
+                print(
+                    f"Loaded model {name} ({spec.key}, {loaded.size_mb:.0f} MB) on {self.device} ({self.backend}) "
+                    f"in {time.perf_counter() - t_start:.1f}s"
+                )
+                self._enforce_budget(keep=name)
+                self._start_idle_thread()
+
+            loaded.last_used = time.monotonic()
+            self._loaded.move_to_end(name)
+            return loaded.ensemble
+
+    def set_model(self, name: str, spec: ModelSpec):
+        """Register or replace the spec for name. A loaded model with a different version is replaced on the next get."""
+        with self._lock:
+            self.models[name] = spec
+
+    def update_models(self, models: Dict[str, ModelSpec]):
+        for name, spec in models.items():
+            self.set_model(name, spec)
+
+    def reload(self, name: Optional[str] = None):
+        """Force (all or one) models to be loaded again on the next get."""
+        with self._lock:
+            for n in [name] if name is not None else list(self._loaded):
+                self.evict(n)
+
+    def evict(self, name: str):
+        with self._lock:
+            loaded = self._loaded.pop(name, None)
+        if loaded is None:
+            return
+        del loaded
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for name, loaded in list(self._loaded.items()):
+                if now - loaded.last_used > self.idle_timeout:
+                    print(f"Evicting idle model {name}")
+                    self.evict(name)
+
+    def _start_idle_thread(self):
+        # started on the first load, in the process (e.g. huey worker) that uses the models
+        if self.idle_timeout is None or self._idle_thread is not None:
+            return
+        interval = min(max(self.idle_timeout / 2, 1), 600)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        self._idle_thread = threading.Thread(target=run, name="evict-idle-models", daemon=True)
+        self._idle_thread.start()
+
+    def _enforce_budget(self, keep: str):
+        if self.memory_budget_mb is None:
+            return
+        # least recently used first
+        for name in list(self._loaded):
+            if self.memory_used_mb() <= self.memory_budget_mb:
+                break
+            if name != keep:
+                print(f"Evicting model {name} (memory budget {self.memory_budget_mb:.0f} MB)")
+                self.evict(name)
+
+    def memory_used_mb(self) -> float:
+        with self._lock:
+            return sum(loaded.size_mb for loaded in self._loaded.values())
+
+    def info(self) -> Dict[str, Dict]:
+        """Loaded models with their version, size and idle time."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                name: {
+                    "version": loaded.spec.key,
+                    "size_mb": loaded.size_mb,
+                    "idle": now - loaded.last_used,
+                }
+                for name, loaded in self._loaded.items()
+            }
+
+
+_registries: Dict[str, ModelRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(
+    device: Optional[torch.device] = None, backend: str = "torch", **kwargs
+) -> ModelRegistry:
+    """
+    Return the process level registry for device and backend (created on first use).
+
+    kwargs (models, memory_budget_mb, idle_timeout, num_threads, onnx_cache_path) are only used
+    when the registry is created.
+    """
+    if device is None:
+        device = auto_device()
+    device = torch.device(device)
+    key = f"{device}:{backend}"
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ModelRegistry(device=device, backend=backend, **kwargs)
+        return _registries[key]
@@ -1,62 +1,75 @@
 from datetime import datetime
 
+import numpy as np
 from eyened_orm import ImageInstance
 from sqlalchemy import update
-from tqdm import tqdm
 
 
-def transform_kps(colname):
-    from rtnls_fundusprep.cfi_bounds import CFIBounds
-
-    def transform_fn(row):
-        bounds = row["bounds"]
-        bounds = CFIBounds(**bounds)
-
-        M = bounds.get_cropping_transform(1024)
-        kps = M.apply_inverse([[row[f"prep_{colname}_x"], row[f"prep_{colname}_y"]]])
-        return kps[0].tolist()
+def inverse_cropping_transform(bounds, points, target_diameter=1024):
+    """
+    Map points in the preprocessed images back to the original images.
 
-    return transform_fn
+    Batched equivalent of CFIBounds(**b).get_cropping_transform(target_diameter).apply_inverse(p)
+    for every bounds dict b and point p (array of shape (N, 2), xy). The cropping transform
+    scales the fundus circle (center, radius) to the target diameter and centers it.
+    """
+    center = np.array([b["center"] for b in bounds], dtype=float).reshape(-1, 2)
+    radius = np.array([b["radius"] for b in bounds], dtype=float)
+    scale = 2 * radius / target_diameter
+    return (np.asarray(points, dtype=float) - target_diameter / 2) * scale[:, None] + center
 
 
 def logits_to_continuous_score(logits, temperature=3.0):
-    import torch
-    import torch.nn.functional as F
-    logits = torch.tensor(logits, dtype=torch.float32) / temperature
-    probs = F.softmax(logits, dim=-1)
-    num_classes = len(logits)
-    class_indices = torch.arange(num_classes, dtype=torch.float32).flip(dims=[0])
-    continuous_score = torch.sum(probs * class_indices).item()
-    return continuous_score
+    """
+    Continuous quality score (0: worst, num_classes - 1: best) for logits of shape (N, num_classes)
+    or (num_classes,): the expected class index, with classes in reverse order.
+    """
+    logits = np.asarray(logits, dtype=float) / temperature
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    probs = np.exp(logits)
+    probs /= probs.sum(axis=-1, keepdims=True)
+    class_indices = np.arange(logits.shape[-1], dtype=float)[::-1]
+    return probs @ class_indices
 
 
 def postprocess(df):
-    # df["bounds"] = df.apply(add_hw_to_bounds, axis=1)
-    df["discedge"] = df.apply(transform_kps("discedge"), axis=1)
-    df["fovea"] = df.apply(transform_kps("fovea"), axis=1)
-    df["score"] = df[["q1", "q2", "q3"]].apply(
-        lambda row: logits_to_continuous_score(row.values), axis=1
-    )
+    df = df.copy()
+    bounds = df["bounds"].tolist()
+    for colname in ["discedge", "fovea"]:
+        prep_kps = df[[f"prep_{colname}_x", f"prep_{colname}_y"]].to_numpy(dtype=float)
+        df[colname] = inverse_cropping_transform(bounds, prep_kps).tolist()
+    df["score"] = logits_to_continuous_score(df[["q1", "q2", "q3"]].to_numpy())
     return df
 
 
 def update_database(session, df, commit=True, N=10000):
     from rtnls_fundusprep.cfi_bounds import CFIBounds
 
+    now = datetime.now()
+    prep_fovea = df[["prep_fovea_x", "prep_fovea_y"]].to_numpy(dtype=float).tolist()
+    prep_discedge = df[["prep_discedge_x", "prep_discedge_y"]].to_numpy(dtype=float).tolist()
     updates = [
         {
             "ImageInstanceID": index,
-            "CFROI": CFIBounds(**row["bounds"]).to_dict_all(),
+            "CFROI": CFIBounds(**bounds).to_dict_all(),
             "CFKeypoints": {
-                "fovea_xy": row["fovea"],
-                "disc_edge_xy": row["discedge"],
-                "prep_fovea_xy": [row["prep_fovea_x"], row["prep_fovea_y"]],
-                "prep_disc_edge_xy": [row["prep_discedge_x"], row["prep_discedge_y"]],
+                "fovea_xy": fovea,
+                "disc_edge_xy": discedge,
+                "prep_fovea_xy": prep_fovea_xy,
+                "prep_disc_edge_xy": prep_disc_edge_xy,
             },
-            "DatePreprocessed": datetime.now(),
-            "CFQuality": row["score"],
+            "DatePreprocessed": now,
+            "CFQuality": score,
         }
-        for index, row in tqdm(df.iterrows())
+        for index, bounds, fovea, discedge, prep_fovea_xy, prep_disc_edge_xy, score in zip(
+            df.index.tolist(),
+            df["bounds"].tolist(),
+            df["fovea"].tolist(),
+            df["discedge"].tolist(),
+            prep_fovea,
+            prep_discedge,
+            df["score"].astype(float).tolist(),
+        )
     ]
 
     for i in range(0, len(updates), N):
@@ -71,15 +84,18 @@ def clear_unsuccessfull(session, df, commit=True):
     # - set DatePreprocessed to now
     # - set CFROI to {success: False}
     # - clear all the derived fields
+    if len(df) == 0:
+        return
+    now = datetime.now()
     updates = [
         {
             "ImageInstanceID": index,
             "CFROI": {"success": False},
             "CFKeypoints": None,
-            "DatePreprocessed": datetime.now(),
+            "DatePreprocessed": now,
             "CFQuality": None,
         }
-        for index, row in tqdm(df.iterrows())
+        for index in df.index.tolist()
     ]
 
     session.execute(update(ImageInstance), updates)
@@ -87,7 +103,6 @@ def clear_unsuccessfull(session, df, commit=True):
         session.commit()
 
 
-
 def auto_device():
     import GPUtil
     import torch
@@ -0,0 +1,74 @@
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+
+from sqlalchemy import JSON, String, VARBINARY, func, select, tuple_
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from .base import Base
+
+
+class InferenceCache(Base):
+    """
+    Cached output of an inference model for the pixel data with hash DataHash
+    (see ImageInstance.DataHash). Results are reused for images with the same pixel data,
+    as long as the model version is unchanged.
+    """
+
+    __tablename__ = "InferenceCache"
+
+    DataHash: Mapped[bytes] = mapped_column(VARBINARY(64), primary_key=True)
+    ModelName: Mapped[str] = mapped_column(String(64), primary_key=True)
+    ModelVersion: Mapped[str] = mapped_column(String(255), primary_key=True)
+    Result: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSON)
+    DateInserted: Mapped[datetime] = mapped_column(server_default=func.now())
+
+    @classmethod
+    def lookup(
+        cls,
+        session: Session,
+        data_hashes: Iterable[bytes],
+        versions: Mapping[str, str],
+    ) -> Dict[bytes, Dict[str, Any]]:
+        """
+        Cached results for data_hashes and the models in versions (model name -> version).
+
+        Returns {DataHash: {ModelName: Result}} for the hashes that have a result for every model.
+        """
+        data_hashes = {h for h in data_hashes if h is not None}
+        if not data_hashes or not versions:
+            return {}
+        stmt = select(cls.DataHash, cls.ModelName, cls.Result).where(
+            cls.DataHash.in_(data_hashes),
+            tuple_(cls.ModelName, cls.ModelVersion).in_(list(versions.items())),
+        )
+        results: Dict[bytes, Dict[str, Any]] = {}
+        for data_hash, model_name, result in session.execute(stmt):
+            results.setdefault(data_hash, {})[model_name] = result
+        return {h: r for h, r in results.items() if len(r) == len(versions)}
+
+    @classmethod
+    def store(
+        cls,
+        session: Session,
+        results: Mapping[bytes, Mapping[str, Any]],
+        versions: Mapping[str, str],
+    ):
+        """Insert or replace the results ({DataHash: {ModelName: Result}}) for the model versions."""
+        rows: List[Dict[str, Any]] = [
+            {
+                "DataHash": data_hash,
+                "ModelName": model_name,
+                "ModelVersion": versions[model_name],
+                "Result": result,
+            }
+            for data_hash, model_results in results.items()
+            for model_name, result in model_results.items()
+        ]
+        if not rows:
+            return
+        stmt = insert(cls)
+        stmt = stmt.on_duplicate_key_update(
+            Result=stmt.inserted.Result, DateInserted=func.now()
+        )
+        session.execute(stmt, rows)
@@ -1,6 +1,6 @@
 import enum
 from datetime import date, datetime
-from typing import TYPE_CHECKING, ClassVar, List, Optional
+from typing import TYPE_CHECKING, Any, ClassVar, Dict, List, Optional
 
 from sqlalchemy import Index, String, ForeignKey, select, Enum as SAEnum, func
 from sqlalchemy.orm import Mapped, Session, mapped_column, relationship
@@ -10,6 +10,7 @@ from .base import Base
 if TYPE_CHECKING:
     from eyened_orm import (Annotation, FormAnnotation, ImageInstance, Project,
                             Study, AttributeValue)
+    from eyened_orm.utils.transforms import TransformGraph
 
 
 class SexEnum(enum.Enum):
@@ -87,3 +88,18 @@ class Patient(Base):
         if where is not None:
             q = q.where(where)
         return session.scalars(q).all()
+
+    def get_transform_graph(self, schema_name: str = "RegistrationSet") -> "TransformGraph":
+        """Return the (cached) graph of the registration transforms of this patient."""
+        from eyened_orm.utils.transforms import get_transform_graph
+
+        return get_transform_graph(Session.object_session(self), self.PatientID, schema_name)
+
+    def get_transform(
+        self, source_id: int, target_id: int, schema_name: str = "RegistrationSet"
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Return the transform from image source_id to image target_id, composed along the shortest
+        path of registrations, or None if the images are not registered (directly or indirectly).
+        """
+        return self.get_transform_graph(schema_name).transform(source_id, target_id)
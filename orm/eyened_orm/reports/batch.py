@@ -0,0 +1,302 @@
+"""
+Batch generation of ETDRS reports (see eorm etdrs-report).
+
+For every selected image the latest segmentation of each feature is read from the zarr store
+(one batched read per zarr array), and the report is created and exported (report.json and
+report.html in results_folder/<ImageInstanceID>) in a process pool. MultiLabel and MultiClass
+segmentations are summarized per subfeature of their feature, in one pass (see
+ETDRS_masks.get_label_summary). Images that already have
+a report.json are skipped. The summaries of all images are combined in one table
+(results_folder/etdrs_report.parquet) with one row per image, feature and field.
+"""
+
+import json
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from tqdm import tqdm
+
+from eyened_orm import (
+    Feature,
+    ImageInstance,
+    ModelSegmentation,
+    Patient,
+    Segmentation,
+    SegmentationModel,
+    Series,
+    Study,
+    Tag,
+    TagType,
+)
+from eyened_orm.segmentation import DataRepresentation, Datatype
+from eyened_orm.tag import ImageInstanceTagLink
+from eyened_orm.utils.zarr.manager import ZarrStorageManager
+
+from .etdrs_masks import subfeature_labels
+from .instance_report import InstanceReport
+
+SOURCES = ("model", "annotation")
+
+# the fovea is rounded to multiples of FOVEA_TOLERANCE pixels, so images with the same geometry
+# share their grid label maps (see ETDRS_masks)
+FOVEA_TOLERANCE = 0.25
+
+
+def select_segmentations(
+    session,
+    features: Sequence[str],
+    project_id: Optional[int] = None,
+    tag: Optional[str] = None,
+    source: str = "model",
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Latest segmentation of each feature per image: {ImageInstanceID: {FeatureName: segmentation}}.
+
+    source is "model" (ModelSegmentation) or "annotation" (active Segmentation).
+    """
+    if source == "model":
+        segmentation = ModelSegmentation
+        stmt = (
+            select(ModelSegmentation, Feature.FeatureName)
+            .join(SegmentationModel, ModelSegmentation.ModelID == SegmentationModel.ModelID)
+            .join(Feature, SegmentationModel.FeatureID == Feature.FeatureID)
+            .order_by(ModelSegmentation.ModelSegmentationID)
+        )
+    elif source == "annotation":
+        segmentation = Segmentation
+        stmt = (
+            select(Segmentation, Feature.FeatureName)
+            .join(Feature, Segmentation.FeatureID == Feature.FeatureID)
+            .where(Segmentation.Inactive == False)
+            .order_by(Segmentation.SegmentationID)
+        )
+    else:
+        raise ValueError(f"Unknown source: {source}, options: {', '.join(SOURCES)}")
+
+    stmt = stmt.join(
+        ImageInstance, segmentation.ImageInstanceID == ImageInstance.ImageInstanceID
+    ).where(
+        Feature.FeatureName.in_(features),
+        ImageInstance.Inactive == False,
+        segmentation.ZarrArrayIndex != None,
+    )
+    if project_id is not None:
+        stmt = (
+            stmt.join(Series, ImageInstance.SeriesID == Series.SeriesID)
+            .join(Study, Series.StudyID == Study.StudyID)
+            .join(Patient, Study.PatientID == Patient.PatientID)
+            .where(Patient.ProjectID == project_id)
+        )
+    if tag is not None:
+        stmt = (
+            stmt.join(
+                ImageInstanceTagLink,
+                ImageInstance.ImageInstanceID == ImageInstanceTagLink.ImageInstanceID,
+            )
+            .join(Tag, ImageInstanceTagLink.TagID == Tag.TagID)
+            .where(Tag.TagName == tag, Tag.TagType == TagType.ImageInstance)
+        )
+
+    latest: Dict[int, Dict[str, Any]] = defaultdict(dict)
+    for seg, feature_name in session.execute(stmt):
+        # ordered by id, so the latest segmentation wins
+        latest[seg.ImageInstanceID][feature_name] = seg
+    return {
+        image_id: {f: segs[f] for f in features if f in segs}
+        for image_id, segs in latest.items()
+    }
+
+
+def read_segmentations(
+    storage_manager: ZarrStorageManager, segmentations: Sequence[Any]
+) -> List[np.ndarray]:
+    """Data of the segmentations, with one batched read per zarr array."""
+    groups = defaultdict(list)
+    for i, seg in enumerate(segmentations):
+        groups[(seg.groupname, seg.dtype, seg.shape)].append(i)
+
+    data: List[Optional[np.ndarray]] = [None] * len(segmentations)
+    for (group_name, dtype, shape), positions in groups.items():
+        arrays = storage_manager.read_batch(
+            group_name, dtype, shape, [segmentations[i].ZarrArrayIndex for i in positions]
+        )
+        for i, array in zip(positions, arrays):
+            data[i] = array
+    return data
+
+
+LABEL_REPRESENTATIONS = (DataRepresentation.MultiLabel, DataRepresentation.MultiClass)
+
+
+def segmentation_mask(segmentation, data: np.ndarray) -> np.ndarray:
+    """Binary mask (H, W) of a 2D segmentation with data of shape (1, H, W)."""
+    if data.shape[0] != 1:
+        raise ValueError(f"Expected a 2D segmentation, got shape {data.shape}")
+    data = data[0]
+    representation = segmentation.DataRepresentation
+    if representation == DataRepresentation.Binary:
+        return data > 0
+    if representation == DataRepresentation.DualBitMask:
+        return (data & 1) > 0
+    if representation == DataRepresentation.Probability:
+        threshold = segmentation.Threshold if segmentation.Threshold is not None else 0.5
+        if segmentation.DataType == Datatype.R8:
+            # stored as uint8, interpreted as [0, 1]
+            data = data / 255
+        return data >= threshold
+    raise ValueError(f"Unsupported data representation: {representation}")
+
+
+def summary_rows(image_id: int, summaries: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Rows (one per feature and field) of the combined table for the summaries of a report."""
+    rows = []
+    for feature_name, summary in summaries.items():
+        by_field: Dict[str, Dict[str, Any]] = {}
+        for key, value in summary.items():
+            field, measurement = key.rsplit("_", 1)
+            by_field.setdefault(field, {})[measurement] = value
+        for field, values in by_field.items():
+            rows.append(
+                {"ImageInstanceID": image_id, "Feature": feature_name, "Field": field, **values}
+            )
+    return rows
+
+
+def _load_summaries(path: Path) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Summaries of an existing report.json, None if missing or incomplete."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _create_report(instance_report, feature_images, label_images, results_folder, export_html):
+    report = instance_report.create_report(feature_images, label_images)
+    instance_report.export_report(report, results_folder, export_html=export_html)
+    return report.summaries
+
+
+def run_etdrs_reports(
+    session,
+    features: Sequence[str],
+    results_folder: str | Path,
+    project_id: Optional[int] = None,
+    tag: Optional[str] = None,
+    source: str = "model",
+    n_jobs: int = 8,
+    batch_size: int = 32,
+    export_html: bool = True,
+    overwrite: bool = False,
+    fovea_tolerance: float = FOVEA_TOLERANCE,
+) -> pd.DataFrame:
+    """
+    Create the ETDRS reports of the selected images and write the combined table. The fovea is
+    rounded to multiples of fovea_tolerance pixels (0: exact).
+
+    Returns the combined table (also written to results_folder/etdrs_report.parquet).
+    """
+    results_folder = Path(results_folder)
+    results_folder.mkdir(parents=True, exist_ok=True)
+    segmentations = select_segmentations(session, features, project_id, tag, source)
+    # labels of MultiLabel / MultiClass segmentations: {feature: {subfeature: label value}}
+    feature_labels = {}
+    for feature_name in features:
+        feature = Feature.by_name(session, feature_name)
+        if feature is not None:
+            feature_labels[feature_name] = subfeature_labels(feature)
+
+    rows: List[Dict[str, Any]] = []
+    todo = []
+    for image_id in sorted(segmentations):
+        summaries = None if overwrite else _load_summaries(
+            results_folder / str(image_id) / "report.json"
+        )
+        if summaries is None:
+            todo.append(image_id)
+        else:
+            rows.extend(summary_rows(image_id, summaries))
+    print(
+        f"Found {len(segmentations)} images, {len(segmentations) - len(todo)} reports already exist"
+    )
+
+    storage_manager = session.storage_manager
+    failures = 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor, tqdm(total=len(todo)) as pbar:
+        pending = []
+
+        def collect(image_id, future):
+            nonlocal failures
+            try:
+                rows.extend(summary_rows(image_id, future.result()))
+            except Exception as e:
+                failures += 1
+                print(f"Error creating report for image {image_id}: {e}")
+            pbar.update(1)
+
+        for start in range(0, len(todo), batch_size):
+            image_ids = todo[start : start + batch_size]
+            instances = {
+                instance.ImageInstanceID: instance
+                for instance in session.scalars(
+                    select(ImageInstance).where(ImageInstance.ImageInstanceID.in_(image_ids))
+                )
+            }
+            items = [
+                (image_id, feature_name, seg)
+                for image_id in image_ids
+                for feature_name, seg in segmentations[image_id].items()
+            ]
+            data = read_segmentations(storage_manager, [seg for _, _, seg in items])
+            feature_data = defaultdict(list)
+            for (image_id, feature_name, seg), array in zip(items, data):
+                feature_data[image_id].append((feature_name, seg, array))
+
+            for image_id in image_ids:
+                try:
+                    instance_report = InstanceReport(instances[image_id], fovea_tolerance)
+                    feature_images, label_images = {}, []
+                    for feature_name, seg, array in feature_data[image_id]:
+                        if array.shape[1:] != (instance_report.h, instance_report.w):
+                            raise ValueError(
+                                f"Segmentation shape {array.shape} of {feature_name} does not match the image"
+                            )
+                        if seg.DataRepresentation in LABEL_REPRESENTATIONS:
+                            if array.shape[0] != 1:
+                                raise ValueError(f"Expected a 2D segmentation, got shape {array.shape}")
+                            label_images.append(
+                                (array[0], feature_labels[feature_name], seg.DataRepresentation.value)
+                            )
+                        else:
+                            feature_images[feature_name] = segmentation_mask(seg, array)
+                except Exception as e:
+                    failures += 1
+                    print(f"Skipping image {image_id}: {e}")
+                    pbar.update(1)
+                    continue
+                future = executor.submit(
+                    _create_report,
+                    instance_report,
+                    feature_images,
+                    label_images,
+                    str(results_folder),
+                    export_html,
+                )
+                pending.append((image_id, future))
+
+            # keep one batch in flight while the next batch is read
+            while len(pending) > batch_size:
+                collect(*pending.pop(0))
+
+        for image_id, future in pending:
+            collect(image_id, future)
+
+    df = pd.DataFrame(rows)
+    df.to_parquet(results_folder / "etdrs_report.parquet", index=False)
+    print(f"Created {len(todo) - failures} reports, {failures} failures")
+    return df
@@ -1,9 +1,241 @@
+import math
 import numpy as np
-from functools import cached_property
+from functools import cached_property, lru_cache
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage import measure
 import uuid
 
 
+# The grid is partitioned into 13 atoms: 0 = outside the grid, 1 + 4 * ring + quadrant inside the grid
+# with ring 0/1/2 = center/inner/outer and quadrant 0/1/2/3 = superior/nasal/inferior/temporal.
+# Every field is a union of atoms.
+N_ATOMS = 13
+
+
+def _atoms(rings=(0, 1, 2), quadrants=(0, 1, 2, 3)):
+    return tuple(1 + 4 * r + q for r in rings for q in quadrants)
+
+
+FIELD_ATOMS = {
+    'CSF': _atoms(rings=(0,)),
+    'SIM': _atoms(rings=(1,), quadrants=(0,)),
+    'NIM': _atoms(rings=(1,), quadrants=(1,)),
+    'TIM': _atoms(rings=(1,), quadrants=(3,)),
+    'IIM': _atoms(rings=(1,), quadrants=(2,)),
+    'SOM': _atoms(rings=(2,), quadrants=(0,)),
+    'NOM': _atoms(rings=(2,), quadrants=(1,)),
+    'TOM': _atoms(rings=(2,), quadrants=(3,)),
+    'IOM': _atoms(rings=(2,), quadrants=(2,)),
+    'center': _atoms(rings=(0,)),
+    'inner': _atoms(rings=(1,)),
+    'outer': _atoms(rings=(2,)),
+    'superior_grid': _atoms(quadrants=(0,)),
+    'nasal_grid': _atoms(quadrants=(1,)),
+    'inferior_grid': _atoms(quadrants=(2,)),
+    'temporal_grid': _atoms(quadrants=(3,)),
+    'grid': _atoms(),
+    'total': (0, *_atoms()),
+}
+
+# radius of the grid in mm
+GRID_RADIUS = 3
+
+# number of grid label maps kept in memory
+GRID_CACHE_SIZE = 64
+
+
+def _field_labels(dx, dy, laterality):
+    '''
+    Atom (see FIELD_ATOMS) for offsets dx, dy (in mm) from the fovea
+    '''
+    d = np.sqrt(dx * dx + dy * dy)
+    theta = np.arctan2(dy, dx) / (2 * np.pi)
+    inferior = (1/8 < theta) & (theta <= 3/8)
+    left = (3/8 < theta) | (theta <= -3/8)
+    superior = (- 3/8 < theta) & (theta <= -1/8)
+    right = (-1/8 < theta) & (theta <= 1/8)
+    nasal = right if laterality == 'R' else left
+
+    ring = np.select([d < 0.5, d < 1.5, d < GRID_RADIUS], [0, 1, 2], default=-1)
+    quadrant = np.select([superior, nasal, inferior], [0, 1, 2], default=3)
+    return np.where(ring >= 0, 1 + 4 * ring + quadrant, 0).astype(np.uint8)
+
+
+@lru_cache(maxsize=GRID_CACHE_SIZE)
+def grid_labels(offset_x, offset_y, resolution_x, resolution_y, laterality):
+    '''
+    Label map of the bounding box of the grid, for a fovea at offset (offset_x, offset_y) in [0, 1)
+    from the center pixel of the map. The map does not depend on the position of the fovea in
+    the image otherwise, so it is shared (cached) between images with the same geometry.
+
+    Returns the (read-only) label map and the index of its center pixel (cx, cy).
+    '''
+    rx = math.ceil(GRID_RADIUS / resolution_x) + 1
+    ry = math.ceil(GRID_RADIUS / resolution_y) + 1
+    dx = (np.arange(2 * rx + 1)[None, :] - rx - offset_x) * resolution_x
+    dy = (np.arange(2 * ry + 1)[:, None] - ry - offset_y) * resolution_y
+    labels = _field_labels(dx, dy, laterality)
+    labels.setflags(write=False)
+    return labels, (rx, ry)
+
+
+def subfeature_labels(feature):
+    '''
+    Label values of the subfeatures of a MultiLabel / MultiClass feature: {name: value}.
+
+    Subfeatures are stored with a 0-based FeatureIndex, the subfeature with index i has label
+    value i + 1 (class i + 1 or bit i, see ETDRS_masks.get_label_summary).
+    '''
+    return {name: index + 1 for index, name in feature.subfeatures.items()}
+
+
+def check_label_values(values):
+    '''
+    Raise if a label value is below 1 (value 0 is the background of a MultiClass image and has
+    no bit in a MultiLabel image)
+    '''
+    invalid = [int(v) for v in np.atleast_1d(values) if v < 1]
+    if invalid:
+        raise ValueError(f'Label values must be at least 1, got {invalid} (see subfeature_labels)')
+
+
+def label_mask(label_image, value, representation):
+    '''
+    Binary image of label value in a packed label image (see ETDRS_masks.get_label_summary)
+    '''
+    check_label_values(value)
+    representation = getattr(representation, 'value', representation)
+    if representation == 'MultiLabel':
+        return (label_image >> (value - 1)) & 1 > 0
+    return label_image == value
+
+
+def component_graph(key_image, linked=None):
+    '''
+    Connected components of pixels with the same (non zero) key.
+
+    Returns the size and key of every component (index 0 is the background) and the unique
+    pairs of touching components (8-connectivity, as measure.label). If given, only the pixel
+    pairs for which linked(first, second) is True are used, with first and second the slices
+    of the two pixels of each pair.
+    '''
+    components = measure.label(key_image, background=0)
+    n = int(components.max())
+    sizes = np.bincount(components.ravel(), minlength=n + 1)
+    keys = np.zeros(n + 1, dtype=key_image.dtype)
+    keys[components.ravel()] = key_image.ravel()
+
+    pairs = []
+    for first, second in (
+        (np.s_[:, :-1], np.s_[:, 1:]),
+        (np.s_[:-1, :], np.s_[1:, :]),
+        (np.s_[:-1, :-1], np.s_[1:, 1:]),
+        (np.s_[:-1, 1:], np.s_[1:, :-1]),
+    ):
+        a, b = components[first], components[second]
+        touching = (a != b) & (a > 0) & (b > 0)
+        if linked is not None:
+            touching &= linked(first, second)
+        # encode the pairs as one integer, to find the unique pairs
+        pairs.append(a[touching].astype(np.int64) * (n + 1) + b[touching])
+    pairs = np.unique(np.concatenate(pairs))
+    edges = np.stack([pairs // (n + 1), pairs % (n + 1)], axis=1)
+    return sizes, keys, edges
+
+
+def merged_components(sizes, nodes, edges):
+    '''
+    Number and size of the largest of the connected components formed by the components in
+    nodes (boolean mask) that touch (edges)
+    '''
+    if not nodes.any():
+        return 0, 0
+    edges = edges[nodes[edges[:, 0]] & nodes[edges[:, 1]]]
+    if len(edges) == 0:
+        return int(nodes.sum()), int(sizes[nodes].max())
+    # graph of the nodes only
+    index = np.cumsum(nodes) - 1
+    n = int(nodes.sum())
+    graph = coo_matrix(
+        (np.ones(len(edges)), (index[edges[:, 0]], index[edges[:, 1]])),
+        shape=(n, n),
+    )
+    n_merged, merged = connected_components(graph, directed=False)
+    merged_sizes = np.bincount(merged, weights=sizes[nodes], minlength=n_merged)
+    return n_merged, int(merged_sizes.max())
+
+
+def label_field_stats(label_image, atoms, values, representation, fields, components=True):
+    '''
+    Area, number of components and largest component (in pixels) per label value and field of
+    a packed label image (see ETDRS_masks.get_label_summary), atoms is the atom of every pixel.
+
+    Pixels are keyed by (pattern, atom), with pattern the relevant labels of the pixel. One
+    labeling gives the components with equal keys. For each label and field, the components
+    that have the label and lie in the field are merged where they touch; their sizes give the
+    areas.
+
+    Returns {field: (areas, counts, largest)} with arrays of the length of values.
+    '''
+    pattern = label_image.astype(np.int64)
+    if representation == 'MultiLabel':
+        mask = np.bitwise_or.reduce(np.left_shift(1, values - 1)) if len(values) else 0
+        pattern &= mask
+    else:
+        pattern[~np.isin(pattern, values)] = 0
+    key_image = np.where(pattern > 0, pattern * N_ATOMS + atoms + 1, 0)
+
+    empty = np.zeros(len(values), dtype=np.int64)
+    if not key_image.any():
+        return {field: (empty, empty, empty) for field in fields}
+    if components:
+        # components can only merge if they share a label
+        if representation == 'MultiLabel':
+            def linked(first, second):
+                return pattern[first] & pattern[second] > 0
+        else:
+            def linked(first, second):
+                return pattern[first] == pattern[second]
+        sizes, keys, edges = component_graph(key_image, linked)
+    else:
+        # only areas: the number of pixels per key
+        keys, sizes = np.unique(key_image, return_counts=True)
+        if keys[0] != 0:
+            keys, sizes = np.concatenate([[0], keys]), np.concatenate([[0], sizes])
+
+    key_pattern = (keys - 1) // N_ATOMS
+    key_atom = (keys - 1) % N_ATOMS
+    if representation == 'MultiLabel':
+        has_label = (key_pattern[None, :] >> (values[:, None] - 1)) & 1 > 0
+    else:
+        has_label = key_pattern[None, :] == values[:, None]
+    has_label[:, 0] = False  # background
+
+    if components:
+        # touching components that share a label
+        label_edges = [
+            edges[label_nodes[edges[:, 0]] & label_nodes[edges[:, 1]]]
+            for label_nodes in has_label
+        ]
+
+    result = {}
+    for field in fields:
+        nodes = has_label & np.isin(key_atom, FIELD_ATOMS[field])[None, :]
+        areas = nodes @ sizes
+        if components:
+            stats = [
+                merged_components(sizes, label_nodes, edges)
+                for label_nodes, edges in zip(nodes, label_edges)
+            ]
+            counts = np.array([count for count, _ in stats], dtype=np.int64)
+            largest = np.array([size for _, size in stats], dtype=np.int64)
+        else:
+            counts = largest = empty
+        result[field] = (areas, counts, largest)
+    return result
+
+
 class ETDRS_masks:
 
     # naming convention: CSF = central subfield
@@ -15,7 +247,7 @@ class ETDRS_masks:
     quadrants = 'superior_grid', 'nasal_grid', 'inferior_grid', 'temporal_grid'
     all_fields = (*subfields_9, *rings_3, *quadrants, 'grid', 'total')
 
-    def __init__(self, h, w, fovea_x, fovea_y, resolution, laterality):
+    def __init__(self, h, w, fovea_x, fovea_y, resolution, laterality, fovea_tolerance=0):
         '''
         h: height of the image
         w: width of the image
@@ -25,6 +257,8 @@ class ETDRS_masks:
             or: (resolution_x, resolution_y)
 
         laterality: laterality of the eye, 'R' or 'L'
+        fovea_tolerance: the fovea is rounded to multiples of fovea_tolerance (in pixels) to
+            reuse cached grid label maps (default 0: no rounding, exact)
         '''
         self.h = h
         self.w = w
@@ -36,6 +270,7 @@ class ETDRS_masks:
             self.resolution_x = resolution
             self.resolution_y = resolution
         self.laterality = laterality
+        self.fovea_tolerance = fovea_tolerance
 
     @cached_property
     def aspect_ratio(self):
@@ -66,26 +301,176 @@ class ETDRS_masks:
                 result[f'{field}_count'] = 0
                 result[f'{field}_largest'] = 0.0
             return result
-            
-        masked_images = {
-            field: getattr(self, field) & binary_image
-            for field in fields
-        }
+
+        binary_image = np.asarray(binary_image, dtype=bool)
+
+        # all fields but total are computed on the bounding box of the grid
+        (ys, xs), labels = self.roi
+        roi_image = binary_image[ys, xs]
+        grid_fields = [field for field in fields if field != 'total']
+        if include_area:
+            atom_areas = np.bincount(labels[roi_image], minlength=N_ATOMS)
+            atom_areas[0] = 0  # outside the grid
+        if include_count or include_largest:
+            components = self.field_components(roi_image, labels, grid_fields)
+            if 'total' in fields:
+                components['total'] = self.total_components(binary_image)
+
         result = {}
-        for field, masked_image in masked_images.items():
+        for field in fields:
             if include_area:
-                result[f'{field}_area'] = self.calculate_area(masked_image)
-            if include_largest or include_count:
-                labeled_image = measure.label(masked_image)
+                if field == 'total':
+                    area = int(np.count_nonzero(binary_image))
+                else:
+                    area = int(atom_areas[list(FIELD_ATOMS[field])].sum())
+                result[f'{field}_area'] = float(area * self.pixel_area)
+            if include_count:
+                result[f'{field}_count'] = components[field][0]
+            if include_largest:
+                result[f'{field}_largest'] = components[field][1] * self.pixel_area
+
+        return result
+
+    @staticmethod
+    def total_components(binary_image):
+        '''
+        Number of connected components and area (in pixels) of the largest component of binary_image
+        '''
+        if not binary_image.any():
+            return 0, 0
+        labeled_image = measure.label(binary_image)
+        sizes = np.bincount(labeled_image.ravel())
+        return len(sizes) - 1, int(sizes[1:].max())
+
+    @staticmethod
+    def field_components(binary_image, labels, fields):
+        '''
+        Number of connected components and area (in pixels) of the largest component of
+        binary_image within each field, as if binary_image & field were labeled separately.
+
+        The image is labeled once with components restricted to a single atom. Components of a
+        field are then the atom components of the field, merged where they touch.
+        '''
+        if not binary_image.any():
+            return {field: (0, 0) for field in fields}
+
+        # +1 so that the atom outside the grid is not background
+        atom_image = np.where(binary_image, labels.astype(np.int16) + 1, 0)
+        sizes, keys, edges = component_graph(atom_image)
+        component_atom = keys - 1
+
+        result = {}
+        for field in fields:
+            in_field = np.isin(component_atom, FIELD_ATOMS[field])
+            in_field[0] = False
+            result[field] = merged_components(sizes, in_field, edges)
+        return result
+
+    def get_label_summary(self, label_image, labels, representation, fields,
+                          include_area=True, include_count=True, include_largest=True):
+        '''
+        Summaries of all labels of a packed label image, the same as get_summary of the binary
+        image of each label, computed in one pass.
+
+        label_image: integer image (h, w)
+        labels: {name: value} with the values as in the viewer: a pixel has label value v if
+            its value is v (MultiClass) or if bit v - 1 is set (MultiLabel). Values start at 1,
+            see subfeature_labels for the values of the subfeatures of a feature.
+        representation: 'MultiLabel' or 'MultiClass' (or DataRepresentation)
+
+        Returns {name: summary}
+        '''
+        representation = getattr(representation, 'value', representation)
+        if representation not in ('MultiLabel', 'MultiClass'):
+            raise ValueError(f'Unsupported representation: {representation}')
+        label_image = np.asarray(label_image)
+        names = list(labels)
+        values = np.array([labels[name] for name in names], dtype=np.int64)
+        check_label_values(values)
+
+        # all fields but total are computed on the bounding box of the grid
+        (ys, xs), roi_labels = self.roi
+        grid_fields = [field for field in fields if field != 'total']
+        components = include_count or include_largest
+        stats = {}
+        if grid_fields:
+            stats.update(label_field_stats(
+                label_image[ys, xs], roi_labels, values, representation, grid_fields, components))
+        if 'total' in fields:
+            # a single atom (0) for the whole image
+            atoms = np.zeros(label_image.shape, dtype=np.uint8)
+            stats.update(label_field_stats(
+                label_image, atoms, values, representation, ['total'], components))
+
+        result = {}
+        for i, name in enumerate(names):
+            summary = {}
+            for field in fields:
+                areas, counts, largest = stats[field]
+                if include_area:
+                    summary[f'{field}_area'] = float(areas[i] * self.pixel_area)
                 if include_count:
-                    result[f'{field}_count'] = self._calculate_count(
-                        labeled_image)
+                    summary[f'{field}_count'] = int(counts[i])
                 if include_largest:
-                    result[f'{field}_largest'] = self.calculate_largest_area(
-                        labeled_image)
+                    summary[f'{field}_largest'] = int(largest[i]) * self.pixel_area
+            result[name] = summary
+        return result
 
+    def get_thickness_summary(self, thickness_map, fields):
+        '''
+        Mean thickness (mm) and volume (mm³) per field of an enface thickness map (in mm).
+        Fields without pixels in the map have a thickness of nan.
+        '''
+        (ys, xs), labels = self.roi
+        roi_map = np.asarray(thickness_map, dtype=np.float64)[ys, xs]
+        sums = np.bincount(labels.ravel(), weights=roi_map.ravel(), minlength=N_ATOMS)
+        counts = np.bincount(labels.ravel(), minlength=N_ATOMS)
+
+        result = {}
+        for field in fields:
+            if field == 'total':
+                total = float(np.sum(thickness_map, dtype=np.float64))
+                count = int(np.size(thickness_map))
+            else:
+                atoms = list(FIELD_ATOMS[field])
+                total = float(sums[atoms].sum())
+                count = int(counts[atoms].sum())
+            result[f'{field}_thickness'] = total / count if count else float('nan')
+            result[f'{field}_volume'] = total * self.pixel_area
         return result
 
+    @cached_property
+    def roi(self):
+        '''
+        Slices (ys, xs) of the bounding box of the grid within the image and the (cached)
+        label map of the grid cropped to it
+        '''
+        fovea_x, fovea_y = self.fovea_x, self.fovea_y
+        if self.fovea_tolerance:
+            fovea_x = round(fovea_x / self.fovea_tolerance) * self.fovea_tolerance
+            fovea_y = round(fovea_y / self.fovea_tolerance) * self.fovea_tolerance
+        x, y = math.floor(fovea_x), math.floor(fovea_y)
+        labels, (cx, cy) = grid_labels(
+            fovea_x - x, fovea_y - y, self.resolution_x, self.resolution_y, self.laterality
+        )
+        # position of the label map in the image, clipped to the image
+        x0, y0 = x - cx, y - cy
+        x1, y1 = x0 + labels.shape[1], y0 + labels.shape[0]
+        xs = slice(min(max(x0, 0), self.w), min(max(x1, 0), self.w))
+        ys = slice(min(max(y0, 0), self.h), min(max(y1, 0), self.h))
+        labels = labels[ys.start - y0: ys.stop - y0, xs.start - x0: xs.stop - x0]
+        return (ys, xs), labels
+
+    @property
+    def field_labels(self):
+        '''
+        Atom of every pixel (see FIELD_ATOMS): 0 outside the grid, 1 + 4 * ring + quadrant inside
+        '''
+        (ys, xs), labels = self.roi
+        field_labels = np.zeros((self.h, self.w), dtype=np.uint8)
+        field_labels[ys, xs] = labels
+        return field_labels
+
     @cached_property
     def dy(self):
         return np.arange(self.h)[:, None] - self.fovea_y
@@ -11,10 +11,10 @@ from eyened_orm.reports import Report
 # Read relevant database fields from ImageInstance to create the report
 # The original instance is then no longer needed, so this object can be used in multiprocessing pool
 class InstanceReport:
-    def __init__(self, instance: ImageInstance):
+    def __init__(self, instance: ImageInstance, fovea_tolerance: float = 0):
         self.image_id = instance.ImageInstanceID
-        self.path = instance.path
-        self.etdrs = instance.ETDRS_masks()
+        self.path = str(instance.path)
+        self.etdrs = instance.ETDRS_masks(fovea_tolerance)
         self.h = instance.Rows_y
         self.w = instance.Columns_x
 
@@ -25,11 +25,11 @@ class InstanceReport:
         else:
             return np.array(Image.open(self.path))
 
-    def create_report(self, feature_images):
-        return Report(feature_images, self.etdrs, self.etdrs.all_fields)
+    def create_report(self, feature_images, label_images=()):
+        return Report(feature_images, self.etdrs, self.etdrs.all_fields, label_images)
 
-    def export_report(self, report, results_folder):
+    def export_report(self, report, results_folder, export_html=True, export_json=True):
         output_folder = f"{results_folder}/{self.image_id}"
         os.makedirs(output_folder, exist_ok=True)
-        image = self.load_image()
-        report.export(output_folder, image, self.image_id)
+        image = self.load_image() if export_html else None
+        report.export(output_folder, image, self.image_id, export_html, export_json)
@@ -4,6 +4,8 @@ from PIL import Image
 import io
 import base64
 
+from .etdrs_masks import label_mask
+
 _style = '''
 <style>
 table {
@@ -89,8 +91,14 @@ def make_img(img, size=(384, 384)):
 
 class Report:
 
-    def __init__(self, feature_images, etdrs, field_names):
+    def __init__(self, feature_images, etdrs, field_names, label_images=()):
+        '''
+        feature_images: {feature_name: binary image}
+        label_images: packed label images (MultiLabel / MultiClass) as
+            (label_image, {feature_name: label value}, representation), see ETDRS_masks.get_label_summary
+        '''
         self.feature_images = feature_images
+        self.label_images = label_images
         self.etdrs = etdrs
         self.field_names = field_names
         self.make_summary()
@@ -100,6 +108,10 @@ class Report:
             feature_name: self.etdrs.get_summary(img, self.field_names)
             for feature_name, img in self.feature_images.items()
         }
+        for label_image, labels, representation in self.label_images:
+            self.summaries.update(
+                self.etdrs.get_label_summary(label_image, labels, representation, self.field_names)
+            )
 
     def export_html(self, filename, image, name):
         html = self.generate_html_report(image, name)
@@ -178,7 +190,12 @@ class Report:
 
         overlays = {}
 
-        for feature_name, img in self.feature_images.items():
+        feature_images = dict(self.feature_images)
+        for label_image, labels, representation in self.label_images:
+            for feature_name, value in labels.items():
+                feature_images[feature_name] = label_mask(label_image, value, representation)
+
+        for feature_name, img in feature_images.items():
             a = np.copy(image)
             if img is not None:
                 a[img] = 255
@@ -0,0 +1,317 @@
+"""
+ETDRS layer thickness of OCT volumes (see eorm oct-thickness).
+
+A layer segmentation of shape (B-scans, axial, width) is reduced along the axial axis to an
+enface thickness map per layer (number of layer pixels * ResolutionAxial, in mm), which is
+aggregated per ETDRS field (mean thickness in mm and volume in mm³). The grid is centered on
+the latest annotated fovea segmentation of the volume, or on the center of the volume if there
+is none.
+
+Volumes are reduced in a process pool; each worker reads its volume from the zarr store slab by
+slab (slab_size B-scans) and reduces each slab before reading the next, so a worker holds one
+slab and the enface maps instead of the whole volume. The store has one chunk per segmentation,
+so every slab read decodes that chunk again (transiently) and larger slabs read faster.
+The results are stored as AttributeValues of the THICKNESS_MODEL model, with attributes named
+<layer>_<field>_thickness and <layer>_<field>_volume.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from tqdm import tqdm
+
+from eyened_orm import Feature, ImageInstance
+from eyened_orm.attributes import AttributesModel
+from eyened_orm.segmentation import DataRepresentation, Datatype
+from eyened_orm.utils.bulk import upsert_attribute_values
+from eyened_orm.utils.zarr.manager import ZarrStorageManager
+
+from .batch import select_segmentations
+from .etdrs_masks import ETDRS_masks, label_mask, subfeature_labels
+
+THICKNESS_MODEL = "ETDRS thickness"
+THICKNESS_VERSION = "1"
+
+THICKNESS_FIELDS = (*ETDRS_masks.subfields_9, *ETDRS_masks.rings_3, 'grid')
+
+LAYER_REPRESENTATIONS = (
+    DataRepresentation.Binary,
+    DataRepresentation.Probability,
+    DataRepresentation.MultiLabel,
+    DataRepresentation.MultiClass,
+)
+
+
+def layer_mask(slab, value, representation, threshold=None, data_type=None):
+    """Binary mask of a layer (value) in a slab of a layer segmentation."""
+    if representation == DataRepresentation.Binary:
+        return slab > 0
+    if representation == DataRepresentation.Probability:
+        if threshold is None:
+            threshold = 0.5
+        if data_type == Datatype.R8:
+            # stored as uint8, interpreted as [0, 1]
+            threshold = threshold * 255
+        return slab >= threshold
+    return label_mask(slab, value, representation)
+
+
+class ZarrVolume:
+    """
+    A segmentation of shape (B-scans, axial, width) in a zarr array, read from the array when it
+    is sliced (along the B-scans).
+    """
+
+    def __init__(self, storage_manager: ZarrStorageManager, group_name, dtype, shape, zarr_index):
+        self.array = storage_manager.get_array(group_name, dtype, shape).array
+        if zarr_index is None or zarr_index >= self.array.shape[0]:
+            raise IndexError(
+                f"Invalid zarr_index: {zarr_index}. Array length: {self.array.shape[0]}"
+            )
+        self.zarr_index = zarr_index
+        self.shape = tuple(shape)
+
+    def __getitem__(self, bscans: slice) -> np.ndarray:
+        return self.array[self.zarr_index, bscans]
+
+
+def thickness_maps(
+    volume,
+    resolution_axial: float,
+    layers: Dict[str, Optional[int]],
+    representation: DataRepresentation,
+    threshold: Optional[float] = None,
+    data_type: Optional[Datatype] = None,
+    slab_size: int = 16,
+) -> Dict[str, np.ndarray]:
+    """
+    Enface thickness maps (B-scans, width) in mm of the layers ({name: label value}) of a layer
+    segmentation of shape (B-scans, axial, width), read and reduced slab_size B-scans at a time
+    (volume is a numpy array or a ZarrVolume).
+    """
+    n_bscans, _, width = volume.shape
+    counts = {name: np.zeros((n_bscans, width), dtype=np.int32) for name in layers}
+    for start in range(0, n_bscans, slab_size):
+        slab = volume[start : start + slab_size]
+        for name, value in layers.items():
+            mask = layer_mask(slab, value, representation, threshold, data_type)
+            counts[name][start : start + slab_size] = mask.sum(axis=1)
+    return {name: count * resolution_axial for name, count in counts.items()}
+
+
+def fovea_location(fovea, n_bscans: int, width: int, slab_size: int = 16) -> Tuple[float, float]:
+    """
+    Enface location (x, B-scan) of the fovea: center of gravity of a fovea segmentation (numpy
+    array or ZarrVolume, read slab_size B-scans at a time) or the center of the volume.
+    """
+    if fovea is not None:
+        n, sum_x, sum_bscan = 0, 0.0, 0.0
+        for start in range(0, n_bscans, slab_size):
+            bscans, _, xs = np.nonzero(fovea[start : start + slab_size])
+            n += len(xs)
+            sum_x += xs.sum()
+            sum_bscan += (bscans + start).sum()
+        if n:
+            return float(sum_x / n), float(sum_bscan / n)
+    return (width - 1) / 2, (n_bscans - 1) / 2
+
+
+_storage_managers: Dict[str, ZarrStorageManager] = {}
+
+
+def _storage_manager(store_path) -> ZarrStorageManager:
+    """Storage manager of the worker process (opened once per process)."""
+    store_path = str(store_path)
+    if store_path not in _storage_managers:
+        _storage_managers[store_path] = ZarrStorageManager(store_path)
+    return _storage_managers[store_path]
+
+
+def _zarr_location(segmentation) -> Tuple[str, np.dtype, tuple, int]:
+    return segmentation.groupname, segmentation.dtype, segmentation.shape, segmentation.ZarrArrayIndex
+
+
+def measure_volume(task: Dict[str, Any]) -> Dict[str, float]:
+    """Thickness and volume per layer and ETDRS field of one volume (see run_oct_thickness)."""
+    storage_manager = _storage_manager(task["store_path"])
+    maps = thickness_maps(
+        ZarrVolume(storage_manager, *task["layers_location"]),
+        task["resolution_axial"],
+        task["layers"],
+        task["representation"],
+        task["threshold"],
+        task["data_type"],
+        task["slab_size"],
+    )
+
+    n_bscans, _, width = task["layers_location"][2]
+    fovea = None
+    if task["fovea_location"] is not None:
+        fovea = ZarrVolume(storage_manager, *task["fovea_location"])
+        if fovea.shape != task["layers_location"][2]:
+            raise ValueError(f"Fovea segmentation shape {fovea.shape} does not match the layers")
+    fovea_x, fovea_y = fovea_location(fovea, n_bscans, width, task["slab_size"])
+
+    etdrs = ETDRS_masks(
+        n_bscans, width, fovea_x, fovea_y, task["resolution"], task["laterality"]
+    )
+    row = {}
+    for name, thickness_map in maps.items():
+        for key, value in etdrs.get_thickness_summary(thickness_map, task["fields"]).items():
+            row[f"{name}_{key}"] = value
+    return row
+
+
+def get_thickness_model(session) -> AttributesModel:
+    """The AttributesModel of the thickness attributes, created if it does not exist."""
+    model = session.scalar(
+        select(AttributesModel).where(
+            AttributesModel.ModelName == THICKNESS_MODEL,
+            AttributesModel.Version == THICKNESS_VERSION,
+        )
+    )
+    if model is None:
+        model = AttributesModel(
+            ModelName=THICKNESS_MODEL,
+            Version=THICKNESS_VERSION,
+            Description="Mean thickness (mm) and volume (mm³) of OCT layers per ETDRS field",
+        )
+        session.add(model)
+        session.flush()
+    return model
+
+
+def _volume_task(instance, segmentation, fovea_segmentation, layers, fields, store_path, slab_size):
+    """Arguments of measure_volume for an image, checking its geometry."""
+    resolution = (instance.ResolutionHorizontal, instance.ResolutionVertical)
+    if instance.ResolutionAxial is None or None in resolution:
+        raise ValueError("Missing resolution")
+    if instance.Laterality is None:
+        raise ValueError("Missing laterality")
+    n_bscans, _, width = segmentation.shape
+    if n_bscans < 2:
+        raise ValueError(f"Expected a volume, got shape {segmentation.shape}")
+    return {
+        "store_path": store_path,
+        "layers_location": _zarr_location(segmentation),
+        "fovea_location": (
+            _zarr_location(fovea_segmentation) if fovea_segmentation is not None else None
+        ),
+        "layers": layers,
+        "representation": segmentation.DataRepresentation,
+        "threshold": segmentation.Threshold,
+        "data_type": segmentation.DataType,
+        "resolution_axial": instance.ResolutionAxial,
+        "resolution": resolution,
+        "laterality": instance.Laterality.value,
+        "fields": fields,
+        "slab_size": slab_size,
+    }
+
+
+def run_oct_thickness(
+    session,
+    feature: str,
+    project_id: Optional[int] = None,
+    tag: Optional[str] = None,
+    source: str = "model",
+    fovea_feature: Optional[str] = "Fovea",
+    fields: Sequence[str] = THICKNESS_FIELDS,
+    n_jobs: int = 8,
+    batch_size: int = 64,
+    slab_size: int = 16,
+) -> int:
+    """
+    Compute and store the ETDRS layer thickness of the OCT volumes with a segmentation of feature.
+
+    The layers are the subfeatures of a MultiClass or MultiLabel feature, or the feature itself
+    for a Binary or Probability segmentation. Results are committed per batch of batch_size
+    volumes. Returns the number of volumes measured.
+    """
+    segmentations = {
+        image_id: segs[feature]
+        for image_id, segs in select_segmentations(
+            session, [feature], project_id, tag, source
+        ).items()
+    }
+    fovea_segmentations = {}
+    if fovea_feature is not None:
+        fovea_segmentations = {
+            image_id: segs[fovea_feature]
+            for image_id, segs in select_segmentations(
+                session, [fovea_feature], project_id, tag, "annotation"
+            ).items()
+        }
+    feature_row = Feature.by_name(session, feature)
+    if feature_row is None:
+        raise ValueError(f"Feature not found: {feature}")
+    subfeatures = subfeature_labels(feature_row)
+    model = get_thickness_model(session)
+    store_path = session.storage_manager.store_path
+    print(
+        f"Found {len(segmentations)} segmentations of {feature}, "
+        f"{len(set(segmentations) & set(fovea_segmentations))} with a fovea segmentation"
+    )
+
+    image_ids = sorted(segmentations)
+    measured, failures = 0, 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor, tqdm(total=len(image_ids)) as pbar:
+        for start in range(0, len(image_ids), batch_size):
+            batch_ids = image_ids[start : start + batch_size]
+            instances = {
+                instance.ImageInstanceID: instance
+                for instance in session.scalars(
+                    select(ImageInstance).where(ImageInstance.ImageInstanceID.in_(batch_ids))
+                )
+            }
+            futures = []
+            for image_id in batch_ids:
+                segmentation = segmentations[image_id]
+                try:
+                    if segmentation.DataRepresentation not in LAYER_REPRESENTATIONS:
+                        raise ValueError(
+                            f"Unsupported data representation: {segmentation.DataRepresentation}"
+                        )
+                    if segmentation.DataRepresentation in (
+                        DataRepresentation.MultiClass,
+                        DataRepresentation.MultiLabel,
+                    ):
+                        layers = subfeatures
+                    else:
+                        layers = {feature: None}
+                    task = _volume_task(
+                        instances[image_id],
+                        segmentation,
+                        fovea_segmentations.get(image_id),
+                        layers,
+                        fields,
+                        store_path,
+                        slab_size,
+                    )
+                except Exception as e:
+                    failures += 1
+                    print(f"Skipping image {image_id}: {e}")
+                    pbar.update(1)
+                    continue
+                futures.append((image_id, executor.submit(measure_volume, task)))
+
+            rows: Dict[int, Dict[str, float]] = {}
+            for image_id, future in futures:
+                try:
+                    rows[image_id] = future.result()
+                except Exception as e:
+                    failures += 1
+                    print(f"Error measuring image {image_id}: {e}")
+                pbar.update(1)
+
+            if rows:
+                df = pd.DataFrame.from_dict(rows, orient="index")
+                upsert_attribute_values(session, df, model=model)
+                session.commit()
+                measured += len(rows)
+
+    print(f"Measured {measured} volumes, {failures} failures")
+    return measured
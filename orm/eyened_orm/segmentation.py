@@ -64,6 +64,15 @@ class Datatype(Enum):
     R32F = "R32F"  # 32-bit float
 
 
+DATATYPE_DTYPES: Dict[Datatype, np.dtype] = {
+    Datatype.R8: np.dtype(np.uint8),
+    Datatype.R8UI: np.dtype(np.uint8),
+    Datatype.R16UI: np.dtype(np.uint16),
+    Datatype.R32UI: np.dtype(np.uint32),
+    Datatype.R32F: np.dtype(np.float32),
+}
+
+
 class SegmentationBase(Base):
     __abstract__ = True  # This makes the class abstract
 
@@ -105,18 +114,9 @@ class SegmentationBase(Base):
 
     @property
     def dtype(self) -> np.dtype:
-        if self.DataType == Datatype.R8:
-            return np.dtype(np.uint8)
-        elif self.DataType == Datatype.R8UI:
-            return np.dtype(np.uint8)
-        elif self.DataType == Datatype.R16UI:
-            return np.dtype(np.uint16)
-        elif self.DataType == Datatype.R32UI:
-            return np.dtype(np.uint32)
-        elif self.DataType == Datatype.R32F:
-            return np.dtype(np.float32)
-        else:
+        if self.DataType not in DATATYPE_DTYPES:
             raise ValueError(f"Unsupported data type: {self.DataType}")
+        return DATATYPE_DTYPES[self.DataType]
 
     @property
     def shape(self) -> tuple[int, int, int]:
@@ -211,6 +211,20 @@ class SegmentationBase(Base):
             slice_index=slice_index,
         )
 
+    def warp_to(
+        self,
+        target: "ImageInstance",
+        schema_name: str = "RegistrationSet",
+        cache=None,
+    ) -> Optional[np.ndarray]:
+        """
+        Warp the (2D) segmentation onto a registered image of the same patient.
+        Returns None if the images are not registered, see utils/warping.py.
+        """
+        from eyened_orm.utils.warping import warp_segmentation
+
+        return warp_segmentation(self.session, self, target, schema_name, cache)
+
     @property
     def shape_matches_image_shape(self):
         image_shape = self.ImageInstance.shape
@@ -502,15 +516,19 @@ class ModelSegmentation(SegmentationBase):
         lazy="selectin",
     )
 
+    @staticmethod
+    def model_groupname(model: "Model") -> str:
+        return f"model_{model.ModelName}_{model.Version}"
+
     @property
     def groupname(self) -> str:
         model = self.Model
         if model is not None:
-            return f"model_{model.ModelName}_{model.Version}"
+            return self.model_groupname(model)
         # Fallback: query base Model directly by ID
         sess = object_session(self)
         if sess is not None:
             base_model = sess.get(Model, getattr(self, "ModelID", None))
             if base_model is not None:
-                return f"model_{base_model.ModelName}_{base_model.Version}"
+                return self.model_groupname(base_model)
         return "model_name_unknown"
@@ -68,6 +68,13 @@ class Study(Base):
             )
         )
 
+    def get_series_by_uid(self, series_instance_uid: str) -> Optional["Series"]:
+        """Return the series of this study with the given SeriesInstanceUid."""
+        return next(
+            (series for series in self.Series if series.SeriesInstanceUid == series_instance_uid),
+            None,
+        )
+
     @property
     def age_years(self) -> float | None:
         if self.StudyDate is None or self.Patient.BirthDate is None:
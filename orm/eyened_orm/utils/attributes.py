@@ -35,15 +35,9 @@ def _infer_column_type(col: pd.Series) -> AttributeDataType:
     return AttributeDataType.String
 
 
-def df_to_attributes(db: Session, df: pd.DataFrame, *, model_name: str, version: str) -> List[AttributeValue]:
-    """Convert a DataFrame to AttributeDefinition and AttributeValue objects for a model; return the AttributeValue objects touched."""
-    model = db.scalar(select(Model).where(Model.ModelName == model_name, Model.Version == version))
-    if not model:
-        raise ValueError(f"Model not found: {model_name} / {version}")
-
+def get_attribute_definitions(db: Session, df: pd.DataFrame, model: Model) -> Dict[str, AttributeDefinition]:
+    """Get or create the AttributeDefinitions for the columns of df (types inferred from the dtypes) and link them to the model."""
     cols = list(df.columns)
-    if not cols:
-        return []
 
     # infer types using pandas dtype
     col_types = {col: _infer_column_type(df[col]) for col in cols}
@@ -79,6 +73,21 @@ def df_to_attributes(db: Session, df: pd.DataFrame, *, model_name: str, version:
         if not existing_link:
             db.add(AttributesModelOutput(ModelID=model.ModelID, AttributeID=attr.AttributeID))
 
+    return attrs_by_name
+
+
+def df_to_attributes(db: Session, df: pd.DataFrame, *, model_name: str, version: str) -> List[AttributeValue]:
+    """Convert a DataFrame to AttributeDefinition and AttributeValue objects for a model; return the AttributeValue objects touched."""
+    model = db.scalar(select(Model).where(Model.ModelName == model_name, Model.Version == version))
+    if not model:
+        raise ValueError(f"Model not found: {model_name} / {version}")
+
+    cols = list(df.columns)
+    if not cols:
+        return []
+
+    attrs_by_name = get_attribute_definitions(db, df, model)
+
     # load images
     image_ids: List[int] = []
     idx_values: List[Any] = []
@@ -0,0 +1,221 @@
+"""
+Bulk writers for model outputs.
+
+write_model_segmentations stores the outputs of a segmentation model for a batch of images:
+the arrays are stacked and appended to the zarr array of the model in a single resize and
+write, and the ModelSegmentation rows are inserted with a single executemany.
+
+upsert_attribute_values stores a DataFrame of (scalar) model outputs as AttributeValues
+with executemany INSERT ... ON DUPLICATE KEY UPDATE, without loading or creating ORM objects.
+It is the bulk equivalent of df_to_attributes.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+from eyened_orm.attributes import AttributeDataType, AttributeValue
+from eyened_orm.segmentation import (
+    DATATYPE_DTYPES,
+    DataRepresentation,
+    Datatype,
+    Model,
+    ModelSegmentation,
+)
+from eyened_orm.utils.attributes import get_attribute_definitions
+from eyened_orm.utils.zarr.manager import ZarrStorageManager
+
+# number of rows per executemany
+CHUNK_SIZE = 10000
+
+ENTITY_COLUMNS = (
+    "ImageInstanceID",
+    "SegmentationID",
+    "ModelSegmentationID",
+    "PatientID",
+    "StudyID",
+)
+
+
+def write_model_segmentations(
+    session: Session,
+    model: Model,
+    image_ids: Sequence[int],
+    data: Union[np.ndarray, Sequence[np.ndarray]],
+    data_representation: DataRepresentation,
+    data_type: Datatype,
+    threshold: Optional[float] = None,
+    sparse_axis: Optional[int] = None,
+    image_projection_matrices: Optional[Sequence[Optional[List[List[float]]]]] = None,
+    scan_indices: Optional[Sequence[Optional[List[int]]]] = None,
+    storage_manager: Optional[ZarrStorageManager] = None,
+) -> List[int]:
+    """
+    Write a batch of segmentations of a model, one per image in image_ids.
+
+    data is an array of shape (N, D, H, W) or (N, H, W), or a sequence of N arrays of shape
+    (D, H, W) or (H, W). Arrays are converted to the dtype of data_type. Arrays of different
+    shapes are written to their own zarr array (one write per shape).
+
+    Returns the ModelSegmentationIDs, in the order of image_ids.
+    """
+    if len(image_ids) != len(data):
+        raise ValueError(
+            f"Got {len(image_ids)} image ids and {len(data)} segmentations"
+        )
+    if len(image_ids) == 0:
+        return []
+    if storage_manager is None:
+        storage_manager = session.storage_manager
+
+    dtype = DATATYPE_DTYPES[data_type]
+    group_name = ModelSegmentation.model_groupname(model)
+
+    # group the segmentations by shape
+    by_shape: Dict[tuple, List[int]] = {}
+    arrays = []
+    for i, array in enumerate(data):
+        array = np.asarray(array)
+        if array.ndim == 2:
+            array = array[None]
+        if array.ndim != 3:
+            raise ValueError(f"Expected 2D or 3D segmentation, got shape {array.shape}")
+        arrays.append(array)
+        by_shape.setdefault(array.shape, []).append(i)
+
+    segmentation_ids: List[Optional[int]] = [None] * len(image_ids)
+    for shape, positions in by_shape.items():
+        stacked = np.stack([arrays[i] for i in positions]).astype(dtype, copy=False)
+        zarr_indices = storage_manager.write_batch(group_name, dtype, shape, stacked)
+
+        depth, height, width = shape
+        rows = [
+            {
+                "ZarrArrayIndex": zarr_index,
+                "ImageInstanceID": int(image_ids[i]),
+                "ModelID": model.ModelID,
+                "DataRepresentation": data_representation,
+                "DataType": data_type,
+                "Depth": depth,
+                "Height": height,
+                "Width": width,
+                "SparseAxis": sparse_axis,
+                "ImageProjectionMatrix": (
+                    image_projection_matrices[i]
+                    if image_projection_matrices is not None
+                    else None
+                ),
+                "ScanIndices": scan_indices[i] if scan_indices is not None else None,
+                "Threshold": threshold,
+            }
+            for i, zarr_index in zip(positions, zarr_indices)
+        ]
+        for start in range(0, len(rows), CHUNK_SIZE):
+            session.execute(insert(ModelSegmentation), rows[start : start + CHUNK_SIZE])
+
+        # MySQL does not return the generated ids of an executemany, the zarr indices
+        # were allocated above so they identify the new rows
+        position_by_index = dict(zip(zarr_indices, positions))
+        id_rows = session.execute(
+            select(
+                ModelSegmentation.ZarrArrayIndex, ModelSegmentation.ModelSegmentationID
+            ).where(
+                ModelSegmentation.ModelID == model.ModelID,
+                ModelSegmentation.DataType == data_type,
+                ModelSegmentation.Depth == depth,
+                ModelSegmentation.Height == height,
+                ModelSegmentation.Width == width,
+                ModelSegmentation.ZarrArrayIndex.between(
+                    zarr_indices[0], zarr_indices[-1]
+                ),
+            )
+        )
+        for zarr_index, segmentation_id in id_rows:
+            segmentation_ids[position_by_index[zarr_index]] = segmentation_id
+
+    return segmentation_ids
+
+
+def _column_values(col: pd.Series, data_type: AttributeDataType) -> pd.Series:
+    """Non-null values of col converted to python values for the AttributeDataType."""
+    if data_type == AttributeDataType.String:
+        col = col[col.notna()].astype(str)
+        return col[~col.isin(["", "null", "NULL"])]
+    col = col[col.notna()]
+    if data_type == AttributeDataType.Int:
+        return col.astype(np.int64).astype(object).map(int)
+    return col.astype(np.float64).astype(object).map(float)
+
+
+VALUE_COLUMNS = {
+    AttributeDataType.Int: "ValueInt",
+    AttributeDataType.Float: "ValueFloat",
+    AttributeDataType.String: "ValueText",
+}
+
+
+def upsert_attribute_values(
+    db: Session,
+    df: pd.DataFrame,
+    *,
+    model: Model,
+    entity_column: str = "ImageInstanceID",
+) -> int:
+    """
+    Insert or update AttributeValues for a model from a DataFrame, indexed by entity id
+    (an ImageInstanceID by default, see ENTITY_COLUMNS) with one column per attribute.
+
+    AttributeDefinitions are created as in df_to_attributes. Null values are skipped.
+    Returns the number of rows written.
+    """
+    if entity_column not in ENTITY_COLUMNS:
+        raise ValueError(
+            f"Unknown entity column: {entity_column}, options: {', '.join(ENTITY_COLUMNS)}"
+        )
+    if df.empty:
+        return 0
+
+    entity_ids = pd.to_numeric(pd.Series(df.index, index=df.index), errors="coerce")
+    df = df[entity_ids.notna().to_numpy()]
+    entity_ids = entity_ids.dropna().astype(np.int64).to_numpy()
+
+    attrs_by_name = get_attribute_definitions(db, df, model)
+
+    rows: List[Dict[str, Any]] = []
+    for col, attr in attrs_by_name.items():
+        values = _column_values(
+            pd.Series(df[col].to_numpy(), index=entity_ids), attr.AttributeDataType
+        )
+        value_column = VALUE_COLUMNS[attr.AttributeDataType]
+        for entity_id, value in zip(values.index.tolist(), values.tolist()):
+            row = {
+                "AttributeID": attr.AttributeID,
+                "ModelID": model.ModelID,
+                "ValueInt": None,
+                "ValueFloat": None,
+                "ValueText": None,
+                "ValueJSON": None,
+                entity_column: entity_id,
+            }
+            row[value_column] = value
+            rows.append(row)
+
+    if not rows:
+        return 0
+
+    stmt = mysql_insert(AttributeValue)
+    stmt = stmt.on_duplicate_key_update(
+        ValueInt=stmt.inserted.ValueInt,
+        ValueFloat=stmt.inserted.ValueFloat,
+        ValueText=stmt.inserted.ValueText,
+        ValueJSON=stmt.inserted.ValueJSON,
+    )
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.execute(stmt, rows[start : start + CHUNK_SIZE])
+    return len(rows)
@@ -0,0 +1,234 @@
+"""
+Parallel backfill of ImageInstance.FileChecksum and ImageInstance.DataHash.
+
+Image IDs are read from the database in pages (keyset pagination), hashed in a process pool
+and written back with one bulk UPDATE per page.
+
+DataHash is the sha256 of the decoded pixel array (see ImageInstance.calc_data_hash). For
+uncompressed little endian DICOM files the PixelData element already contains exactly those
+bytes, so it is hashed directly instead of decoding the pixels. The same holds for .binary files,
+which are hashed as they are read.
+"""
+
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from sqlalchemy import func, select, update
+from tqdm import tqdm
+
+from eyened_orm.image_instance import (
+    ImageInstance,
+    data_hash,
+    file_checksum,
+    load_pixel_array,
+)
+
+CHUNK_SIZE = 8 << 20
+
+
+def _native_pixel_bytes(ds) -> Optional[memoryview]:
+    """
+    Return the PixelData bytes of a DICOM dataset if they are identical to ds.pixel_array.tobytes(),
+    otherwise None (compressed transfer syntax, planar / YBR color data, padding bits, etc.)
+    """
+    from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+    if "PixelData" not in ds:
+        return None
+    transfer_syntax = getattr(ds.file_meta, "TransferSyntaxUID", None)
+    if transfer_syntax not in (ExplicitVRLittleEndian, ImplicitVRLittleEndian):
+        return None
+
+    bits_allocated = ds.get("BitsAllocated")
+    if bits_allocated not in (8, 16, 32):
+        return None
+    if ds.get("PixelRepresentation", 0) == 1 and ds.get("BitsStored") != bits_allocated:
+        # pixel_array sign-extends the stored bits
+        return None
+
+    samples_per_pixel = ds.get("SamplesPerPixel", 1)
+    if samples_per_pixel > 1:
+        if ds.get("PlanarConfiguration", 0) != 0:
+            return None
+        if str(ds.get("PhotometricInterpretation", "")).startswith("YBR"):
+            return None
+
+    n_frames = int(ds.get("NumberOfFrames", 1) or 1)
+    expected = ds.Rows * ds.Columns * samples_per_pixel * n_frames * bits_allocated // 8
+    pixel_data = ds.PixelData
+    if len(pixel_data) < expected:
+        return None
+    # PixelData is padded to an even length
+    return memoryview(pixel_data)[:expected]
+
+
+def _calc_data_hash(path: Path, images_basepath: Path, dataset_identifier: str, rows, columns):
+    """Return (DataHash, number of bytes hashed)."""
+    if dataset_identifier.endswith(".dcm"):
+        import pydicom
+
+        ds = pydicom.dcmread(path)
+        pixel_bytes = _native_pixel_bytes(ds)
+        if pixel_bytes is not None:
+            return hashlib.sha256(pixel_bytes).hexdigest(), len(pixel_bytes)
+        data = ds.pixel_array
+        return data_hash(data), data.nbytes
+
+    if dataset_identifier.endswith(".binary") and rows and columns:
+        # pixel_array is the raw file content as uint8
+        if os.path.getsize(path) % (rows * columns) == 0:
+            sha256 = hashlib.sha256()
+            n_bytes = 0
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    n_bytes += len(chunk)
+            return sha256.hexdigest(), n_bytes
+
+    data = load_pixel_array(images_basepath, dataset_identifier, rows, columns)
+    return data_hash(data), data.nbytes
+
+
+def hash_image(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compute the missing hashes for one image (runs in a worker process).
+
+    item contains ImageInstanceID, images_basepath, DatasetIdentifier, Rows_y, Columns_x and
+    the flags calc_checksum and calc_data_hash. Returns the values to update (by column name),
+    the number of bytes read and a list of errors.
+    """
+    images_basepath = Path(item["images_basepath"])
+    dataset_identifier = item["DatasetIdentifier"]
+    path = images_basepath / dataset_identifier
+    result = {"values": {}, "bytes": 0, "errors": []}
+
+    if not path.exists():
+        result["errors"].append(f"File {path} does not exist")
+        return result
+
+    if item["calc_checksum"]:
+        try:
+            result["values"]["FileChecksum"] = file_checksum(path, chunk_size=CHUNK_SIZE)
+            result["bytes"] += os.path.getsize(path)
+        except Exception as e:
+            result["errors"].append(f"Error calculating file checksum for {path}: {e}")
+
+    if item["calc_data_hash"]:
+        try:
+            value, n_bytes = _calc_data_hash(
+                path, images_basepath, dataset_identifier, item["Rows_y"], item["Columns_x"]
+            )
+            result["values"]["DataHash"] = value
+            result["bytes"] += n_bytes
+        except Exception as e:
+            result["errors"].append(f"Error calculating data hash for {path}: {e}")
+
+    return result
+
+
+def iter_missing_hashes(session, page_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+    """Yield pages of images with a missing FileChecksum or DataHash, ordered by ImageInstanceID."""
+    images_basepath = str(session.config.images_basepath)
+    last_id = 0
+    while True:
+        query = (
+            select(
+                ImageInstance.ImageInstanceID,
+                ImageInstance.DatasetIdentifier,
+                ImageInstance.Rows_y,
+                ImageInstance.Columns_x,
+                ImageInstance.FileChecksum.is_(None).label("calc_checksum"),
+                ImageInstance.DataHash.is_(None).label("calc_data_hash"),
+            )
+            .where(
+                (ImageInstance.FileChecksum == None) | (ImageInstance.DataHash == None),
+                ImageInstance.ImageInstanceID > last_id,
+            )
+            .order_by(ImageInstance.ImageInstanceID)
+            .limit(page_size)
+        )
+        rows = session.execute(query).mappings().all()
+        if not rows:
+            return
+        last_id = rows[-1]["ImageInstanceID"]
+        yield [
+            {
+                **row,
+                "calc_checksum": bool(row["calc_checksum"]),
+                "calc_data_hash": bool(row["calc_data_hash"]),
+                "images_basepath": images_basepath,
+            }
+            for row in rows
+        ]
+
+
+def update_hashes(
+    session,
+    n_jobs: int = 8,
+    page_size: int = 1000,
+    print_errors: bool = False,
+) -> Dict[str, Any]:
+    """
+    Compute the missing FileChecksum and DataHash values of all ImageInstances.
+
+    Parameters:
+    -----------
+    session : EyenedSession
+        Database session
+    n_jobs : int, default=8
+        Number of worker processes
+    page_size : int, default=1000
+        Number of images read from the database, hashed and updated at a time
+
+    Returns:
+    --------
+    Dict
+        Statistics: updated, errors, bytes, elapsed and mb_per_second
+    """
+    missing = (ImageInstance.FileChecksum == None) | (ImageInstance.DataHash == None)
+    n_total = session.scalar(select(func.count()).select_from(ImageInstance).where(missing))
+    print(f"Found {n_total} images with missing hashes")
+
+    n_updated = 0
+    n_errors = 0
+    n_bytes = 0
+    t_start = time.perf_counter()
+
+    def mb_per_second():
+        elapsed = time.perf_counter() - t_start
+        return n_bytes / 1e6 / elapsed if elapsed > 0 else 0.0
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor, tqdm(total=n_total) as progress:
+        for page in iter_missing_hashes(session, page_size=page_size):
+            chunksize = max(1, len(page) // (4 * n_jobs))
+            updates = []
+            for item, result in zip(page, executor.map(hash_image, page, chunksize=chunksize)):
+                n_bytes += result["bytes"]
+                if result["errors"]:
+                    n_errors += len(result["errors"])
+                    if print_errors:
+                        for error in result["errors"]:
+                            print(f"ImageInstanceID={item['ImageInstanceID']}: {error}")
+                if result["values"]:
+                    updates.append({"ImageInstanceID": item["ImageInstanceID"], **result["values"]})
+
+            if updates:
+                # bulk UPDATE by primary key
+                session.execute(update(ImageInstance), updates)
+                session.commit()
+            n_updated += len(updates)
+            progress.update(len(page))
+            progress.set_postfix(errors=n_errors, mb_s=f"{mb_per_second():.1f}")
+
+    elapsed = time.perf_counter() - t_start
+    return {
+        "updated": n_updated,
+        "errors": n_errors,
+        "bytes": n_bytes,
+        "elapsed": elapsed,
+        "mb_per_second": mb_per_second(),
+    }
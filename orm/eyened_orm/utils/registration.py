@@ -1,9 +1,316 @@
-from collections import defaultdict, deque
+import multiprocessing
+import os
+import tempfile
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 
-from eyened_orm import Creator, FormAnnotation, FormSchema, ImageInstance
+import cv2
+import numpy as np
+from PIL import Image
+from sqlalchemy import select
+from tqdm import tqdm
+
+from eyened_orm import (
+    Creator,
+    Database,
+    FormAnnotation,
+    FormSchema,
+    ImageInstance,
+    Patient,
+    Series,
+    Study,
+)
+from eyened_orm.utils.transforms import UnionFind, compose_transforms, invert_transform
+from eyened_orm.utils.warping import warp_image
 from rtnls_registration import Registration
 
+ENFACE_MODALITIES = ["ColorFundus", "InfraredReflectance", "Autofluorescence"]
+
+# features of the reference (0) and target (1) image of a Registration
+FEATURE_ATTRIBUTES = ("M{}", "kp{}_005", "des{}_005", "kp{}_01", "des{}_01")
+
+
+def extractor_version():
+    try:
+        return f"rtnls-registration=={version('rtnls-registration')}"
+    except PackageNotFoundError:
+        return "rtnls-registration"
+
+
+class FeatureCache:
+    """
+    On-disk cache of the registration features (mask, keypoints and descriptors) of images,
+    keyed by ImageInstance.DataHash. Entries are stored per extractor version, so features
+    of another version of rtnls_registration are never reused.
+    """
+
+    def __init__(self, path, extractor=None):
+        extractor = extractor or extractor_version()
+        self.path = Path(path) / extractor.replace("==", "-")
+
+    def _file(self, data_hash: bytes) -> Path:
+        key = data_hash.hex()
+        return self.path / key[:2] / f"{key}.npz"
+
+    def get(self, data_hash: bytes):
+        try:
+            with np.load(self._file(data_hash)) as data:
+                return {name: data[name] if name in data else None for name in FEATURE_ATTRIBUTES}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+    def put(self, data_hash: bytes, features):
+        file = self._file(data_hash)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {name: np.asarray(value) for name, value in features.items() if value is not None}
+        # write to a temporary file first, so concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=file.parent, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+class FeatureExtractor:
+    """
+    Registration features of images, computed once per image and reused from the
+    (optional) FeatureCache. load returns the pixel array of an image (default: get_pixel_array).
+    """
+
+    def __init__(self, cache: FeatureCache = None, load=None):
+        self.cache = cache
+        self.load = load or get_pixel_array
+        self._features = {}
+
+    def __call__(self, image):
+        if image.ImageInstanceID in self._features:
+            return self._features[image.ImageInstanceID]
+        data_hash = image.DataHash if self.cache is not None else None
+        features = self.cache.get(data_hash) if data_hash is not None else None
+        if features is None:
+            registration = Registration()
+            registration.set_reference(self.load(image))
+            features = get_features(registration, 0)
+            if data_hash is not None:
+                self.cache.put(data_hash, features)
+        self._features[image.ImageInstanceID] = features
+        return features
+
+
+def get_features(registration, index):
+    return {name: getattr(registration, name.format(index)) for name in FEATURE_ATTRIBUTES}
+
+
+def set_features(registration, index, features):
+    for name, value in features.items():
+        setattr(registration, name.format(index), value)
+
+
+def register_pair(reference, target, extractor):
+    """Transform from the reference to the target image (see registration_schema.json)."""
+    registration = Registration()
+    set_features(registration, 0, extractor(reference))
+    set_features(registration, 1, extractor(target))
+    return registration.run().to_dict()
+
+
+# size of the preprocessed images in cfi_cache_path (see inference/pipeline.py)
+PREPROCESSED_SIZE = 1024
+# longest side of the coarse level of images without a cached preprocessed image
+COARSE_SIZE = 1024
+
+# thresholds on the coarse fit of a pair (see alignment_quality): pairs below MIN_OVERLAP or
+# MIN_QUALITY are rejected, pairs from ACCEPT_QUALITY are accepted without full resolution
+# refinement
+MIN_OVERLAP = 0.2
+MIN_QUALITY = 0.15
+ACCEPT_QUALITY = 0.5
+
+# fundus mask of the coarse images: pixels brighter than this fraction of the maximum
+MASK_THRESHOLD = 0.05
+
+
+def projective(matrix):
+    return {"type": "ProjectiveTransform", "Matrix": np.asarray(matrix, dtype=float).ravel().tolist()}
+
+
+class CoarseImages:
+    """
+    Coarse pyramid level of images: the preprocessed image in cfi_cache_path/rgb if it is
+    cached (and the image has a CFROI), the image downsampled to a longest side of size
+    otherwise. Returns (pixel array, matrix from original to coarse pixel coordinates).
+    """
+
+    def __init__(self, cfi_cache_path=None, size: int = COARSE_SIZE):
+        self.rgb_path = Path(cfi_cache_path) / "rgb" if cfi_cache_path is not None else None
+        self.size = size
+        self._levels = {}
+
+    def __call__(self, image):
+        if image.ImageInstanceID not in self._levels:
+            self._levels[image.ImageInstanceID] = self._preprocessed(image) or self._downsampled(image)
+        return self._levels[image.ImageInstanceID]
+
+    def image(self, image):
+        return self(image)[0]
+
+    def matrix(self, image):
+        return self(image)[1]
+
+    def _preprocessed(self, image):
+        roi = image.CFROI
+        if self.rgb_path is None or not roi or "center" not in roi:
+            return None
+        path = self.rgb_path / f"{image.ImageInstanceID}.png"
+        if not path.exists():
+            return None
+        # the preprocessing scales the fundus circle to PREPROCESSED_SIZE and centers it
+        # (see inference/utils.inverse_cropping_transform)
+        (cx, cy), radius = roi["center"], roi["radius"]
+        scale = PREPROCESSED_SIZE / (2 * radius)
+        offset = PREPROCESSED_SIZE / 2
+        matrix = np.array(
+            [[scale, 0, offset - cx * scale], [0, scale, offset - cy * scale], [0, 0, 1]]
+        )
+        return np.array(Image.open(path)), matrix
+
+    def _downsampled(self, image):
+        data = get_pixel_array(image)
+        height, width = data.shape[:2]
+        factor = self.size / max(height, width)
+        if factor >= 1:
+            return data, np.eye(3)
+        size = (max(1, round(width * factor)), max(1, round(height * factor)))
+        fx, fy = size[0] / width, size[1] / height
+        data = cv2.resize(data, size, interpolation=cv2.INTER_AREA)
+        # pixel centers: x' + 0.5 = (x + 0.5) * fx
+        matrix = np.array([[fx, 0, (fx - 1) / 2], [0, fy, (fy - 1) / 2], [0, 0, 1]])
+        return data, matrix
+
+
+def _structure(data):
+    """Green (or gray) channel without the background illumination, and the fundus mask."""
+    gray = (data[..., 1] if data.ndim == 3 else data).astype(np.float32)
+    gray /= max(float(gray.max()), 1e-6)
+    mask = gray > MASK_THRESHOLD
+    # shrink the mask, so the edge of the fundus does not dominate the structure
+    radius = max(1, max(gray.shape) // 128)
+    mask = cv2.erode(mask.astype(np.uint8), np.ones((2 * radius + 1, 2 * radius + 1), np.uint8)) > 0
+    # background illumination: blurred image, normalized by the blurred mask
+    sigma = max(gray.shape) / 64
+    weight = cv2.GaussianBlur(mask.astype(np.float32), (0, 0), sigma)
+    background = cv2.GaussianBlur(gray * mask, (0, 0), sigma) / np.maximum(weight, 1e-3)
+    return np.where(mask, gray - background, 0).astype(np.float32), mask
+
+
+def alignment_quality(reference, target, transform):
+    """
+    (overlap, quality) of the target image aligned to the reference image with transform (from
+    reference to target pixels): the fraction of the reference fundus that is covered by the
+    target fundus, and the normalized cross correlation of their structure in the overlap.
+    """
+    reference, reference_mask = _structure(reference)
+    target, target_mask = _structure(target)
+    aligned = warp_image(target, transform, reference.shape, linear=True)
+    aligned_mask = warp_image(target_mask.astype(np.uint8), transform, reference.shape) > 0
+    overlap = reference_mask & aligned_mask
+    n = int(overlap.sum())
+    if n < 2:
+        return 0.0, 0.0
+    a = reference[overlap] - reference[overlap].mean()
+    b = aligned[overlap] - aligned[overlap].mean()
+    norm = float(np.sqrt(np.dot(a, a) * np.dot(b, b)))
+    quality = float(np.dot(a, b)) / norm if norm > 0 else 0.0
+    return n / int(reference_mask.sum()), quality
+
+
+class PyramidRegistration:
+    """
+    Coarse-to-fine registration of image pairs.
+
+    A pair is first registered on the coarse level of the images (see CoarseImages), which is
+    much cheaper than full resolution and reads the cached preprocessed images instead of the
+    original images where possible. The coarse fit is rejected if its overlap or quality (see
+    alignment_quality) is below min_overlap or min_quality, accepted as is (scaled to full
+    resolution) from accept_quality, and refined by a full resolution registration in between.
+    With accept_quality None, every pair that passes is refined.
+
+    counts has the number of pairs per level ("coarse", "full" and "rejected").
+    """
+
+    def __init__(
+        self,
+        extractor: FeatureExtractor = None,
+        cfi_cache_path=None,
+        coarse_size: int = COARSE_SIZE,
+        min_overlap: float = MIN_OVERLAP,
+        min_quality: float = MIN_QUALITY,
+        accept_quality: float = ACCEPT_QUALITY,
+    ):
+        self.extractor = extractor or FeatureExtractor()
+        self.coarse = CoarseImages(cfi_cache_path, coarse_size)
+        # coarse features are not cached on disk: the coarse level of an image changes when
+        # its preprocessed image is cached
+        self.coarse_extractor = FeatureExtractor(load=self.coarse.image)
+        self.min_overlap = min_overlap
+        self.min_quality = min_quality
+        self.accept_quality = accept_quality
+        self.counts = Counter()
+
+    def coarse_transform(self, reference, target):
+        """Full resolution transform from the coarse registration, and its (overlap, quality)."""
+        transform = register_pair(reference, target, self.coarse_extractor)
+        fit = alignment_quality(self.coarse.image(reference), self.coarse.image(target), transform)
+        full = compose_transforms(
+            [
+                projective(self.coarse.matrix(reference)),
+                transform,
+                invert_transform(projective(self.coarse.matrix(target))),
+            ]
+        )
+        if len(full["transforms"]) == 1:
+            full = full["transforms"][0]
+        return full, fit
+
+    def run(self, reference, target):
+        """(transform, level, (overlap, quality) of the coarse fit), transform None if rejected."""
+        transform, (overlap, quality) = self.coarse_transform(reference, target)
+        if overlap < self.min_overlap or quality < self.min_quality:
+            level, transform = "rejected", None
+        elif self.accept_quality is not None and quality >= self.accept_quality:
+            level = "coarse"
+        else:
+            level = "full"
+            transform = register_pair(reference, target, self.extractor)
+        self.counts[level] += 1
+        return transform, level, (overlap, quality)
+
+    def __call__(self, reference, target):
+        transform, _, (overlap, quality) = self.run(reference, target)
+        if transform is None:
+            raise ValueError(
+                f"coarse fit below thresholds (overlap {overlap:.2f}, quality {quality:.2f})"
+            )
+        return transform
+
+
+def make_register(feature_cache: FeatureCache = None, pyramid=None):
+    """
+    Registration of image pairs: register(reference, target) -> transform. pyramid is None for
+    full resolution registration, or the keyword arguments of PyramidRegistration.
+    """
+    extractor = FeatureExtractor(feature_cache)
+    if pyramid is not None:
+        return PyramidRegistration(extractor, **pyramid)
+    return partial(register_pair, extractor=extractor)
+
 
 def get_or_create_schema(session, schema_name):
     schema = FormSchema.by_name(session, schema_name)
@@ -62,44 +369,10 @@ def get_or_create_FormAnnotation(session, patient, schema, creator):
 
 
 def get_processed_edges(formAnnotation):
+    """Connectivity (UnionFind) of the images of the registration set."""
     if formAnnotation.FormData:
-        processed = {(e["image1"], e["image2"]) for e in formAnnotation.FormData}
-    else:
-        processed = set()
-
-    # Build adjacency list from the processed edges (bidirectional)
-    graph = defaultdict(set)
-    for img1, img2 in processed:
-        graph[img1].add(img2)
-        graph[img2].add(img1)
-    return graph
-
-
-def are_connected(image_id1, image_id2, graph):
-    """
-    Check if two images are connected through any path in the processed graph.
-    """
-    if image_id1 == image_id2:
-        return True
-
-    # BFS to check connectivity
-    if image_id1 not in graph or image_id2 not in graph:
-        return False
-
-    queue = deque([image_id1])
-    visited = {image_id1}
-
-    while queue:
-        current = queue.popleft()
-        if current == image_id2:
-            return True
-
-        for neighbor in graph[current]:
-            if neighbor not in visited:
-                visited.add(neighbor)
-                queue.append(neighbor)
-
-    return False
+        return UnionFind((e["image1"], e["image2"]) for e in formAnnotation.FormData)
+    return UnionFind()
 
 
 def get_etdrs_field(image):
@@ -145,34 +418,33 @@ def get_pixel_array(image):
         return image.pixel_array
 
 
-def run_registration(image_set, graph, form_data):
+def select_reference(image_set):
+    """Best quality image as reference."""
+    return max(image_set, key=lambda i: i.CFQuality if i.CFQuality else 0)
+
+
+def run_registration(image_set, graph, form_data, register):
     # Skip if image set is empty
     if not image_set:
-        return None, None
-
-    # best quality image as reference
-    reference = max(image_set, key=lambda i: i.CFQuality if i.CFQuality else 0)
+        return None
 
-    registrator = Registration()
-    registrator.set_reference(get_pixel_array(reference))
+    reference = select_reference(image_set)
 
     for i in image_set:
-        if are_connected(reference.ImageInstanceID, i.ImageInstanceID, graph):
+        if graph.connected(reference.ImageInstanceID, i.ImageInstanceID):
             continue
 
-        registrator.set_target(get_pixel_array(i))
         try:
             print(
                 f"Running registration for {reference.ImageInstanceID} -> {i.ImageInstanceID}"
             )
-            transform = registrator.run()
-            graph[reference.ImageInstanceID].add(i.ImageInstanceID)
-            graph[i.ImageInstanceID].add(reference.ImageInstanceID)
+            transform = register(reference, i)
+            graph.union(reference.ImageInstanceID, i.ImageInstanceID)
             form_data.append(
                 {
                     "image1": reference.ImageInstanceID,
                     "image2": i.ImageInstanceID,
-                    "transform": transform.to_dict(),
+                    "transform": transform,
                 }
             )
         except Exception as e:
@@ -180,91 +452,215 @@ def run_registration(image_set, graph, form_data):
                 f"Error running registration for {reference.ImageInstanceID}, {i.ImageInstanceID}: {e}"
             )
 
-    return registrator, reference
+    return reference
+
+
+def register_eye(eye_images, graph, all_transforms, register):
+    """Register the F1 and F2 images of an eye, and the F1 and F2 reference images to each other."""
+    # split images into F1 and F2
+    sorted_images = sort_images(eye_images)
+
+    reference_f1 = None
+    reference_f2 = None
+    if sorted_images["F1"]:
+        print(f"Running registration for F1 images")
+        reference_f1 = run_registration(
+            sorted_images["F1"], graph, all_transforms, register
+        )
+
+    if sorted_images["F2"]:
+        print(f"Running registration for F2 images")
+        reference_f2 = run_registration(
+            sorted_images["F2"], graph, all_transforms, register
+        )
+
+    if (
+        reference_f1
+        and reference_f2
+        and not graph.connected(reference_f1.ImageInstanceID, reference_f2.ImageInstanceID)
+    ):
+        # register the two reference images
+        try:
+            transform = register(reference_f1, reference_f2)
+            graph.union(reference_f1.ImageInstanceID, reference_f2.ImageInstanceID)
+            all_transforms.append(
+                {
+                    "image1": reference_f1.ImageInstanceID,
+                    "image2": reference_f2.ImageInstanceID,
+                    "transform": transform,
+                }
+            )
+        except Exception as e:
+            print(
+                f"Error running reference-to-reference registration for {reference_f1.ImageInstanceID}, {reference_f2.ImageInstanceID}: {e}"
+            )
 
 
-def run_registration_patient(patient, formAnnotation):
+def run_patient(session, patient, schema, creator, replace, feature_cache=None, pyramid=None):
+    """Register the enface images of a patient, one eye at a time (see run_registration_unit)."""
     print(
         f"Running registration for patient {patient.PatientID} {patient.PatientIdentifier}"
     )
-    enface_images = patient.get_images(
-        where=ImageInstance.Modality.in_(
-            ["ColorFundus", "InfraredReflectance", "Autofluorescence"]
+    form_annotation_id = get_or_create_FormAnnotation(
+        session, patient, schema, creator
+    ).FormAnnotationID
+    for patient_id, eye in get_registration_units(session, [patient.PatientID]):
+        n_transforms = run_registration_unit(
+            session, patient_id, eye, form_annotation_id, replace, feature_cache, pyramid
         )
-    )
-    print(f"Found {len(enface_images)} enface images")
-    graph = get_processed_edges(formAnnotation)
-    print(f"Found {len(graph)} processed pairs")
+        print(f"Added {n_transforms} transforms for eye {eye}")
 
-    all_transforms = [*formAnnotation.FormData] if formAnnotation.FormData else []
-    for eye in "RL":
 
-        eye_images = [i for i in enface_images if i.Laterality.name == eye]
+def replaced_edges(form_data, image_ids, active_ids):
+    """
+    Edges of a registration set that are kept when the images of an eye (image_ids) are
+    registered again: edges that do not touch image_ids, between active enface images of the
+    patient (active_ids). Edges to removed or inactive images are dropped as well.
+    """
+    return [
+        e
+        for e in form_data
+        if e["image1"] not in image_ids
+        and e["image2"] not in image_ids
+        and e["image1"] in active_ids
+        and e["image2"] in active_ids
+    ]
 
-        # split images into F1 and F2
-        sorted_images = sort_images(eye_images)
 
-        register_f1 = None
-        register_f2 = None
-        if sorted_images["F1"]:
-            print(f"Running registration for F1 images")
-            register_f1, reference_f1 = run_registration(
-                sorted_images["F1"], graph, all_transforms
-            )
+def save_transforms(session, form_annotation_id, transforms, image_ids, replace=False, active_ids=None):
+    """
+    Add transforms to the FormData of a registration set, with the FormAnnotation row locked so
+    that concurrent writers (other eyes of the patient) do not overwrite each other.
+    With replace, the existing transforms are replaced (see replaced_edges).
+    """
+    formAnnotation = session.scalar(
+        select(FormAnnotation)
+        .where(FormAnnotation.FormAnnotationID == form_annotation_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    form_data = formAnnotation.FormData or []
+    if replace:
+        form_data = replaced_edges(form_data, image_ids, active_ids or set())
+    existing = {(e["image1"], e["image2"]) for e in form_data}
+    formAnnotation.FormData = [
+        *form_data,
+        *(t for t in transforms if (t["image1"], t["image2"]) not in existing),
+    ]
+    session.commit()
+
 
-        if sorted_images["F2"]:
-            print(f"Running registration for F2 images")
-            register_f2, reference_f2 = run_registration(
-                sorted_images["F2"], graph, all_transforms
+def run_registration_unit(
+    session, patient_id, eye, form_annotation_id, replace=False, feature_cache=None, pyramid=None
+):
+    """
+    Register the enface images of one eye of a patient and add the new transforms to the
+    registration set. Returns the number of new transforms.
+    """
+    patient = Patient.by_id(session, patient_id)
+    enface_images = patient.get_images(where=ImageInstance.Modality.in_(ENFACE_MODALITIES))
+    eye_images = [
+        i for i in enface_images if i.Laterality is not None and i.Laterality.name == eye
+    ]
+    active_ids = {i.ImageInstanceID for i in enface_images}
+    if replace:
+        graph = UnionFind()
+    else:
+        graph = get_processed_edges(FormAnnotation.by_id(session, form_annotation_id))
+    transforms = []
+    register_eye(eye_images, graph, transforms, make_register(feature_cache, pyramid))
+    # release the read transaction before locking the FormAnnotation
+    session.rollback()
+    save_transforms(
+        session,
+        form_annotation_id,
+        transforms,
+        {i.ImageInstanceID for i in eye_images},
+        replace,
+        active_ids,
+    )
+    return len(transforms)
+
+
+def get_registration_units(session, patient_ids):
+    """(PatientID, eye) of the patients that have enface images of the eye."""
+    units = set()
+    patient_ids = list(patient_ids)
+    for start in range(0, len(patient_ids), 1000):
+        rows = session.execute(
+            select(Study.PatientID, ImageInstance.Laterality)
+            .join(Series, ImageInstance.SeriesID == Series.SeriesID)
+            .join(Study, Series.StudyID == Study.StudyID)
+            .where(
+                Study.PatientID.in_(patient_ids[start : start + 1000]),
+                ~ImageInstance.Inactive,
+                ImageInstance.Modality.in_(ENFACE_MODALITIES),
+                ImageInstance.Laterality != None,
             )
+            .distinct()
+        )
+        units.update((patient_id, laterality.name) for patient_id, laterality in rows)
+    return sorted(units)
 
 
-        if (
-            register_f1
-            and register_f2
-            and not are_connected(
-                reference_f1.ImageInstanceID, reference_f2.ImageInstanceID, graph
-            )
-        ):
-            # register the two reference images
-            registration = Registration()
-            registration.M0 = register_f1.M0
-            registration.kp0_005 = register_f1.kp0_005
-            registration.des0_005 = register_f1.des0_005
-            registration.kp0_01 = register_f1.kp0_01
-            registration.des0_01 = register_f1.des0_01
-
-            registration.M1 = register_f2.M0
-            registration.kp1_005 = register_f2.kp0_005
-            registration.des1_005 = register_f2.des0_005
-            registration.kp1_01 = register_f2.kp0_01
-            registration.des1_01 = register_f2.des0_01
-            try:
-                transform = registration.run()
-                graph[reference_f1.ImageInstanceID].add(reference_f2.ImageInstanceID)
-                graph[reference_f2.ImageInstanceID].add(reference_f1.ImageInstanceID)
-                all_transforms.append(
-                    {
-                        "image1": reference_f1.ImageInstanceID,
-                        "image2": reference_f2.ImageInstanceID,
-                        "transform": transform.to_dict(),
-                    }
-                )
-            except Exception as e:
-                print(
-                    f"Error running reference-to-reference registration for {reference_f1.ImageInstanceID}, {reference_f2.ImageInstanceID}: {e}"
-                )
+_database = None
 
-    return all_transforms
 
+def _init_worker(config):
+    global _database
+    _database = Database(config)
 
-def run_patient(session, patient, schema, creator, replace):
-    formAnnotation = get_or_create_FormAnnotation(session, patient, schema, creator)
-    if replace:
-        formAnnotation.FormData = []
 
-    all_transforms = run_registration_patient(patient, formAnnotation)
-    formAnnotation.FormData = all_transforms
+def _run_unit(args):
+    with _database.get_session() as session:
+        return run_registration_unit(session, *args)
 
-    session.add(formAnnotation)
-    session.commit()
+
+def run_registration_parallel(
+    session, patients, schema, creator, replace=False, feature_cache=None, n_jobs=8, pyramid=None
+):
+    """
+    Run the registration of patients in a process pool, with (patient, eye) as unit of work.
+    Each worker process has its own database session and every unit writes its transforms
+    in one transaction (see save_transforms). Returns the failed units with their error.
+    """
+    form_annotations = {
+        patient.PatientID: get_or_create_FormAnnotation(
+            session, patient, schema, creator
+        ).FormAnnotationID
+        for patient in patients
+    }
+    units = get_registration_units(session, form_annotations)
+    print(f"Found {len(units)} eyes of {len(form_annotations)} patients")
+
+    n_transforms = 0
+    failures = []
+    # spawn: the parent has open database connections, which must not be shared with the workers
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(session.config,),
+    ) as executor, tqdm(total=len(units)) as pbar:
+        futures = {
+            executor.submit(
+                _run_unit,
+                (patient_id, eye, form_annotations[patient_id], replace, feature_cache, pyramid),
+            ): (patient_id, eye)
+            for patient_id, eye in units
+        }
+        for future in as_completed(futures):
+            patient_id, eye = futures[future]
+            try:
+                n_transforms += future.result()
+            except Exception as e:
+                failures.append((patient_id, eye, str(e)))
+                print(f"Error running registration for patient {patient_id} ({eye}): {e}")
+            pbar.update(1)
+
+    print(
+        f"Added {n_transforms} transforms for {len(units) - len(failures)} eyes, "
+        f"{len(failures)} failures"
+    )
+    return failures
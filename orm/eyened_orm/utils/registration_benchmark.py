@@ -0,0 +1,128 @@
+"""
+Benchmark of the pyramid (coarse-to-fine) registration against full resolution registration
+(see eorm benchmark-registration).
+
+Pairs are selected as run-registration would register them: every F1 or F2 image of an eye with
+the reference image of its field. Every pair is registered in both modes, without a feature
+cache, so each mode extracts the features of every image once. Per pair the time of both modes,
+the level of the pyramid registration (coarse, full or rejected), the coarse fit and the mean
+distance (in pixels of the reference image) between both transforms are reported.
+"""
+
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+
+from eyened_orm import ImageInstance, Patient
+from eyened_orm.utils.registration import (
+    ENFACE_MODALITIES,
+    FeatureExtractor,
+    PyramidRegistration,
+    register_pair,
+    select_reference,
+    sort_images,
+)
+from eyened_orm.utils.warping import map_points
+
+# grid of points (per axis) on which two transforms are compared
+GRID_SIZE = 16
+
+
+def load_benchmark_pairs(
+    session,
+    n_pairs: int = 32,
+    project_id: Optional[int] = None,
+    patient_identifier: Optional[str] = None,
+) -> List[Tuple[Any, Any]]:
+    """(reference, target) ImageInstance pairs of the most recent patients."""
+    stmt = select(Patient).order_by(Patient.PatientID.desc())
+    if project_id is not None:
+        stmt = stmt.where(Patient.ProjectID == project_id)
+    if patient_identifier is not None:
+        stmt = stmt.where(Patient.PatientIdentifier == patient_identifier)
+
+    pairs = []
+    for patient in session.scalars(stmt):
+        images = patient.get_images(where=ImageInstance.Modality.in_(ENFACE_MODALITIES))
+        for eye in "RL":
+            groups = sort_images(
+                [i for i in images if i.Laterality is not None and i.Laterality.name == eye]
+            )
+            for group in (groups["F1"], groups["F2"]):
+                if len(group) < 2:
+                    continue
+                reference = select_reference(group)
+                pairs.extend((reference, i) for i in group if i is not reference)
+        if len(pairs) >= n_pairs:
+            break
+    return pairs[:n_pairs]
+
+
+def transform_distance(first: Dict[str, Any], second: Dict[str, Any], shape) -> float:
+    """Mean distance between the points mapped by two transforms, on a grid over the central half of the image."""
+    height, width = shape
+    x, y = np.meshgrid(
+        np.linspace(width / 4, 3 * width / 4, GRID_SIZE),
+        np.linspace(height / 4, 3 * height / 4, GRID_SIZE),
+    )
+    x1, y1 = map_points(first, x, y)
+    x2, y2 = map_points(second, x, y)
+    return float(np.hypot(x1 - x2, y1 - y2).mean())
+
+
+def benchmark_registration(
+    pairs: Sequence[Tuple[Any, Any]],
+    cfi_cache_path=None,
+    **pyramid,
+) -> pd.DataFrame:
+    """
+    Register every pair at full resolution and with PyramidRegistration(cfi_cache_path=...,
+    **pyramid), returning one row per pair.
+    """
+    full_extractor = FeatureExtractor()
+    registration = PyramidRegistration(FeatureExtractor(), cfi_cache_path, **pyramid)
+
+    rows = []
+    for reference, target in pairs:
+        row = {"reference": reference.ImageInstanceID, "target": target.ImageInstanceID}
+
+        start = time.perf_counter()
+        try:
+            full = register_pair(reference, target, full_extractor)
+        except Exception as e:
+            print(f"Error running registration for {reference.ImageInstanceID}, {target.ImageInstanceID}: {e}")
+            full = None
+        row["full_s"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            transform, level, (overlap, quality) = registration.run(reference, target)
+        except Exception as e:
+            print(f"Error running pyramid registration for {reference.ImageInstanceID}, {target.ImageInstanceID}: {e}")
+            transform, level, (overlap, quality) = None, "error", (np.nan, np.nan)
+        row["pyramid_s"] = time.perf_counter() - start
+
+        row.update(level=level, overlap=overlap, quality=quality)
+        row["distance_px"] = (
+            transform_distance(full, transform, (reference.Rows_y, reference.Columns_x))
+            if full is not None and transform is not None
+            else np.nan
+        )
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def summarize_benchmark(results: pd.DataFrame) -> Dict[str, Any]:
+    """Total time of both modes, the speedup, the pairs per level and the median distance."""
+    full_s, pyramid_s = results["full_s"].sum(), results["pyramid_s"].sum()
+    return {
+        "pairs": len(results),
+        "full_s": full_s,
+        "pyramid_s": pyramid_s,
+        "speedup": full_s / pyramid_s if pyramid_s > 0 else np.nan,
+        **{f"n_{level}": int((results["level"] == level).sum()) for level in ("coarse", "full", "rejected")},
+        "median_distance_px": results["distance_px"].median(),
+    }
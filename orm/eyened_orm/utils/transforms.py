@@ -0,0 +1,226 @@
+"""
+Connectivity and composition of registration transforms.
+
+Registration sets (FormAnnotations with the RegistrationSet schema, see utils/registration.py)
+store a list of {"image1", "image2", "transform"} edges per patient, with transforms as in
+registration_schema.json (ProjectiveTransform, ParabolicTransform or CompositeTransform).
+TransformGraph finds the shortest path of edges between two images and composes their
+transforms (inverting edges that are traversed backwards) into one CompositeTransform, in the
+format read by the viewer. Transform graphs are cached per patient until one of its
+registration sets changes.
+"""
+
+from collections import OrderedDict, defaultdict, deque
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+
+from eyened_orm.form_annotation import FormAnnotation, FormSchema
+
+REGISTRATION_SCHEMA = "RegistrationSet"
+
+# number of patients with a cached transform graph
+TRANSFORM_GRAPH_CACHE_SIZE = 256
+
+
+class UnionFind:
+    """Incremental connectivity of images (disjoint sets with path halving and union by size)."""
+
+    def __init__(self, edges: Iterable[Tuple[int, int]] = ()):
+        self._parent: Dict[int, int] = {}
+        self._size: Dict[int, int] = {}
+        for a, b in edges:
+            self.union(a, b)
+
+    def __len__(self):
+        return len(self._parent)
+
+    def __contains__(self, item):
+        return item in self._parent
+
+    def find(self, item: int) -> int:
+        parent = self._parent
+        if item not in parent:
+            parent[item] = item
+            self._size[item] = 1
+            return item
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a: int, b: int):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return
+        if self._size[root_a] < self._size[root_b]:
+            root_a, root_b = root_b, root_a
+        self._parent[root_b] = root_a
+        self._size[root_a] += self._size[root_b]
+
+    def connected(self, a: int, b: int) -> bool:
+        if a == b:
+            return True
+        if a not in self._parent or b not in self._parent:
+            return False
+        return self.find(a) == self.find(b)
+
+
+def invert_transform(transform: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Inverse of a transform. The inverse of a ParabolicTransform is approximated by negating
+    its coefficients, as in the viewer.
+    """
+    kind = transform["type"]
+    if kind == "ProjectiveTransform":
+        matrix = np.linalg.inv(np.asarray(transform["Matrix"], dtype=float).reshape(3, 3))
+        return {"type": kind, "Matrix": (matrix / matrix[2, 2]).ravel().tolist()}
+    if kind == "ParabolicTransform":
+        return {
+            "type": kind,
+            "dx": [-v for v in transform["dx"]],
+            "dy": [-v for v in transform["dy"]],
+        }
+    if kind == "CompositeTransform":
+        return {
+            "type": kind,
+            "transforms": [invert_transform(t) for t in reversed(transform["transforms"])],
+        }
+    raise ValueError(f"Unknown transform type: {kind}")
+
+
+def compose_transforms(transforms: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Transform that applies transforms in order, as a CompositeTransform. Nested composites are
+    flattened and consecutive projective transforms are multiplied into one.
+    """
+    flat: List[Dict[str, Any]] = []
+    stack = list(reversed(transforms))
+    while stack:
+        transform = stack.pop()
+        if transform["type"] == "CompositeTransform":
+            stack.extend(reversed(transform["transforms"]))
+        elif (
+            transform["type"] == "ProjectiveTransform"
+            and flat
+            and flat[-1]["type"] == "ProjectiveTransform"
+        ):
+            first = np.asarray(flat[-1]["Matrix"], dtype=float).reshape(3, 3)
+            second = np.asarray(transform["Matrix"], dtype=float).reshape(3, 3)
+            matrix = second @ first
+            flat[-1] = {"type": "ProjectiveTransform", "Matrix": (matrix / matrix[2, 2]).ravel().tolist()}
+        else:
+            flat.append(transform)
+    return {"type": "CompositeTransform", "transforms": flat}
+
+
+class TransformGraph:
+    """Registration edges of a patient, with shortest path transforms between any two images."""
+
+    def __init__(self, form_data: Iterable[Dict[str, Any]] = ()):
+        # image -> {neighbour: transform from image to neighbour}
+        self._edges: Dict[int, Dict[int, Any]] = defaultdict(dict)
+        self.components = UnionFind()
+        # shortest path trees by source image: {image: previous image on the path}
+        self._trees: Dict[int, Dict[int, Optional[int]]] = {}
+        for edge in form_data:
+            self.add_edge(edge["image1"], edge["image2"], edge["transform"])
+
+    def __len__(self):
+        return len(self._edges)
+
+    def add_edge(self, image1: int, image2: int, transform: Dict[str, Any]):
+        # the reverse direction is inverted lazily, see _edge_transform
+        self._edges[image1][image2] = transform
+        self._edges[image2].setdefault(image1, None)
+        self.components.union(image1, image2)
+        self._trees.clear()
+
+    def connected(self, image1: int, image2: int) -> bool:
+        return self.components.connected(image1, image2)
+
+    def _tree(self, source: int) -> Dict[int, Optional[int]]:
+        tree = self._trees.get(source)
+        if tree is None:
+            tree = {source: None}
+            queue = deque([source])
+            while queue:
+                current = queue.popleft()
+                for neighbour in self._edges[current]:
+                    if neighbour not in tree:
+                        tree[neighbour] = current
+                        queue.append(neighbour)
+            self._trees[source] = tree
+        return tree
+
+    def path(self, source: int, target: int) -> Optional[List[int]]:
+        """Shortest path of images from source to target, None if they are not connected."""
+        if not self.connected(source, target):
+            return None
+        tree = self._tree(source)
+        path = [target]
+        while path[-1] != source:
+            path.append(tree[path[-1]])
+        return path[::-1]
+
+    def _edge_transform(self, image1: int, image2: int) -> Dict[str, Any]:
+        transform = self._edges[image1][image2]
+        if transform is None:
+            transform = invert_transform(self._edges[image2][image1])
+            self._edges[image1][image2] = transform
+        return transform
+
+    def transform(self, source: int, target: int) -> Optional[Dict[str, Any]]:
+        """Composed transform from source to target, None if they are not connected."""
+        path = self.path(source, target)
+        if path is None:
+            return None
+        return compose_transforms(
+            [self._edge_transform(a, b) for a, b in zip(path[:-1], path[1:])]
+        )
+
+
+# (PatientID, SchemaName) -> (version of the registration sets, TransformGraph)
+_transform_graphs: "OrderedDict[Tuple, Tuple[Tuple, TransformGraph]]" = OrderedDict()
+
+
+def get_transform_graph(
+    session, patient_id: int, schema_name: str = REGISTRATION_SCHEMA
+) -> TransformGraph:
+    """
+    Transform graph of all active registration sets of a patient. Graphs are cached until one of
+    the registration sets of the patient is added, removed or modified.
+    """
+    rows = session.execute(
+        select(
+            FormAnnotation.FormAnnotationID,
+            FormAnnotation.DateModified,
+            func.json_length(FormAnnotation.FormData),
+        )
+        .join(FormSchema, FormAnnotation.FormSchemaID == FormSchema.FormSchemaID)
+        .where(
+            FormAnnotation.PatientID == patient_id,
+            FormSchema.SchemaName == schema_name,
+            ~FormAnnotation.Inactive,
+        )
+        .order_by(FormAnnotation.FormAnnotationID)
+    ).all()
+    key = (patient_id, schema_name)
+    version = tuple(tuple(row) for row in rows)
+    cached = _transform_graphs.get(key)
+    if cached is not None and cached[0] == version:
+        _transform_graphs.move_to_end(key)
+        return cached[1]
+
+    form_data = session.scalars(
+        select(FormAnnotation.FormData).where(
+            FormAnnotation.FormAnnotationID.in_([row[0] for row in rows])
+        )
+    )
+    graph = TransformGraph(edge for data in form_data if data for edge in data)
+    _transform_graphs[key] = (version, graph)
+    _transform_graphs.move_to_end(key)
+    while len(_transform_graphs) > TRANSFORM_GRAPH_CACHE_SIZE:
+        _transform_graphs.popitem(last=False)
+    return graph
@@ -0,0 +1,256 @@
+"""
+Warping of segmentations onto registered images.
+
+A segmentation of a source image is resampled onto the pixel grid of a target image of the
+same patient with the transform from the target to the source image (composed along the
+registration sets, see utils/transforms.py), so every target pixel takes the value at its
+location in the source segmentation. Label segmentations (Binary, DualBitMask, MultiLabel,
+MultiClass) use nearest neighbour sampling, probabilities use linear interpolation. Pixels that
+map outside the source segmentation are 0.
+
+Warped segmentations are cached (WarpCache) by the hash of the source data, the transform,
+the target shape and the interpolation, so a modified segmentation or registration is warped
+again.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from eyened_orm.segmentation import DataRepresentation
+from eyened_orm.utils.transforms import REGISTRATION_SCHEMA, get_transform_graph
+
+# memory budget of a WarpCache (full resolution segmentations are tens of MB each)
+WARP_CACHE_BYTES = 256 * 2**20
+
+# rows of the target grid that are mapped at once (bounds the size of the coordinate arrays)
+BLOCK_ROWS = 512
+
+LINEAR_REPRESENTATIONS = (DataRepresentation.Probability,)
+
+
+def map_points(transform: Dict[str, Any], x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply a transform (see registration_schema.json) to arrays of x and y coordinates."""
+    kind = transform["type"]
+    if kind == "ProjectiveTransform":
+        m = np.asarray(transform["Matrix"], dtype=np.float64).reshape(3, 3)
+        w = m[2, 0] * x + m[2, 1] * y + m[2, 2]
+        return (
+            (m[0, 0] * x + m[0, 1] * y + m[0, 2]) / w,
+            (m[1, 0] * x + m[1, 1] * y + m[1, 2]) / w,
+        )
+    if kind == "ParabolicTransform":
+        # coefficients of (1, 1, x, y, x², xy, y²): the intercept is stored twice (see
+        # ParabolicRegistration in the viewer), factorized to limit the array operations
+        a, b = transform["dx"], transform["dy"]
+        dx = (a[0] + a[1]) + x * (a[2] + a[4] * x + a[5] * y) + y * (a[3] + a[6] * y)
+        dy = (b[0] + b[1]) + x * (b[2] + b[4] * x + b[5] * y) + y * (b[3] + b[6] * y)
+        return x - dx, y - dy
+    if kind == "CompositeTransform":
+        for t in transform["transforms"]:
+            x, y = map_points(t, x, y)
+        return x, y
+    raise ValueError(f"Unknown transform type: {kind}")
+
+
+def warp_image(
+    data: np.ndarray,
+    transform: Dict[str, Any],
+    shape: Tuple[int, int],
+    linear: bool = False,
+) -> np.ndarray:
+    """
+    Resample a 2D array onto a grid of the given (height, width), where transform maps grid
+    coordinates to coordinates in data.
+    """
+    height, width = shape
+    # remap does not support unsigned 32 bit data, which is copied bitwise as signed for
+    # nearest neighbour sampling
+    source = data.view(np.int32) if data.dtype == np.uint32 and not linear else data
+    result = np.zeros(shape, dtype=source.dtype)
+    interpolation = cv2.INTER_LINEAR if linear else cv2.INTER_NEAREST
+    xs = np.arange(width, dtype=np.float64)
+    for start in range(0, height, BLOCK_ROWS):
+        stop = min(start + BLOCK_ROWS, height)
+        x, y = np.meshgrid(xs, np.arange(start, stop, dtype=np.float64))
+        map_x, map_y = map_points(transform, x, y)
+        result[start:stop] = cv2.remap(
+            source,
+            map_x.astype(np.float32),
+            map_y.astype(np.float32),
+            interpolation=interpolation,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        )
+    return result.view(data.dtype)
+
+
+def data_version(data: np.ndarray) -> str:
+    """Hash of the data of a segmentation."""
+    h = hashlib.sha256(str((data.dtype.str, data.shape)).encode())
+    h.update(np.ascontiguousarray(data).data)
+    return h.hexdigest()
+
+
+class WarpCache:
+    """
+    Cache of warped segmentations, in memory (the most recently used, at most max_items arrays
+    and max_bytes in total) and, if path is given, on disk. Arrays larger than max_bytes are
+    only cached on disk.
+    """
+
+    def __init__(self, path=None, max_items: int = 64, max_bytes: int = WARP_CACHE_BYTES):
+        self.path = Path(path) if path is not None else None
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._nbytes = 0
+
+    @staticmethod
+    def key(source_version: str, transform: Dict[str, Any], shape, linear: bool) -> str:
+        description = json.dumps(
+            [source_version, transform, list(shape), linear], sort_keys=True
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.npy"
+
+    def _remember(self, key: str, data: np.ndarray):
+        if key in self._items:
+            self._nbytes -= self._items.pop(key).nbytes
+        if data.nbytes > self.max_bytes:
+            return
+        self._items[key] = data
+        self._nbytes += data.nbytes
+        while len(self._items) > self.max_items or self._nbytes > self.max_bytes:
+            self._nbytes -= self._items.popitem(last=False)[1].nbytes
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if key in self._items:
+            self._items.move_to_end(key)
+            return self._items[key]
+        if self.path is None:
+            return None
+        try:
+            data = np.load(self._file(key))
+        except (OSError, ValueError):
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: np.ndarray):
+        self._remember(key, data)
+        if self.path is None:
+            return
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=file.parent, suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp, file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def segmentation_transform(
+    session, segmentation, target_id: int, schema_name: str = REGISTRATION_SCHEMA
+) -> Optional[Dict[str, Any]]:
+    """
+    Transform from the pixels of the target image to the pixels of the segmentation, None if
+    the images are not registered.
+    """
+    source = segmentation.ImageInstance
+    patient_id = source.Series.Study.PatientID
+    graph = get_transform_graph(session, patient_id, schema_name)
+    transform = graph.transform(target_id, source.ImageInstanceID)
+    if transform is None:
+        return None
+    if segmentation.ImageProjectionMatrix is not None:
+        # from image space to segmentation space
+        transform = {
+            "type": "CompositeTransform",
+            "transforms": [
+                transform,
+                {
+                    "type": "ProjectiveTransform",
+                    "Matrix": segmentation.projection_matrix_inverse.ravel().tolist(),
+                },
+            ],
+        }
+    return transform
+
+
+def warp_segmentation(
+    session,
+    segmentation,
+    target,
+    schema_name: str = REGISTRATION_SCHEMA,
+    cache: Optional[WarpCache] = None,
+    data: Optional[np.ndarray] = None,
+) -> Optional[np.ndarray]:
+    """
+    Warp a 2D (Segmentation or ModelSegmentation) onto the target ImageInstance.
+
+    Returns an array of shape (1, Rows_y, Columns_x) of the target image, or None if the images
+    are not registered. data is the data of the segmentation, read if not given.
+    """
+    if segmentation.Depth != 1:
+        raise ValueError(f"Only 2D segmentations can be warped, got shape {segmentation.shape}")
+    transform = segmentation_transform(
+        session, segmentation, target.ImageInstanceID, schema_name
+    )
+    if transform is None:
+        return None
+
+    if data is None:
+        data = segmentation.read_data()
+    if data is None:
+        raise ValueError("Segmentation has no data")
+    shape = (target.Rows_y, target.Columns_x)
+    linear = segmentation.DataRepresentation in LINEAR_REPRESENTATIONS
+
+    key = None
+    if cache is not None:
+        key = WarpCache.key(data_version(data), transform, shape, linear)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    warped = warp_image(data[0], transform, shape, linear)[None]
+    if cache is not None:
+        cache.put(key, warped)
+    return warped
+
+
+def warp_segmentations(
+    session,
+    pairs: Iterable[Tuple[Any, Any]],
+    schema_name: str = REGISTRATION_SCHEMA,
+    cache: Optional[WarpCache] = None,
+) -> Iterator[Tuple[Any, Any, Optional[np.ndarray]]]:
+    """
+    Warp many (segmentation, target ImageInstance) pairs, yielding (segmentation, target,
+    warped). The data of each segmentation is read once and the transform graph of each patient
+    is built once.
+    """
+    data: Dict[Tuple, np.ndarray] = {}
+    for segmentation, target in pairs:
+        location = (segmentation.groupname, segmentation.shape, segmentation.ZarrArrayIndex)
+        if location not in data:
+            # pairs are usually grouped by segmentation
+            data.clear()
+            data[location] = segmentation.read_data()
+        warped = warp_segmentation(
+            session, segmentation, target, schema_name, cache, data[location]
+        )
+        yield segmentation, target, warped
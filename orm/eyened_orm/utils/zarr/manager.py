@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import zarr
@@ -90,6 +90,19 @@ class ZarrStorageManager:
         else:
             return zarr_array.read(zarr_index)
 
+    def read_batch(
+        self,
+        group_name: str,
+        data_dtype: np.dtype,
+        data_shape: Tuple[int],
+        zarr_indices: List[int],
+    ) -> np.ndarray:
+        """
+        Read the segmentations at zarr_indices in one call, returns an array of shape (N, D, H, W).
+        """
+        zarr_array = self.get_array(group_name, data_dtype, data_shape)
+        return zarr_array.read_batch(zarr_indices)
+
     def write(
         self,
         group_name: str,
@@ -123,6 +136,19 @@ class ZarrStorageManager:
         else:
             return zarr_array.write(zarr_index, data)
 
+    def write_batch(
+        self,
+        group_name: str,
+        data_dtype: np.dtype,
+        data_shape: Tuple[int],
+        data: np.ndarray,
+    ) -> List[int]:
+        """
+        Append a batch of segmentations (N, D, H, W) in one write, returns their zarr indices.
+        """
+        zarr_array = self.get_array(group_name, data_dtype, data_shape)
+        return zarr_array.append_batch(data)
+
     def defragment_to_new_store(self, new_store_path: str | Path):
         """
         Defragment the zarr store by copying all segmentations to a new store with sequential ZarrArrayIndex values.
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 import zarr
@@ -82,6 +82,35 @@ class ZarrArray:
         self.array.append(segmentation_data[None, ...])
         return self.array.shape[0] - 1
         
+    def append_batch(self, segmentation_data: np.ndarray) -> List[int]:
+        """
+        Append a batch of segmentations to the zarr array with a single resize and write.
+
+        Args:
+            segmentation_data: Segmentation data as numpy array of shape (N, D, H, W)
+
+        Returns:
+            The zarr indices where the segmentations were written
+        """
+        if len(segmentation_data.shape) != 4:
+            raise ValueError(
+                f"Expected 4D array (N, D, H, W), got shape {segmentation_data.shape}"
+            )
+        if segmentation_data.shape[1:] != self.segmentation_shape:
+            raise ValueError(
+                f"Expected spatial dimensions {self.segmentation_shape}, got {segmentation_data.shape[1:]}"
+            )
+        if segmentation_data.dtype != self.array.dtype:
+            raise ValueError(
+                f"Expected dtype {self.array.dtype}, got {segmentation_data.dtype}"
+            )
+
+        n = segmentation_data.shape[0]
+        start = self.array.shape[0]
+        self.array.resize((start + n, *self.segmentation_shape))
+        self.array[start : start + n, ...] = segmentation_data
+        return list(range(start, start + n))
+
     def _append_zeroed_element(self) -> int:
         """Append a zeroed-out element to the zarr array and return the new index."""
         # Create a zeroed array with the correct shape and dtype
@@ -218,6 +247,29 @@ class ZarrArray:
 
         return self.array[zarr_index, ...]
 
+    def read_batch(self, zarr_indices: List[int]) -> np.ndarray:
+        """
+        Read the segmentations at zarr_indices in a single (orthogonal) selection, so the
+        chunks are fetched concurrently.
+
+        Returns:
+            Segmentation data as numpy array of shape (N, D, H, W), in the order of zarr_indices
+        """
+        zarr_indices = np.asarray(zarr_indices, dtype=np.int64)
+        if len(zarr_indices) == 0:
+            return np.zeros((0, *self.segmentation_shape), dtype=self.array.dtype)
+        if zarr_indices.min() < 0 or zarr_indices.max() >= self.array.shape[0]:
+            raise IndexError(
+                f"Invalid zarr_indices, array length: {self.array.shape[0]}"
+            )
+
+        # zarr requires sorted, unique indices for orthogonal selections
+        unique_indices, inverse = np.unique(zarr_indices, return_inverse=True)
+        data = self.array.get_orthogonal_selection(
+            (unique_indices, slice(None), slice(None), slice(None))
+        )
+        return data[inverse]
+
     def delete(self, zarr_index: int) -> None:
         """
         Delete segmentation data from the zarr array by clearing the specified index.
@@ -0,0 +1,29 @@
+"""checksum indexes
+
+Revision ID: 3f9c2a7d41b6
+Revises: 10d5ab598dc7
+Create Date: 2026-10-19 09:12:40.118233
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2a7d41b6'
+down_revision: Union[str, None] = '10d5ab598dc7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('FileChecksum_idx', 'ImageInstance', ['FileChecksum'], unique=False, mysql_length=16)
+    op.create_index('DataHash_idx', 'ImageInstance', ['DataHash'], unique=False, mysql_length=64)
+
+
+def downgrade() -> None:
+    op.drop_index('DataHash_idx', table_name='ImageInstance')
+    op.drop_index('FileChecksum_idx', table_name='ImageInstance')
@@ -0,0 +1,34 @@
+"""inference cache
+
+Revision ID: 8b1e4c6f2a93
+Revises: 3f9c2a7d41b6
+Create Date: 2026-10-20 10:03:12.482107
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b1e4c6f2a93'
+down_revision: Union[str, None] = '3f9c2a7d41b6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('InferenceCache',
+    sa.Column('DataHash', sa.VARBINARY(length=64), nullable=False),
+    sa.Column('ModelName', sa.String(length=64), nullable=False),
+    sa.Column('ModelVersion', sa.String(length=255), nullable=False),
+    sa.Column('Result', sa.JSON(), nullable=True),
+    sa.Column('DateInserted', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('DataHash', 'ModelName', 'ModelVersion')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('InferenceCache')
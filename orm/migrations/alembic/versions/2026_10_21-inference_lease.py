@@ -0,0 +1,29 @@
+"""inference lease
+
+Revision ID: c47d09e5b218
+Revises: 8b1e4c6f2a93
+Create Date: 2026-10-21 14:27:51.903664
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c47d09e5b218'
+down_revision: Union[str, None] = '8b1e4c6f2a93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('ImageInstance', sa.Column('InferenceLeaseOwner', sa.String(length=64), nullable=True))
+    op.add_column('ImageInstance', sa.Column('InferenceLeaseUntil', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('ImageInstance', 'InferenceLeaseUntil')
+    op.drop_column('ImageInstance', 'InferenceLeaseOwner')
@@ -0,0 +1,27 @@
+"""inference attempts
+
+Revision ID: 5e2a9d13f6b7
+Revises: c47d09e5b218
+Create Date: 2026-10-22 09:12:37.418260
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2a9d13f6b7'
+down_revision: Union[str, None] = 'c47d09e5b218'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('ImageInstance', sa.Column('InferenceAttempts', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('ImageInstance', 'InferenceAttempts')
@@ -24,6 +24,7 @@ setup(
         "click==8.*",
         "numpy==2.*",
         "pandas==2.*",
+        "pyarrow",
         "matplotlib==3.*",
         "opencv-python-headless==4.*",
         "sqlalchemy==2.*",
@@ -41,5 +42,9 @@ setup(
         "zarr==3.1.0",
         "pyyaml==6.*",
     ],
+    extras_require={
+        # CPU inference backends onnx and onnx-int8 (see eyened_orm/inference/backends.py)
+        "onnx": ["onnx", "onnxruntime"],
+    },
     python_requires=">=3.10",
 )
@@ -30,6 +30,15 @@ class ObjectTagPATCH(BaseModel):
     comment: Optional[str] = None
 
 
+class TransformGET(BaseModel):
+    image1: int
+    image2: int
+    # images on the shortest path of registrations from image1 to image2
+    path: list[int]
+    # CompositeTransform (see registration_schema.json)
+    transform: dict[str, Any]
+
+
 # Utility DTOs
 class Position2D(BaseModel):
     x: float
@@ -1,17 +1,29 @@
-from typing import Dict, Optional, Any, Union
+from typing import Dict, List, Literal, Optional, Any, Union
 import traceback
 import datetime
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.security import HTTPBasic
 from pydantic import BaseModel, Field
 from server.routes.auth import CurrentUser, get_current_user
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 
+from eyened_orm import ImageInstance, Patient, Project, Series, Study
 from eyened_orm.importer.importer import Importer
 from ..db import get_db
 from ..config import settings
-from ..utils.huey import task_run_inference, task_update_thumbnails
+from ..utils.huey import (
+    huey,
+    INFERENCE_CHUNK_SIZE,
+    INFERENCE_SHARDS,
+    get_inference_failures,
+    task_run_inference,
+    task_update_thumbnails,
+    task_import_batch,
+    set_import_job_status,
+    get_import_job_status,
+)
 
 router = APIRouter()
 security = HTTPBasic()
@@ -66,6 +78,10 @@ class ImportOptions(BaseModel):
     include_stack_trace: bool = Field(
         False, description="If True, include stack trace in the error response"
     )
+    on_duplicate: Literal["allow", "skip", "link", "flag"] = Field(
+        "allow",
+        description="What to do with images whose file is identical to an existing image",
+    )
 
 
 class ImportRequest(BaseModel):
@@ -81,6 +97,44 @@ class ImportResponse(BaseModel):
     stack_trace: Optional[str] = None
 
 
+class BatchImportRequest(BaseModel):
+    data: List[ImageImportData] = Field(..., min_length=1)
+    options: ImportOptions
+    batch_size: int = Field(
+        100, ge=1, description="Number of images committed per transaction"
+    )
+
+
+class BatchImportRowError(BaseModel):
+    row: int
+    image: Optional[str] = None
+    error: str
+
+
+class BatchImportStatus(BaseModel):
+    job_id: str
+    status: str = Field(..., description="queued, running, completed or failed")
+    total: int
+    processed: int = 0
+    imported: int = 0
+    duplicates: int = 0
+    failed: List[BatchImportRowError] = []
+    error: Optional[str] = None
+
+
+class DuplicateImage(BaseModel):
+    image_id: int
+    dataset_identifier: str
+    project_id: int
+    project_name: str
+    patient_identifier: Optional[str] = None
+
+
+class DuplicateGroup(BaseModel):
+    checksum: str = Field(..., description="Hex encoded md5 checksum of the file")
+    images: List[DuplicateImage]
+
+
 class TaskResponse(BaseModel):
     success: bool
     message: str
@@ -88,6 +142,22 @@ class TaskResponse(BaseModel):
     error: Optional[str] = None
 
 
+class InferenceFailure(BaseModel):
+    task_id: str
+    error: str
+    retries_left: int
+    time: float
+
+
+class InferenceStatus(BaseModel):
+    pending: int
+    in_progress: int
+    failed: int = 0
+    chunk_size: int
+    shards: int
+    failures: List[InferenceFailure] = []
+
+
 def make_importer(session, options: ImportOptions):
     # Create importer with options
     return Importer(
@@ -96,6 +166,7 @@ def make_importer(session, options: ImportOptions):
         create_studies=options.create_studies,
         create_series=options.create_series,
         create_projects=options.create_project,
+        on_duplicate=options.on_duplicate,
         generate_thumbnails=True,
         run_ai_models=False,  # We handle this separately via background tasks
         config=settings,
@@ -135,8 +206,117 @@ async def import_single_image(
     return ImportResponse(
         success=True,
         message="Import completed successfully",
-        data={"project_name": image_data["project_name"], "image_count": len(images)},
+        data={
+            "project_name": image_data["project_name"],
+            "image_count": len(images),
+            "duplicates": importer.duplicates,
+        },
+    )
+
+
+@router.post("/import/batch", response_model=BatchImportStatus)
+async def import_batch(
+    request: BatchImportRequest,
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Queue the import of many images as a background job.
+
+    The images are imported by the worker, which also generates thumbnails and queues inference.
+    Use GET /import/batch/{job_id} to follow the progress of the job.
+    """
+    rows = [item.model_dump() for item in request.data]
+    options = request.options.model_dump()
+
+    # create the task first so the job status exists before the worker can pick it up
+    task = task_import_batch.s(rows, options, batch_size=request.batch_size)
+    set_import_job_status(task.id, job_id=task.id, status="queued", total=len(rows))
+    huey.enqueue(task)
+
+    return BatchImportStatus(**get_import_job_status(task.id))
+
+
+@router.get("/import/batch/{job_id}", response_model=BatchImportStatus)
+async def get_import_batch_status(
+    job_id: str,
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    status = get_import_job_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return BatchImportStatus(**status)
+
+
+@router.get("/import/duplicates", response_model=List[DuplicateGroup])
+async def get_duplicates(
+    project_id: Optional[int] = None,
+    across_projects: bool = False,
+    limit: int = 100,
+    offset: int = 0,
+    session: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Find groups of active images with identical files (same FileChecksum).
+
+    Args:
+        project_id: Only return groups containing at least one image of this project
+        across_projects: Only return groups with images in more than one project
+    """
+    checksum = ImageInstance.FileChecksum
+    groups = (
+        select(checksum)
+        .join(Series)
+        .join(Study)
+        .join(Patient)
+        .where(checksum.is_not(None), ImageInstance.Inactive == False)
+        .group_by(checksum)
+        .having(func.count(ImageInstance.ImageInstanceID) > 1)
+        .order_by(checksum)
+        .limit(limit)
+        .offset(offset)
     )
+    if across_projects:
+        groups = groups.having(func.count(func.distinct(Patient.ProjectID)) > 1)
+    if project_id is not None:
+        groups = groups.having(func.sum(Patient.ProjectID == project_id) > 0)
+
+    checksums = session.scalars(groups).all()
+    if not checksums:
+        return []
+
+    rows = session.execute(
+        select(
+            checksum,
+            ImageInstance.ImageInstanceID,
+            ImageInstance.DatasetIdentifier,
+            Project.ProjectID,
+            Project.ProjectName,
+            Patient.PatientIdentifier,
+        )
+        .join(Series)
+        .join(Study)
+        .join(Patient)
+        .join(Project)
+        .where(checksum.in_(checksums), ImageInstance.Inactive == False)
+        .order_by(checksum, ImageInstance.ImageInstanceID)
+    ).all()
+
+    result: Dict[bytes, DuplicateGroup] = {}
+    for row in rows:
+        group = result.setdefault(
+            row.FileChecksum, DuplicateGroup(checksum=row.FileChecksum.hex(), images=[])
+        )
+        group.images.append(
+            DuplicateImage(
+                image_id=row.ImageInstanceID,
+                dataset_identifier=row.DatasetIdentifier,
+                project_id=row.ProjectID,
+                project_name=row.ProjectName,
+                patient_identifier=row.PatientIdentifier,
+            )
+        )
+    return list(result.values())
 
 
 @router.post("/import/run_inference", response_model=TaskResponse)
@@ -153,6 +333,26 @@ async def run_inference(current_user: CurrentUser = Depends(get_current_user)):
         )
 
 
+@router.get("/import/inference_status", response_model=InferenceStatus)
+async def inference_status(
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Progress of the inference queue: images waiting for inference (pending), images in
+    chunks that are being processed (in_progress), images that are no longer claimed after
+    repeated failures (failed) and the most recent chunk failures.
+    """
+    from eyened_orm.inference.queue import inference_progress
+
+    return InferenceStatus(
+        **inference_progress(db),
+        chunk_size=INFERENCE_CHUNK_SIZE,
+        shards=INFERENCE_SHARDS,
+        failures=get_inference_failures(),
+    )
+
+
 @router.post("/import/update_thumbnails", response_model=TaskResponse)
 async def update_thumbnails(current_user: CurrentUser = Depends(get_current_user)):
     try:
@@ -6,11 +6,12 @@ from eyened_orm import (
 from eyened_orm.tag import SegmentationTagLink, FormAnnotationTagLink, TagType
 from fastapi import APIRouter, Depends, HTTPException, Response
 
+from sqlalchemy import select
 from sqlalchemy.orm import Session, selectinload
 
 from ..dtos.dto_converter import DTOConverter
 from ..dtos.dtos_instances import InstanceGET
-from ..dtos.dtos_aux import ObjectTagPOST, ObjectTagPATCH, TagMeta
+from ..dtos.dtos_aux import ObjectTagPOST, ObjectTagPATCH, TagMeta, TransformGET
 
 from .auth import CurrentUser, get_current_user, is_authenticated
 from ..db import get_db
@@ -152,3 +153,38 @@ async def untag_instance(instance_id: int, tag_id: int, db: Session = Depends(ge
     if link:
         db.delete(link); db.commit()
     return Response(status_code=204)
+
+
+@router.get("/instances/{instance_id}/transform/{target_id}", response_model=TransformGET)
+async def get_instance_transform(
+    instance_id: int,
+    target_id: int,
+    schema_name: str = "RegistrationSet",
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """Registration transform from an ImageInstance to another image of the same patient."""
+    from eyened_orm.utils.transforms import get_transform_graph
+
+    rows = db.execute(
+        select(ImageInstance.ImageInstanceID, Study.PatientID)
+        .join(Series, ImageInstance.SeriesID == Series.SeriesID)
+        .join(Study, Series.StudyID == Study.StudyID)
+        .where(ImageInstance.ImageInstanceID.in_([instance_id, target_id]))
+    ).all()
+    patient_ids = dict(rows)
+    if instance_id not in patient_ids or target_id not in patient_ids:
+        raise HTTPException(404, "ImageInstance not found")
+    if patient_ids[instance_id] != patient_ids[target_id]:
+        raise HTTPException(400, "Images belong to different patients")
+
+    graph = get_transform_graph(db, patient_ids[instance_id], schema_name)
+    path = graph.path(instance_id, target_id)
+    if path is None:
+        raise HTTPException(404, "Images are not registered")
+    return TransformGET(
+        image1=instance_id,
+        image2=target_id,
+        path=path,
+        transform=graph.transform(instance_id, target_id),
+    )
@@ -28,6 +28,7 @@ from fastapi import (
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session, selectinload
 
+from ..config import settings
 from ..db import get_db
 from .auth import CurrentUser, get_current_user
 from ..dtos.dtos_main import SegmentationGET, SegmentationPOST, SegmentationPATCH
@@ -36,6 +37,9 @@ from ..dtos.dtos_aux import ObjectTagPOST, TagMeta
 
 router = APIRouter()
 
+# warped segmentations, also kept on disk if the fundus image cache is configured
+warp_cache = None
+
 dtypes = {
     Datatype.R8: np.uint8,
     Datatype.R8UI: np.uint8,
@@ -419,3 +423,74 @@ async def get_model_segmentation_data(
         "Content-Length": str(len(gz)),
     }
     return Response(content=gz, media_type="application/octet-stream", headers=headers)
+
+
+def get_warp_cache():
+    global warp_cache
+    if warp_cache is None:
+        from eyened_orm.utils.warping import WarpCache
+
+        path = settings.cfi_cache_path / "warped" if settings.cfi_cache_path else None
+        # per worker process; with a disk cache only a few recent arrays are kept in memory
+        warp_cache = WarpCache(path, max_items=8) if path is not None else WarpCache()
+    return warp_cache
+
+
+def warped_response(segmentation, target_id: int, schema_name: str, db: Session, filename: str):
+    from eyened_orm.utils.warping import warp_segmentation
+
+    target = ImageInstance.by_id(db, target_id)
+    if target is None:
+        raise HTTPException(status_code=404, detail="Target ImageInstance not found")
+    if segmentation.ImageInstance.Series.Study.PatientID != target.Series.Study.PatientID:
+        raise HTTPException(status_code=400, detail="Images belong to different patients")
+
+    try:
+        arr = warp_segmentation(db, segmentation, target, schema_name, get_warp_cache())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    if arr is None:
+        raise HTTPException(status_code=404, detail="Images are not registered")
+
+    np_buf = io.BytesIO()
+    np.save(np_buf, arr)
+    gz = gzip.compress(np_buf.getvalue())
+
+    headers = {
+        "Content-Encoding": "gzip",
+        "Content-Disposition": f'inline; filename="{filename}"',
+        "Content-Length": str(len(gz)),
+    }
+    return Response(content=gz, media_type="application/octet-stream", headers=headers)
+
+
+@router.get("/segmentations/{segmentation_id}/warp/{target_id}")
+async def get_warped_segmentation_data(
+    segmentation_id: int,
+    target_id: int,
+    schema_name: str = "RegistrationSet",
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """Segmentation data warped onto a registered image of the same patient."""
+    segmentation = Segmentation.by_id(db, segmentation_id)
+    if segmentation is None:
+        raise HTTPException(status_code=404, detail="Segmentation data not found")
+    return warped_response(segmentation, target_id, schema_name, db, "segmentation.npy.gz")
+
+
+@router.get("/model-segmentations/{model_segmentation_id}/warp/{target_id}")
+async def get_warped_model_segmentation_data(
+    model_segmentation_id: int,
+    target_id: int,
+    schema_name: str = "RegistrationSet",
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """ModelSegmentation data warped onto a registered image of the same patient."""
+    model_segmentation = ModelSegmentation.by_id(db, model_segmentation_id)
+    if model_segmentation is None:
+        raise HTTPException(status_code=404, detail="ModelSegmentation data not found")
+    return warped_response(
+        model_segmentation, target_id, schema_name, db, "model_segmentation.npy.gz"
+    )
@@ -1,6 +1,7 @@
 
-from huey import RedisHuey
+from huey import RedisHuey, crontab
 import os
+import time
 import logging
 # Configure logging
 logging.basicConfig(
@@ -18,30 +19,228 @@ huey = RedisHuey(
     port=redis_port,
 )
 
+# Models stay loaded in the worker process between inference tasks (see get_model_registry)
+INFERENCE_MODELS_KEY = 'inference-models'
+INFERENCE_MEMORY_BUDGET_MB = os.environ.get('INFERENCE_MEMORY_BUDGET_MB')
+INFERENCE_IDLE_TIMEOUT = os.environ.get('INFERENCE_IDLE_TIMEOUT')
+# torch, onnx or onnx-int8 (only used when the worker has no GPU)
+INFERENCE_CPU_BACKEND = os.environ.get('INFERENCE_CPU_BACKEND') or 'torch'
+INFERENCE_NUM_THREADS = os.environ.get('INFERENCE_NUM_THREADS')
+# Inference is split in chunk tasks, of which at most INFERENCE_SHARDS run concurrently
+INFERENCE_CHUNK_SIZE = int(os.environ.get('INFERENCE_CHUNK_SIZE') or 500)
+INFERENCE_SHARDS = int(os.environ.get('INFERENCE_SHARDS') or 4)
+INFERENCE_LEASE_SECONDS = int(os.environ.get('INFERENCE_LEASE_SECONDS') or 3600)
+INFERENCE_FAILURES_KEY = 'inference-failures'
+
+
+def get_model_registry():
+    """
+    Return the model registry of this worker process.
+
+    The model versions stored with set_inference_models are applied on every call,
+    so that a new version is loaded by the next inference task (hot reload).
+    """
+    from eyened_orm.inference.registry import ModelSpec, get_registry
+    from eyened_orm.inference.utils import auto_device
+
+    device = auto_device()
+    registry = get_registry(
+        device,
+        backend=INFERENCE_CPU_BACKEND if device.type == 'cpu' else 'torch',
+        num_threads=int(INFERENCE_NUM_THREADS) if INFERENCE_NUM_THREADS else None,
+        memory_budget_mb=float(INFERENCE_MEMORY_BUDGET_MB) if INFERENCE_MEMORY_BUDGET_MB else None,
+        idle_timeout=float(INFERENCE_IDLE_TIMEOUT) if INFERENCE_IDLE_TIMEOUT else None,
+    )
+    models = huey.get(INFERENCE_MODELS_KEY, peek=True)
+    if models:
+        registry.update_models({name: ModelSpec(**spec) for name, spec in models.items()})
+    return registry
+
+
+def set_inference_models(models):
+    """
+    Set the model versions used by the inference workers.
+
+    Args:
+        models: Dict of model name (fovea, discedge, quality) to a dict with the
+            ModelSpec fields kind, reference and (optionally) version
+    """
+    current = huey.get(INFERENCE_MODELS_KEY, peek=True) or {}
+    huey.put(INFERENCE_MODELS_KEY, {**current, **models})
+
+
 @huey.task()
-@huey.lock_task('inference-lock')
 def task_run_inference():
     """
-    Run inference on images in a background task.
-    
+    Queue inference chunk tasks for the ColorFundus images that have not been processed yet.
+
+    Up to INFERENCE_SHARDS chunk tasks are queued (fewer if chunks are already being processed).
+    Each chunk task claims a chunk of images and queues the next chunk task when done, so the
+    backlog is drained by as many workers as are available.
+    """
+    from math import ceil
+
+    from eyened_orm.inference.queue import inference_progress
+    from eyened_orm.utils.config import load_config
+    from eyened_orm import Database
+
+    config = load_config()
+    database = Database(config)
+    with database.get_session() as session:
+        progress = inference_progress(session)
+
+    running = ceil(progress['in_progress'] / INFERENCE_CHUNK_SIZE)
+    n_shards = min(ceil(progress['pending'] / INFERENCE_CHUNK_SIZE), INFERENCE_SHARDS - running)
+    for _ in range(max(n_shards, 0)):
+        task_run_inference_chunk()
+    logger.info(
+        f"Queued {max(n_shards, 0)} inference chunk tasks "
+        f"({progress['pending']} images pending, {progress['in_progress']} in progress)"
+    )
+    return max(n_shards, 0)
+
+
+@huey.task(retries=2, retry_delay=60, context=True)
+def task_run_inference_chunk(task=None):
+    """
+    Run inference on one chunk of INFERENCE_CHUNK_SIZE pending images.
+
+    The images are leased to this task in the database (SELECT ... FOR UPDATE SKIP LOCKED),
+    so chunk tasks on any number of workers process disjoint images. A failed chunk task is
+    retried (with the same images); after the lease expires, its images can be claimed by other tasks.
+    Models are loaded once per worker process and reused by subsequent tasks.
+    """
+    from eyened_orm.inference.inference import run_inference_chunk
+    from eyened_orm.utils.config import load_config
+    from eyened_orm import Database
+
+    config = load_config()
+    database = Database(config)
+    registry = get_model_registry()
+
+    try:
+        with database.get_session() as session:
+            n_images = run_inference_chunk(
+                session,
+                owner=f'huey:{task.id}',
+                chunk_size=INFERENCE_CHUNK_SIZE,
+                lease_seconds=INFERENCE_LEASE_SECONDS,
+                cfi_cache_path=config.cfi_cache_path,
+                registry=registry,
+            )
+    except Exception as e:
+        logger.exception(f"Inference chunk task {task.id} failed ({task.retries} retries left)")
+        add_inference_failure(task.id, str(e), task.retries)
+        raise
+
+    logger.info(f"Inference chunk task {task.id} processed {n_images} images")
+    if n_images == INFERENCE_CHUNK_SIZE:
+        # there may be more pending images, continue with the next chunk
+        task_run_inference_chunk()
+    return n_images
+
+
+def add_inference_failure(task_id, error, retries_left, max_failures=100):
+    failures = huey.get(INFERENCE_FAILURES_KEY, peek=True) or []
+    failures.append({
+        'task_id': task_id,
+        'error': error,
+        'retries_left': retries_left,
+        'time': time.time(),
+    })
+    huey.put(INFERENCE_FAILURES_KEY, failures[-max_failures:])
+
+
+def get_inference_failures():
+    """Most recent inference chunk failures."""
+    return huey.get(INFERENCE_FAILURES_KEY, peek=True) or []
+
+
+def import_job_key(job_id):
+    return f'import-job-{job_id}'
+
+
+def set_import_job_status(job_id, **status):
+    """
+    Store the status of a batch import job in the huey result store.
+    Status is read with peek=True, so it remains available after reading.
+    """
+    key = import_job_key(job_id)
+    current = huey.get(key, peek=True) or {}
+    huey.put(key, {**current, **status})
+
+
+def get_import_job_status(job_id):
+    return huey.get(import_job_key(job_id), peek=True)
+
+
+@huey.task(context=True)
+def task_import_batch(rows, options, batch_size=100, task=None):
+    """
+    Import a batch of images in a background task.
+
+    Images are committed in batches of batch_size, thumbnails are generated
+    for each committed batch and inference is queued once all images are imported.
+    Progress is stored under the task id (see get_import_job_status).
+
     Args:
-        device: Device to run inference on (None for auto-selection)
+        rows: List of flat image dictionaries (see Importer.import_one)
+        options: Import options (create_patients, create_studies, create_series, create_project, on_duplicate)
     """
-    from eyened_orm.inference.inference import run_inference
+    from eyened_orm.importer.importer import Importer
     from eyened_orm.utils.config import load_config
     from eyened_orm import Database
-    
-    logger.info(f"Starting inference task")
+
+    job_id = task.id
+    logger.info(f"Starting batch import task {job_id} ({len(rows)} images)")
+    set_import_job_status(job_id, status='running')
 
     config = load_config()
     database = Database(config)
 
-    with database.get_session() as session:
-        # Use session for database operations
+    def on_progress(stats):
+        set_import_job_status(
+            job_id,
+            processed=stats['rows'],
+            imported=stats['imported'],
+            duplicates=stats['duplicates'],
+            failed=stats['failed'],
+        )
+
+    try:
+        with database.get_session() as session:
+            importer = Importer(
+                session=session,
+                config=config,
+                create_patients=options.get('create_patients', False),
+                create_studies=options.get('create_studies', False),
+                create_series=options.get('create_series', True),
+                create_projects=options.get('create_project', False),
+                on_duplicate=options.get('on_duplicate', 'allow'),
+                generate_thumbnails=True,
+                run_ai_models=False,
+            )
+            stats = importer.import_stream(
+                rows, batch_size=batch_size, progress_callback=on_progress
+            )
+    except Exception as e:
+        logger.exception(f"Batch import task {job_id} failed")
+        set_import_job_status(job_id, status='failed', error=str(e))
+        raise
+
+    set_import_job_status(
+        job_id,
+        status='completed',
+        processed=stats['rows'],
+        imported=stats['imported'],
+        duplicates=stats['duplicates'],
+        failed=stats['failed'],
+    )
+    if stats['imported']:
+        task_run_inference()
+    logger.info(f"Batch import task {job_id} completed: {stats['imported']} images imported")
+    return stats['imported']
 
-        run_inference(session, device=None, cfi_cache_path=None)
-    logger.info("Inference task completed successfully")
-    return True
 
 @huey.task()
 @huey.lock_task('update-thumbnails-lock') 